@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+
+import sys
+from pyimgann import cli
+
+if __name__ == "__main__":
+    sys.exit(cli.main())
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+
+import sys
+from pyimgann import bench
+
+if __name__ == "__main__":
+    sys.exit(bench.main())
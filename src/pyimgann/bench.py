@@ -0,0 +1,265 @@
+""" Benchmarks of the model, persistence and frame-switch hot paths.
+
+    python -m pyimgann.bench --images 20000 --corrs 200 --save base.json
+    python -m pyimgann.bench --images 20000 --corrs 200 --compare base.json
+
+Each benchmark runs in its own process on a synthetic project, and reports
+latency percentiles and the peak resident memory of that process. The gui
+benchmarks request Qt's offscreen platform; Qt 4 has no such platform, so
+there they need a display (e.g. xvfb-run) or can be skipped with --no-gui.
+With --compare the results are checked against a saved baseline and the
+exit status is 1 if any benchmark got slower than the allowed ratio.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+import pathlib as pl
+import numpy as np
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(name, gui=False):
+    def register(f):
+        BENCHMARKS[name] = (f, gui)
+        return f
+    return register
+
+def timed(f, repeat):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        f(i)
+        times.append(time.time() - start)
+    return times
+
+def synthetic_project(workdir, n_images, n_corrs, skip=1, seed=0):
+    """ Return a project of n_images (not written to disk) with n_corrs
+    random correspondences and their keypoints on every pair """
+    import pyimgann.model as mdl
+    rng = np.random.RandomState(seed)
+    images = mdl.PathTable([os.path.join(workdir, "{0:06d}.png".format(i))
+                            for i in xrange(n_images)])
+    proj = {'name': 'bench',
+            'image_path': pl.Path(workdir),
+            'images': images,
+            'kps': mdl.defaultdict(mdl.PointSet2D),
+            'pairs': mdl.PairSequence(images, skip),
+            'skip': skip,
+            'correspondences': mdl.defaultdict(mdl.CorrespondenceSet),
+            'pat': "*.png",
+            'index': 0}
+    for pair in proj['pairs']:
+        rows = rng.randint(0, 480, size=(n_corrs, 4)).astype(np.int32)
+        proj['correspondences'][pair].add_rows(rows)
+        proj['kps'][pair[0]].add_points(rows[:,0:2])
+        proj['kps'][pair[1]].add_points(rows[:,2:4])
+    return proj
+
+def write_images(proj, count, shape=(480, 640)):
+    """ Write the first count images of proj as noise pngs """
+    from skimage.io import imsave
+    rng = np.random.RandomState(1)
+    for i in xrange(min(count, len(proj['images']))):
+        imsave(str(proj['images'][i]),
+               rng.randint(0, 255, size=shape + (3,)).astype(np.uint8))
+
+# lookups timed together, as one is too quick to time
+LOOKUPS = 1000
+
+def synthetic_paths(workdir, n_images):
+    return [os.path.join(workdir, "{0:06d}.png".format(i)) for i in xrange(n_images)]
+
+@benchmark("pair_sequence")
+def bench_pair_sequence(cfg, workdir):
+    import pyimgann.model as mdl
+    pairs = mdl.PairSequence(mdl.PathTable(synthetic_paths(workdir, cfg.images)), 1)
+    rng = np.random.RandomState(4)
+    picks = rng.randint(0, len(pairs), size=(cfg.repeat, LOOKUPS))
+    def index(i):
+        for j in picks[i]:
+            pairs[j]
+    return timed(index, cfg.repeat)
+
+@benchmark("pair_index")
+def bench_pair_index(cfg, workdir):
+    import pyimgann.model as mdl
+    images = mdl.PathTable(synthetic_paths(workdir, cfg.images))
+    rows = np.arange(cfg.images, dtype=np.int32)
+    pairs = mdl.IndexedPairs(images, np.column_stack([rows[:-1], rows[1:]]))
+    rng = np.random.RandomState(4)
+    picks = rng.randint(0, len(pairs), size=(cfg.repeat, LOOKUPS))
+    def lookup(i):
+        # a fresh index, as after opening a project
+        index = mdl.PairIndex(pairs, mdl.PathIndex(images))
+        for j in picks[i]:
+            index.get(pairs[j])
+    return timed(lookup, cfg.repeat)
+
+@benchmark("save_correspondence_project")
+def bench_save(cfg, workdir):
+    import pyimgann.model as mdl
+    proj = synthetic_project(workdir, cfg.images, cfg.corrs)
+    fn = os.path.join(workdir, "bench.pya")
+    return timed(lambda i: mdl.save_correspondence_project(proj, fn), cfg.repeat)
+
+@benchmark("load_correspondence_project")
+def bench_load(cfg, workdir):
+    import pyimgann.model as mdl
+    proj = synthetic_project(workdir, cfg.images, cfg.corrs)
+    fn = os.path.join(workdir, "bench.pya")
+    mdl.save_correspondence_project(proj, fn)
+    del proj
+    def load(i):
+        # opening plus the first frame's data
+        p = mdl.load_correspondence_project(fn)
+        mdl.get_kps(p, 0)
+        mdl.get_correspondences(p, 0)
+    return timed(load, cfg.repeat)
+
+@benchmark("apply_correspondence")
+def bench_apply(cfg, workdir):
+    import pyimgann.model as mdl
+    proj = synthetic_project(workdir, min(cfg.images, 10), cfg.corrs)
+    rng = np.random.RandomState(2)
+    rows = rng.randint(480, 960, size=(cfg.repeat, 4))
+    return timed(lambda i: mdl.apply_correspondence(
+        proj, 0, mdl.Correspondence(rows[i,0:2], rows[i,2:4])), cfg.repeat)
+
+def gui_controller(proj, workdir):
+    """ Return a controller showing proj, with its disk caches in workdir
+    and without the background work that would compete with the timed
+    frame switches and edits """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt4 import QtGui
+    import pyimgann.ui as ui
+    import pyimgann.cache as cache
+    import pyimgann.controller as ctrl
+    app = QtGui.QApplication([])
+    mw = ui.MainWindow()
+    ctl = ctrl.CorrespondenceController(mw, cache_dir=os.path.join(workdir, "cache"))
+    ctl.propagate = False
+    ctl.prefetcher.close()
+    ctl.prefetcher = cache.ImagePrefetcher(ctl.image_cache, 0, pyramids=ctl.pyramids)
+    ctl.current_project = proj
+    ctrl.load_project(proj, ctl)
+    return app, ctl
+
+@benchmark("load_frame", gui=True)
+def bench_load_frame(cfg, workdir):
+    import pyimgann.controller as ctrl
+    frames = min(cfg.frames, cfg.images - 1)
+    proj = synthetic_project(workdir, frames + 1, cfg.corrs)
+    write_images(proj, frames + 1)
+    app, ctl = gui_controller(proj, workdir)
+    def load(i):
+        ctrl.load_frame(proj, ctl, i % frames)
+        app.processEvents()
+    return timed(load, cfg.repeat)
+
+@benchmark("add_correspondence", gui=True)
+def bench_add(cfg, workdir):
+    import pyimgann.controller as ctrl
+    proj = synthetic_project(workdir, 2, cfg.corrs)
+    write_images(proj, 2)
+    app, ctl = gui_controller(proj, workdir)
+    ctrl.load_frame(proj, ctl, 0)
+    rng = np.random.RandomState(3)
+    rows = rng.randint(0, 480, size=(cfg.repeat, 4))
+    def add(i):
+        ctl.edit("add correspondence", added=rows[i])
+        app.processEvents()
+    return timed(add, cfg.repeat)
+
+def run_one(name, cfg, queue):
+    f, gui = BENCHMARKS[name]
+    workdir = tempfile.mkdtemp(prefix="pyimgann-bench-")
+    try:
+        times = f(cfg, workdir)
+        # ru_maxrss is in kilobytes on linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        queue.put((times, peak))
+    except Exception as e:
+        queue.put((None, repr(e)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run(name, cfg):
+    """ Run a benchmark in a fresh process, so its peak memory is its own """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_one, args=(name, cfg, queue))
+    p.start()
+    times, peak = queue.get()
+    p.join()
+    if times is None:
+        raise RuntimeError("{0} failed: {1}".format(name, peak))
+    ms = 1000 * np.array(times)
+    return OrderedDict([('p50', float(np.percentile(ms, 50))),
+                        ('p90', float(np.percentile(ms, 90))),
+                        ('p99', float(np.percentile(ms, 99))),
+                        ('max', float(ms.max())),
+                        ('peak_mb', peak / (1024.0 * 1024.0))])
+
+def compare(results, baseline, ratio):
+    """ Print the change against baseline, returning the names of the
+    benchmarks whose p50 or peak memory grew by more than ratio """
+    slower = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None:
+            continue
+        t = r['p50'] / max(b['p50'], 1e-6)
+        m = r['peak_mb'] / max(b['peak_mb'], 1e-6)
+        flag = ""
+        if t > ratio or m > ratio:
+            slower.append(name)
+            flag = "  REGRESSION"
+        print("{0:>28}: p50 x{1:.2f}, peak x{2:.2f}{3}".format(name, t, m, flag))
+    return slower
+
+def parser():
+    p = argparse.ArgumentParser(prog="pyimgann.bench", description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--images", type=int, default=2000)
+    p.add_argument("--corrs", type=int, default=100,
+                   help="correspondences per pair")
+    p.add_argument("--frames", type=int, default=10,
+                   help="pairs cycled through by the frame benchmarks")
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--only", nargs="*", default=None,
+                   help="benchmarks to run (default: all)")
+    p.add_argument("--no-gui", action="store_true")
+    p.add_argument("--save", default=None, help="write the results as a baseline")
+    p.add_argument("--compare", default=None, help="baseline to compare against")
+    p.add_argument("--ratio", type=float, default=1.2,
+                   help="allowed slowdown against the baseline")
+    return p
+
+def main(argv=None):
+    cfg = parser().parse_args(argv)
+    names = cfg.only or list(BENCHMARKS)
+    results = OrderedDict()
+    for name in names:
+        if cfg.no_gui and BENCHMARKS[name][1]:
+            continue
+        r = results[name] = run(name, cfg)
+        print("{0:>28}: p50 {1:8.2f}ms  p90 {2:8.2f}ms  p99 {3:8.2f}ms  "
+              "max {4:8.2f}ms  peak {5:7.1f}MB".format(name, *r.values()))
+    if cfg.save:
+        with open(cfg.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if cfg.compare:
+        with open(cfg.compare, "r") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, cfg.ratio):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,346 @@
+import os
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import cv2
+from skimage.io import imread, imsave
+
+log = logging.getLogger("pyimgann.cache")
+log.setLevel(logging.DEBUG)
+
+# root of the on-disk caches
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pyimgann")
+# default budget for decoded images held in memory
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+# number of pairs on either side of the current pair to prefetch
+DEFAULT_PREFETCH_PAIRS = 2
+DEFAULT_PREFETCH_WORKERS = 2
+# thumbnails fit in a square of this size
+THUMB_SIZE = 64
+THUMB_DIR = os.path.join(DEFAULT_CACHE_DIR, "thumbs")
+THUMB_CACHE_BYTES = 64 * 1024 * 1024
+THUMB_WORKERS = 2
+RAW_DIR = os.path.join(DEFAULT_CACHE_DIR, "raw")
+DEFAULT_RAW_CACHE_BYTES = 8 * 1024 * 1024 * 1024
+
+class ImageCache(object):
+    """ Thread-safe LRU cache of decoded images, bounded by total bytes """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, loader=imread):
+        self.max_bytes_ = max_bytes
+        self.loader_ = loader
+        self.images_ = OrderedDict()
+        self.nbytes_ = 0
+        self.lock_ = threading.Lock()
+
+    def __contains__(self, path):
+        with self.lock_:
+            return str(path) in self.images_
+
+    def __len__(self):
+        return len(self.images_)
+
+    @property
+    def nbytes(self):
+        return self.nbytes_
+
+    @property
+    def max_bytes(self):
+        return self.max_bytes_
+
+    @max_bytes.setter
+    def max_bytes(self, n):
+        with self.lock_:
+            self.max_bytes_ = n
+            self.evict_()
+
+    @property
+    def loader(self):
+        return self.loader_
+
+    @loader.setter
+    def loader(self, f):
+        self.loader_ = f
+
+    def get(self, path):
+        """ Return the cached image for path (marking it most recently
+        used), or None """
+        key = str(path)
+        with self.lock_:
+            img = self.images_.pop(key, None)
+            if img is not None:
+                self.images_[key] = img
+            return img
+
+    def put(self, path, img):
+        key = str(path)
+        with self.lock_:
+            old = self.images_.pop(key, None)
+            if old is not None:
+                self.nbytes_ -= old.nbytes
+            self.images_[key] = img
+            self.nbytes_ += img.nbytes
+            self.evict_()
+
+    def load(self, path):
+        """ Return the image for path, decoding and caching it on a miss """
+        img = self.get(path)
+        if img is None:
+            img = self.loader_(str(path))
+            self.put(path, img)
+        return img
+
+    def discard(self, path):
+        with self.lock_:
+            img = self.images_.pop(str(path), None)
+            if img is not None:
+                self.nbytes_ -= img.nbytes
+
+    def clear(self):
+        with self.lock_:
+            self.images_.clear()
+            self.nbytes_ = 0
+
+    def evict_(self):
+        # never evict the most recently used image, even if it alone
+        # exceeds the budget
+        while self.nbytes_ > self.max_bytes_ and len(self.images_) > 1:
+            key, img = self.images_.popitem(last=False)
+            self.nbytes_ -= img.nbytes
+            log.debug("evicted {0}".format(key))
+
+def file_key(path):
+    """ Return a key for the current contents of the file at path, from its
+    absolute path, size and mtime """
+    st = os.stat(str(path))
+    ident = repr((os.path.abspath(str(path)), st.st_size, st.st_mtime))
+    return hashlib.sha1(ident).hexdigest()
+
+class RawFrameCache(object):
+    """ Decoded images stored as .npy files and memory-mapped when loaded
+    again, bounded by total bytes on disk. The least recently used files
+    are evicted first; a file's mtime records its last use """
+    def __init__(self, cache_dir=RAW_DIR, max_bytes=DEFAULT_RAW_CACHE_BYTES,
+                 loader=imread):
+        self.cache_dir_ = cache_dir
+        self.max_bytes_ = max_bytes
+        self.loader_ = loader
+        self.lock_ = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.nbytes_ = sum(os.path.getsize(os.path.join(cache_dir, n))
+                           for n in os.listdir(cache_dir) if n.endswith(".npy"))
+
+    @property
+    def nbytes(self):
+        return self.nbytes_
+
+    def load(self, path):
+        """ Return the image for path, mapping the stored frame if there is
+        one and decoding and storing it otherwise """
+        fn = os.path.join(self.cache_dir_, file_key(path) + ".npy")
+        try:
+            img = np.load(fn, mmap_mode="r")
+            os.utime(fn, None)
+            return img
+        except (IOError, OSError, ValueError):
+            pass
+        img = self.loader_(str(path))
+        self.store_(fn, img)
+        return img
+
+    def store_(self, fn, img):
+        tmpname = "{0}.{1}.tmp".format(fn, threading.current_thread().ident)
+        try:
+            with open(tmpname, "wb") as f:
+                np.save(f, img)
+            os.rename(tmpname, fn)
+        except (IOError, OSError):
+            log.exception("failed to store the raw frame {0}".format(fn))
+            return
+        with self.lock_:
+            self.nbytes_ += os.path.getsize(fn)
+            if self.nbytes_ > self.max_bytes_:
+                self.evict_()
+
+    def evict_(self):
+        entries = []
+        for n in os.listdir(self.cache_dir_):
+            if n.endswith(".npy"):
+                st = os.stat(os.path.join(self.cache_dir_, n))
+                entries.append((st.st_mtime, st.st_size, n))
+        entries.sort()
+        self.nbytes_ = sum(e[1] for e in entries)
+        # evict down to 90% of the budget, so eviction does not run on
+        # every store; mapped files stay readable after they are removed
+        target = int(0.9 * self.max_bytes_)
+        for mtime, size, n in entries[:-1]:
+            if self.nbytes_ <= target:
+                break
+            os.remove(os.path.join(self.cache_dir_, n))
+            self.nbytes_ -= size
+            log.debug("evicted raw frame {0}".format(n))
+
+def neighbour_paths(pairs, index, radius):
+    """ Return the image paths of the pairs within radius of index, nearest
+    pairs first and without duplicates """
+    paths = []
+    seen = set()
+    count = len(pairs)
+    order = [index]
+    for d in range(1, radius + 1):
+        order.extend([index + d, index - d])
+    for i in order:
+        if 0 <= i < count:
+            for p in pairs[i]:
+                if p not in seen:
+                    seen.add(p)
+                    paths.append(p)
+    return paths
+
+class ImagePrefetcher(object):
+    """ Decode the images of neighbouring pairs into an ImageCache using a
+    pool of worker threads. Large images are given to pyramids, which
+    builds their pyramids instead of caching the full decodes """
+    def __init__(self, cache, radius=DEFAULT_PREFETCH_PAIRS,
+                 workers=DEFAULT_PREFETCH_WORKERS, pyramids=None):
+        self.cache_ = cache
+        self.pyramids_ = pyramids
+        self.radius_ = radius
+        self.pool_ = ThreadPool(workers)
+        self.pending_ = set()
+        self.wanted_ = set()
+        self.lock_ = threading.Lock()
+
+    def prefetch(self, pairs, index):
+        """ Queue the images around pairs[index] that are not yet cached.
+        Queued images that fall out of the window are skipped by the workers """
+        paths = neighbour_paths(pairs, index, self.radius_)
+        with self.lock_:
+            self.wanted_ = set(str(p) for p in paths)
+            todo = [p for p in paths if str(p) not in self.pending_]
+            self.pending_.update(str(p) for p in todo)
+        for p in todo:
+            if p in self.cache_:
+                self.done_(str(p))
+            else:
+                self.pool_.apply_async(self.fetch_, (p,))
+
+    def fetch_(self, path):
+        key = str(path)
+        try:
+            with self.lock_:
+                wanted = key in self.wanted_
+            if wanted:
+                if (self.pyramids_ is None or
+                    not self.pyramids_.prefetch(path, self.cache_.loader)):
+                    self.cache_.load(path)
+        except Exception:
+            log.exception("failed to prefetch {0}".format(key))
+        finally:
+            self.done_(key)
+
+    def done_(self, key):
+        with self.lock_:
+            self.pending_.discard(key)
+
+    def close(self):
+        # queued jobs become no-ops once nothing is wanted
+        with self.lock_:
+            self.wanted_ = set()
+        self.pool_.close()
+        self.pool_.join()
+
+def content_key(path, chunk=1 << 20):
+    """ Return the sha1 of the contents of the file at path """
+    h = hashlib.sha1()
+    with open(str(path), "rb") as f:
+        block = f.read(chunk)
+        while block:
+            h.update(block)
+            block = f.read(chunk)
+    return h.hexdigest()
+
+def make_thumbnail(img, size=THUMB_SIZE):
+    """ Return img downscaled to fit a size x size square, as 8-bit rgb """
+    if img.dtype != np.uint8:
+        img = (255 * (img.astype(np.float64) / max(1, img.max()))).astype(np.uint8)
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[...,0]
+    if img.ndim == 2:
+        img = np.dstack([img, img, img])
+    img = np.ascontiguousarray(img[...,:3])
+    h, w = img.shape[:2]
+    scale = float(size) / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))),
+                         interpolation=cv2.INTER_AREA)
+    return img
+
+class ThumbnailCache(object):
+    """ Thumbnails of image files, kept in memory and in a directory of
+    files named by the sha1 of the source contents. Thumbnails are made by
+    a pool of worker threads """
+    def __init__(self, cache_dir=THUMB_DIR, size=THUMB_SIZE,
+                 max_bytes=THUMB_CACHE_BYTES, workers=THUMB_WORKERS):
+        self.cache_dir_ = cache_dir
+        self.size_ = size
+        self.memory_ = ImageCache(max_bytes, loader=self.load_)
+        self.pool_ = ThreadPool(workers)
+        self.pending_ = set()
+        self.closed_ = False
+        self.lock_ = threading.Lock()
+
+    def get(self, path):
+        """ Return the thumbnail of path if it is in memory, or None """
+        return self.memory_.get(path)
+
+    def request(self, path, done):
+        """ Make the thumbnail of path in the background, then call
+        done(path) from the worker thread """
+        key = str(path)
+        with self.lock_:
+            if key in self.pending_:
+                return
+            self.pending_.add(key)
+        self.pool_.apply_async(self.fetch_, (path, done))
+
+    def fetch_(self, path, done):
+        try:
+            if not self.closed_:
+                self.memory_.load(path)
+                done(path)
+        except Exception:
+            log.exception("failed to make the thumbnail of {0}".format(str(path)))
+        finally:
+            with self.lock_:
+                self.pending_.discard(str(path))
+
+    def load_(self, path):
+        key = content_key(path)
+        fn = os.path.join(self.cache_dir_, key[:2], key + ".png")
+        if os.path.exists(fn):
+            return imread(fn)
+        thumb = make_thumbnail(imread(str(path)), self.size_)
+        try:
+            if not os.path.isdir(os.path.dirname(fn)):
+                try:
+                    os.makedirs(os.path.dirname(fn))
+                except OSError:
+                    # another worker made it first
+                    if not os.path.isdir(os.path.dirname(fn)):
+                        raise
+            tmpname = fn + ".{0}.tmp.png".format(threading.current_thread().ident)
+            imsave(tmpname, thumb)
+            os.rename(tmpname, fn)
+        except (IOError, OSError):
+            log.exception("failed to store the thumbnail of {0}".format(str(path)))
+        return thumb
+
+    def close(self):
+        # queued jobs become no-ops
+        self.closed_ = True
+        self.pool_.close()
+        self.pool_.join()
@@ -0,0 +1,169 @@
+""" Headless command line interface for batch project operations.
+
+  new      create a project from an image directory
+  convert  convert a pickled or single file project to shards
+  export   write the correspondence csv of every pair
+  stats    print project statistics
+
+Nothing here needs a display, so it runs on machines without X. Edits in
+the journal of a project, left by a running or crashed gui, are replayed
+before exporting or counting.
+"""
+import sys
+import time
+import argparse
+import logging
+import multiprocessing
+import pathlib as pl
+import numpy as np
+import pyimgann.model as mdl
+import pyimgann.journal as jrnl
+import pyimgann.projfile as pf
+import pyimgann.shards as shards
+
+log = logging.getLogger("pyimgann.cli")
+log.setLevel(logging.DEBUG)
+
+# pairs exported by one worker task
+EXPORT_CHUNK = 256
+
+def cmd_new(args):
+    proj = mdl.new_correspondence_project(args.name, pl.Path(args.images),
+                                          args.skip, args.pattern)
+    mdl.save_correspondence_project(proj, args.project)
+    print("{0}: {1} images, {2} pairs".format(args.project, len(proj['images']),
+                                              len(proj['pairs'])))
+    return 0
+
+def cmd_convert(args):
+    if pf.is_project_file(args.project):
+        if shards.is_sharded(pf.ProjectFile(args.project)):
+            print("{0} is already a sharded project".format(args.project))
+            return 0
+        # single file projects are written again as shards
+        mdl.write_project(mdl.open_project(args.project), args.output or args.project)
+    else:
+        mdl.convert_pickled_project(args.project, args.output)
+    print("converted {0}".format(args.output or args.project))
+    return 0
+
+def load_project(filename):
+    """ Return a project with its journal replayed """
+    proj = mdl.load_correspondence_project(filename)
+    jrnl.replay_journal(proj, filename)
+    return proj
+
+def export_chunk(job):
+    """ Write the correspondence files of pairs [start, stop) of a project
+    file, except the edited ones. Runs in a worker process, which maps the
+    project itself """
+    filename, outdir, start, stop, edited = job
+    f = shards.open_store(filename)
+    basedir = pl.Path(outdir)
+    for i in xrange(start, stop):
+        if i in edited:
+            continue
+        a, b = f.pairs[i]
+        left = pl.Path(f.paths[a])
+        right = pl.Path(f.paths[b])
+        mdl.write_correspondence_file(mdl.corr_filename(basedir, left, right),
+                                      f.corrs(i))
+    return stop - start
+
+def cmd_export(args):
+    if not pf.is_project_file(args.project):
+        sys.stderr.write("{0} is pickled, run convert first\n".format(args.project))
+        return 1
+    outdir = pl.Path(args.output)
+    if not outdir.exists():
+        outdir.mkdir(parents=True)
+    count = len(shards.open_store(args.project).pairs)
+    # pairs with journaled edits are exported from the replayed project
+    edited = set(r[1] for r in jrnl.read_journal(args.project))
+    jobs = [(args.project, str(outdir), i, min(i + EXPORT_CHUNK, count),
+             edited & set(xrange(i, min(i + EXPORT_CHUNK, count))))
+            for i in xrange(0, count, EXPORT_CHUNK)]
+    start = time.time()
+    if edited:
+        proj = load_project(args.project)
+        for i in sorted(edited):
+            if i < count:
+                left, right = proj['pairs'][i]
+                mdl.write_correspondence_file(
+                    mdl.corr_filename(outdir, left, right),
+                    mdl.corr_rows(proj['correspondences'], (left, right)))
+    pool = multiprocessing.Pool(args.workers or multiprocessing.cpu_count())
+    done = 0
+    try:
+        for n in pool.imap_unordered(export_chunk, jobs):
+            done += n
+            sys.stderr.write("\rexported {0}/{1} pairs".format(done, count))
+    finally:
+        pool.close()
+        pool.join()
+    sys.stderr.write("\n")
+    print("exported {0} pairs to {1} in {2:.2f}s".format(count, outdir,
+                                                         time.time() - start))
+    return 0
+
+def project_stats(proj):
+    """ Return a list of (name, value) statistics of a project """
+    counts = mdl.correspondence_counts(proj)
+    annotated = counts[counts > 0]
+    stats = [('images', len(proj['images'])),
+             ('pairs', len(proj['pairs'])),
+             ('annotated pairs', len(annotated)),
+             ('correspondences', int(counts.sum()))]
+    if len(annotated):
+        stats.extend([('mean per annotated pair', float(annotated.mean())),
+                      ('median per annotated pair', float(np.median(annotated))),
+                      ('max per pair', int(annotated.max()))])
+    return stats
+
+def cmd_stats(args):
+    proj = load_project(args.project)
+    for name, value in project_stats(proj):
+        if isinstance(value, float):
+            print("{0:>26}: {1:.2f}".format(name, value))
+        else:
+            print("{0:>26}: {1}".format(name, value))
+    return 0
+
+def parser():
+    p = argparse.ArgumentParser(prog="pyimgann",
+                                description="Batch operations on pyimgann projects")
+    sub = p.add_subparsers()
+
+    new = sub.add_parser("new", help="create a project from an image directory")
+    new.add_argument("project")
+    new.add_argument("images")
+    new.add_argument("--name", default="new project")
+    new.add_argument("--skip", type=int, default=5)
+    new.add_argument("--pattern", default="*.png")
+    new.set_defaults(func=cmd_new)
+
+    convert = sub.add_parser("convert", help="convert a pickled or single file project")
+    convert.add_argument("project")
+    convert.add_argument("-o", "--output", default=None,
+                         help="write here instead of replacing the project")
+    convert.set_defaults(func=cmd_convert)
+
+    export = sub.add_parser("export", help="write the correspondence csv of every pair")
+    export.add_argument("project")
+    export.add_argument("-o", "--output", default=".")
+    export.add_argument("-j", "--workers", type=int, default=0,
+                        help="worker processes (default: one per core)")
+    export.set_defaults(func=cmd_export)
+
+    stats = sub.add_parser("stats", help="print project statistics")
+    stats.add_argument("project")
+    stats.set_defaults(func=cmd_stats)
+    return p
+
+def main(argv=None):
+    logging.basicConfig()
+    args = parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,46 +1,85 @@
 import os
 import pyimgann.ui as ui
 import logging
-import traceback as tb
 from functools import partial
+from collections import OrderedDict
 import pathlib as pl
 import cPickle as pkl
-from skimage.io import imread
 from PyQt4.QtCore import pyqtSignal, QObject, QRect, Qt
 from PyQt4.QtGui import QAction, QStandardItemModel, QStandardItem, QDialog, \
-     QItemSelectionModel, QUndoCommand, QUndoStack, QFileDialog, QHeaderView
+     QItemSelectionModel, QKeySequence, QFileDialog, QHeaderView, QActionGroup
 
 import numpy as np
 from transitions import Machine
 import pyimgann.model as mdl
+import pyimgann.cache as cache
+import pyimgann.journal as jrnl
+import pyimgann.projfile as pf
+import pyimgann.dirindex as dirindex
+import pyimgann.pyramid as pyr
+import pyimgann.proposals as prop
+import pyimgann.propagation as flow
+import pyimgann.segmentation as seg
+import pyimgann.enhance as enh
+import pyimgann.trace as trace
+import pyimgann.history as hist
 
 log = logging.getLogger("pyimgann.controller")
 log.setLevel(logging.DEBUG)
 
+# clicks within this many pixels of a keypoint snap to it
+SNAP_RADIUS = 6
+CANDIDATE_COLOR = (255,255,0)
+PROPAGATED_COLOR = (255,128,0)
+
 class AnnotationController(QObject):
     def __init__(self, ui):
         super(AnnotationController,self).__init__()
         self.ui_ = ui
 
+def cache_path(cache_dir, default):
+    """ Return the default cache directory, moved under cache_dir if one
+    is given """
+    if cache_dir is None:
+        return default
+    return os.path.join(cache_dir, os.path.basename(default))
+
 def to_model(items, model, formatter):
     for i in items:
         model.appendRow(formatter(i))
 
+def load_image(path, ctl):
+    """ Return the image at path, or its pyramid if it is too large to
+    show as one pixmap """
+    # prefetched images need no file access
+    img = ctl.image_cache.get(path)
+    if img is not None:
+        return img
+    pyramid = ctl.pyramids.get(path)
+    if pyramid is not None:
+        return pyramid
+    if pyr.is_large_file(path):
+        # decoded outside the image cache, which would keep it pinned
+        return ctl.pyramids.build(path, ctl.image_cache.loader(str(path)))
+    img = ctl.image_cache.load(path)
+    if pyr.is_large(img):
+        ctl.image_cache.discard(path)
+        return ctl.pyramids.build(path, img)
+    return img
+
+def display_luts(img_pair, imgs, ctl):
+    """ Return the display lookup tables of a pair of images """
+    adj = ctl.enhance.adjustment
+    return [ctl.stats.lut(p, img, adj) for p, img in zip(img_pair, imgs)]
+
+@trace.traced("show_images")
 def show_images(img_pair, ctl):
-    imga = imread(str(img_pair[0]))
-    imgb = imread(str(img_pair[1]))
+    imga = load_image(img_pair[0], ctl)
+    imgb = load_image(img_pair[1], ctl)
+    # set before the images, so each pixmap is built once
+    ctl.dual_img.set_luts(display_luts(img_pair, (imga, imgb), ctl), redraw=False)
     ctl.dual_img.set_images((imga,imgb))
 
-def corr_formatter(corr):
-    left = QStandardItem("{0}".format(corr[0,:]))
-    right = QStandardItem("{0}".format(corr[1,:]))
-    return [left,right]
-
-def img_pair_formatter(proj, ipair):
-    left = ipair[0].stem
-    right = ipair[1].stem
-    return QStandardItem("{0}, {1}".format(left,right))
-
 def draw_annotation(view, pts=np.array([]), color=(255,0,0), desc=""):
     ann = ui.Annotation(pts=np.array([pts[0],
                                       pts[1]+view.image_b_offset]), 
@@ -61,116 +100,249 @@ def show_keypoints(apts, bpts, ctl):
     for b in bpts:
         draw_keypoint(ctl.dual_img, b + ctl.dual_img.image_b_offset)
 
-def add_correspondence(proj, ctl, c):
-    model = ctl.corr_model
-    view = ctl.dual_img
-    ann = ui.Annotation(pts=[c[0],c[1]+view.image_b_offset],
-                        color=(255,0,0), desc="")
-    # list
-    item = corr_formatter(c)
-    model.appendRow(item)
-    # image
-    ann.index = view.add_annotation(ann)
-    ctl.correspondences[ann] = (c, item)
-
-    # manage model
-    idx, corrs = mdl.get_correspondences(proj)
-    corrs.add(c)
-    
-    return ann
-
-def remove_correspondence(proj, ctl, ann):
-    model = ctl.corr_model
-    view = ctl.dual_img    
-    c, listitem = ctl.correspondences[ann]
-    # list
-    mdlidx = model.indexFromItem(listitem[0])
-    model.removeRows(mdlidx.row(), 1)
-    # image
-    view.remove_annotation(ann.index)
+def correspondence_annotation(view, c):
+    return ui.Annotation(pts=[c[0],c[1]+view.image_b_offset],
+                         color=(255,0,0), desc="")
 
-    # manage model
-    idx, corrs = mdl.get_correspondences(proj)
-    corrs.discard(c)
+def keypoint_annotation(view, kp, which_img):
+    return ui.Annotation(pts=[view.image_to_view(which_img,np.array(kp))],
+                         color=(255,0,0,128), desc="")
 
-    del ctl.correspondences[ann]
-
-def add_keypoint(proj, ctl, kp, which_img):
+def add_rows(proj, ctl, rows):
+    """ Add the (N,4) correspondence rows to the current pair, with their
+    keypoints, in a single scene update. Returns the rows that were added """
     view = ctl.dual_img
-    ann = ui.Annotation(pts=[view.image_to_view(which_img,np.array(kp))], color=(255,0,0,128), desc="")
-    ann.index = view.add_annotation(ann)
-    ctl.keypoints[ann] = (which_img,kp)
-
-    # manage the model
+    keys = OrderedDict.fromkeys(r for r in map(tuple, hist.as_rows(rows).tolist())
+                                if r not in ctl.corr_ids)
+    new = hist.as_rows(list(keys))
+    if len(new) == 0:
+        return new
     akps, bkps = mdl.get_kps(proj)
-    if which_img == ui.DualImageView.IMAGE_A:
-        akps.add(kp)
-    else:
-        bkps.add(kp)
-
-    return ann
-
-def remove_keypoint(proj, ctl, ann):
+    akps.add_points(new[:,0:2])
+    bkps.add_points(new[:,2:4])
+    kps = []
+    for which, pts in ((ui.DualImageView.IMAGE_A, new[:,0:2]),
+                       (ui.DualImageView.IMAGE_B, new[:,2:4])):
+        for kp in OrderedDict.fromkeys(map(tuple, pts.tolist())):
+            if keypoint_at(ctl, which, kp) is None:
+                kps.append((which, kp))
+    kp_anns = [keypoint_annotation(view, kp, which) for which, kp in kps]
+    corrs = [mdl.Correspondence(r[0:2], r[2:4]) for r in new]
+    corr_anns = [correspondence_annotation(view, c) for c in corrs]
+    ids = view.add_annotations(kp_anns + corr_anns)
+    for ann, idx, (which, kp) in zip(kp_anns, ids, kps):
+        ann.index = idx
+        ctl.keypoints[idx] = (which, kp)
+        ctl.kp_index[which].add(kp, idx)
+    # manage model, through the list model showing the pair
+    cids = ctl.corr_model.add_rows(new)
+    for ann, idx, c, key, cid in zip(corr_anns, ids[len(kp_anns):], corrs, keys, cids):
+        ann.index = idx
+        ann.cid = cid
+        ann.akpt = keypoint_at(ctl, ui.DualImageView.IMAGE_A, c[0])
+        ann.bkpt = keypoint_at(ctl, ui.DualImageView.IMAGE_B, c[1])
+        ctl.correspondences[idx] = c
+        ctl.corr_ids[key] = idx
+    return new
+
+def remove_rows(proj, ctl, rows):
+    """ Remove the (N,4) correspondence rows of the current pair in a single
+    scene update, with the keypoints no remaining correspondence uses.
+    Returns the rows that were removed """
     view = ctl.dual_img
-    which, kp = ctl.keypoints[ann]
-    view.remove_annotation(ann.index)
-
-    # manage the model
-    akps, bkps = mdl.get_kps(proj)
-    if which_img == ui.DualImageView.IMAGE_A:
-        akps.discard(kp)
-    else:
-        bkps.discard(kp)
-
-    del ctl.keypoints[ann]
-
+    keys = [r for r in OrderedDict.fromkeys(map(tuple, hist.as_rows(rows).tolist()))
+            if r in ctl.corr_ids]
+    if not keys:
+        return hist.as_rows(None)
+    removed = hist.as_rows(keys)
+    # manage model, through the list model showing the pair
+    ctl.corr_model.remove_rows(removed,
+                               [view.annotation(ctl.corr_ids[k]).cid for k in keys])
+    pair_index = proj.get('index', 0)
+    unused = {}
+    for side, (which, kps) in enumerate(zip((ui.DualImageView.IMAGE_A,
+                                             ui.DualImageView.IMAGE_B),
+                                            mdl.get_kps(proj))):
+        # keypoints may be shared by several correspondences, also of the
+        # neighbouring pair showing the same image
+        pts = mdl.corr_ends(removed)[side]
+        kept = mdl.image_ends(proj, pair_index, side)
+        pts = pts[~np.in1d(mdl.point_keys(pts), mdl.point_keys(kept))]
+        kps.remove_points(pts)
+        unused[which] = set(map(tuple, pts.tolist()))
+    ids = []
+    for key in keys:
+        idx = ctl.corr_ids.pop(key)
+        del ctl.correspondences[idx]
+        ids.append(idx)
+        ann = view.annotation(idx)
+        for kpt in (ann.akpt, ann.bkpt):
+            if kpt is None or kpt.index not in ctl.keypoints:
+                continue
+            which, kp = ctl.keypoints[kpt.index]
+            if tuple(np.asarray(kp).tolist()) in unused[which]:
+                del ctl.keypoints[kpt.index]
+                ctl.kp_index[which].remove(kp, kpt.index)
+                ids.append(kpt.index)
+    view.remove_annotations(ids)
+    return removed
+
+@trace.traced("load_keypoints")
 def load_keypoints(proj, ctl, akps, bkps):
-    for a in akps:
-        add_keypoint(proj, ctl, a, ui.DualImageView.IMAGE_A)
-    for b in bkps:
-        add_keypoint(proj, ctl, b, ui.DualImageView.IMAGE_B)
-
+    """ Show the keypoints of a frame in one batch. The keypoints are
+    already in the model """
+    view = ctl.dual_img
+    kps = [(ui.DualImageView.IMAGE_A, kp) for kp in akps] + \
+          [(ui.DualImageView.IMAGE_B, kp) for kp in bkps]
+    anns = [keypoint_annotation(view, kp, which) for which, kp in kps]
+    ids = view.add_annotations(anns)
+    for ann, idx, (which, kp) in zip(anns, ids, kps):
+        ann.index = idx
+        ctl.keypoints[idx] = (which, kp)
+        ctl.kp_index[which].add(kp, idx)
+
+def keypoint_at(ctl, which, pt):
+    hit = ctl.kp_index[which].nearest(pt, 0)
+    if hit is None:
+        return None
+    return ctl.dual_img.annotation(next(iter(hit[1])))
+
+@trace.traced("load_annotations")
 def load_annotations(proj, corrs, ctl):
-    log.debug("load_annotations")
-    for c in corrs:
-        add_correspondence(proj, ctl, c)
+    """ Show the correspondences of a frame in one batch. The keypoints must
+    be loaded first, so each correspondence can be linked to them """
+    view = ctl.dual_img
+    ctl.corr_model.set_correspondences(corrs)
+    items = list(corrs)
+    anns = [correspondence_annotation(view, c) for c in items]
+    ids = view.add_annotations(anns)
+    for ann, idx, c, cid in zip(anns, ids, items, corrs.ids().tolist()):
+        ann.index = idx
+        ann.cid = cid
+        ann.akpt = keypoint_at(ctl, ui.DualImageView.IMAGE_A, c[0])
+        ann.bkpt = keypoint_at(ctl, ui.DualImageView.IMAGE_B, c[1])
+        ctl.correspondences[idx] = c
+        ctl.corr_ids[tuple(mdl.corr_row(c).tolist())] = idx
     ctl.corr_view.horizontalHeader().setResizeMode(QHeaderView.Stretch)
-    # view = ui.dual_img
-    # for c in corrs:
-    #     ann = ui.Annotation(view, pts=[c[0],c[1]+view.image_b_offset],
-    #                         color=(255,0,0), desc="")
-    #     annotations.append((c,ann))
-
-    # to_model(corrs, ui.corr_model, corr_formatter)
-    # w = ui.corr_view.width()
-    # # cnt = ui.corr_view.horizontalHeader().count()
-    # # for i in range(cnt):
-    # #     ui.corr_view.setColumnWidth(i, w/2)
-    # for c in corrs:
-    #     draw_annotation(ui.dual_img, pts=c)
 
+@trace.traced("show_candidates")
+def show_candidates(proj, ctl, idx, rows, color=CANDIDATE_COLOR, desc="proposal"):
+    """ Show the proposed correspondences rows of pair idx that are not
+    correspondences or candidates yet and were not rejected """
+    view = ctl.dual_img
+    _, corrs = mdl.get_correspondences(proj, idx)
+    known = set(map(tuple, corrs.rows().tolist()))
+    known.update(ctl.rejected.get(idx, ()))
+    known.update(ctl.candidates.itervalues())
+    rows = [r for r in rows.tolist() if tuple(r) not in known]
+    anns = [ui.Annotation(pts=[r[0:2], np.array(r[2:4]) + view.image_b_offset],
+                          color=color, desc=desc)
+            for r in rows]
+    ids = view.add_annotations(anns)
+    for ann, cid, r in zip(anns, ids, rows):
+        ann.index = cid
+        ctl.candidates[cid] = tuple(r)
+
+def propagation_source(proj, idx):
+    """ Return the image of pair idx - 1 shared with pair idx, the other
+    image of pair idx, the side of pair idx the shared image is on, and the
+    correspondence ends on the shared image; or None """
+    pairs = proj['pairs']
+    if not 0 < idx < len(pairs):
+        return None
+    prev, pair = pairs[idx - 1], pairs[idx]
+    sides = flow.shared_image(prev, pair)
+    if sides is None:
+        return None
+    s, t = sides
+    _, corrs = mdl.get_correspondences(proj, idx - 1)
+    if len(corrs) == 0:
+        return None
+    pts = corrs.rows()[:,2*s:2*s+2].copy()
+    return prev[s], pair[1 - t], t, pts
+
+def propagated_rows(proj, ctl, idx):
+    """ Return the correspondences of pair idx - 1 carried into pair idx by
+    the cached tracks, requesting the tracks that are missing """
+    src = propagation_source(proj, idx)
+    if src is None:
+        return None
+    shared, other, t, pts = src
+    if not ctl.propagator.tracked(shared, other, pts):
+        ctl.propagator.request(idx, shared, other, pts, ctl.propagated.emit)
+    dst, ok = ctl.propagator.get(shared, other, pts)
+    if not ok.any():
+        return None
+    tracked = np.round(dst[ok]).astype(np.int32)
+    if t == 0:
+        return np.hstack([pts[ok], tracked])
+    return np.hstack([tracked, pts[ok]])
+
+def request_propagation(proj, ctl, idx):
+    """ Track the correspondences of pair idx into pair idx + 1 in the
+    background """
+    src = propagation_source(proj, idx + 1)
+    if src is not None:
+        shared, other, t, pts = src
+        ctl.propagator.request(idx + 1, shared, other, pts, ctl.propagated.emit)
+
+def show_segment(ctl, which, path):
+    """ Overlay the segments of image which, or queue their computation """
+    view = ctl.dual_img
+    if view.is_tiled(which):
+        # pyramid images are too large to segment or overlay whole
+        view.set_overlay(which, None)
+        return
+    labels = ctl.segments.get(path, ctl.segment_method)
+    if labels is None:
+        view.set_overlay(which, None)
+        ctl.segments.request(path, ctl.segment_method, ctl.segments_ready.emit)
+        return
+    with trace.span("segment_overlay"):
+        view.set_overlay(which, seg.label_overlay(labels, ctl.segment_mode))
+
+def show_segments(proj, ctl, idx):
+    img_pair = proj['pairs'][idx]
+    for which, path in enumerate(img_pair):
+        show_segment(ctl, which, path)
+    ctl.segments.prefetch(proj['pairs'], idx, ctl.segment_method)
+
+@trace.traced("load_frame")
 def load_frame(proj, ctl, idx):
-    tb.print_stack()
-    log.debug("load frame {0}".format(idx))
-    ctl.clear()
+    log.debug("load frame %d", idx)
+    with trace.span("clear"):
+        ctl.clear()
     # update the index    
     count = len(proj['pairs'])
     img_pair = proj['pairs'][idx]
     # load the image and keypoints
     show_images(img_pair, ctl)
+    ctl.prefetcher.prefetch(proj['pairs'], idx)
     akps, bkps = mdl.get_kps(proj, idx)
     #show_keypoints(akps, bkps, ui)
     load_keypoints(proj, ctl, akps, bkps)
     # update the pair correspondences
     _, corrs = mdl.get_correspondences(proj, idx)
     load_annotations(proj, corrs, ctl)
+    rows = ctl.proposals.get(img_pair)
+    if rows is not None:
+        show_candidates(proj, ctl, idx, rows)
+    if ctl.segment_method is not None:
+        show_segments(proj, ctl, idx)
+    if ctl.propagate:
+        rows = propagated_rows(proj, ctl, idx)
+        if rows is not None:
+            show_candidates(proj, ctl, idx, rows, PROPAGATED_COLOR, "propagated")
+        # prepare the next pair while this one is annotated
+        request_propagation(proj, ctl, idx)
     ctl.status_field.setText("Loaded frame {0}".format(idx))
 
 def load_project(proj, ctl):
     ctl.clear(clear_pairs=True)
+    ctl.image_cache.clear()
     ctl.status_field.setText("Loading project: " + proj['name'])
     # load the list data
-    to_model(proj['pairs'], ctl.pair_model, partial(img_pair_formatter, proj))
+    ctl.pair_model.set_pairs(proj['pairs'])
     # to_model(proj['correspondences'], ui.corr_model)
     # load the current image pair
     pair_index = proj.get('index',0)
@@ -179,74 +351,24 @@ def load_project(proj, ctl):
     ctl.select_pair(pair_index)
     ctl.status_field.setText("{0} project ready".format(proj['name']))
 
-class AddCorrespondenceCmd(QUndoCommand):
-    def __init__(self, proj, ctl, pta, ptb, desc="", color=""):
-        super(AddCorrespondenceCmd,self).__init__()
-        self.proj = proj
-        self.ctl = ctl
-        self.pts = mdl.Correspondence(pta,ptb)
-        self.desc = desc
-        self.color = color
-        self.setText("add correspondence")
-        
-    def redo(self):
-        log.debug("Add correspondence")
-        self.ann = add_correspondence(self.proj, self.ctl, self.pts)
-        self.akpt = add_keypoint(self.proj, self.ctl, tuple(self.pts[0]), ui.DualImageView.IMAGE_A)
-        self.bkpt = add_keypoint(self.proj, self.ctl, tuple(self.pts[1]), ui.DualImageView.IMAGE_B)
-        self.ann.akpt = self.akpt
-        self.ann.bkpt = self.bkpt
-        #pair_index, corr_set = mdl.get_correspondences(self.proj)
-        #akps, bkps = mdl.get_kps(self.proj, pair_index)
-        #self.corr_index = len(corr_set)
-        #corr_set.append(self.pts)
-        #akps.add(tuple(self.pts[0]))
-        #bkps.add(tuple(self.pts[1]))
-        #self.ann = ui.Annotation(pts=np.array([self.pts[0],
-        #                                  self.pts[1] + self.view.image_b_offset]))
-        #self.ann.index = self.view.add_annotation(self.ann)
-        
-    def undo(self):
-        log.debug("Undo/delete correspondence")
-        remove_correspondence(self.proj, self.ctl, self.ann)
-        remove_keypoint(self.proj, self.ctl, self.akpt)
-        remove_keypoint(self.proj, self.ctl, self.bkpt)
-        # pair_index, corr_set = mdl.get_correspondences(self.proj)
-        # akps, bkps = mdl.get_kps(self.proj, pair_index)
-        # apt,bpt = corr_set[self.corr_index]
-        # del corr_set[self.corr_index]
-        # akps.discard(tuple(apt))
-        # bkps.discard(tuple(bpt))
-        # self.view.remove_annotation(self.ann.index)
-
-class DeleteCorrespondenceCmd(QUndoCommand):
-    def __init__(self, proj, ctl, ann):
-        super(DeleteCorrespondenceCmd,self).__init__()
-        self.proj = proj
-        self.ctl = ctl
-        self.ann = ann
-        self.pts = self.ann.pts_
-        
-    def redo(self):
-        log.debug("Delete correspondence")
-        remove_correspondence(self.proj, self.ctl, self.ann)
-        remove_keypoint(self.proj, self.ctl, self.ann.akpt)
-        remove_keypoint(self.proj, self.ctl, self.ann.bkpt)
-
-    def undo(self):
-        log.debug("Undo/add correspondence")
-        self.ann = add_correspondence(self.proj, self.ctl, self.pts)
-        self.ann.akpt = add_keypoint(self.proj, self.ctl, tuple(pts[0]), ui.DualImageView.IMAGE_A)
-        self.ann.bkpt = add_keypoint(self.proj, self.ctl, tuple(pts[1]), ui.DualImageView.IMAGE_B)
-
 class CorrespondenceController(AnnotationController):
     project_changed = pyqtSignal()
+    # done, total, pair index; emitted from the proposal thread
+    proposals_progress = pyqtSignal(int, int, int)
+    # pair index; emitted from the proposal pool
+    proposed = pyqtSignal(int)
+    # pair index; emitted from the propagation thread
+    propagated = pyqtSignal(int)
+    # image path; emitted from the segmentation pool
+    segments_ready = pyqtSignal(str)
         
     states = ['no_project', 'new_project', 'open_project', 'clean_project', \
               'dirty_project', 'point_a', 'point_b', 'exiting']
 
-    def __init__(self, ui):
-        super(CorrespondenceController,self).__init__(ui)
+    def __init__(self, mw, cache_dir=None):
+        super(CorrespondenceController,self).__init__(mw)
+        # root of the disk caches, by default each cache's own directory
+        self.cache_dir = cache_dir
 
         self.machine = Machine(model=self, states=CorrespondenceController.states,
                                initial='no_project')
@@ -306,31 +428,78 @@ class CorrespondenceController(AnnotationController):
         self.project_changed.connect(self.on_project_changed)
         self.current_project = None
         self.current_filename = None
-        self.dual_img = ui.select('dual_img')
+        self.journal = None
+        # pairs ingested since the project file was written
+        self.extended = False
+        self.watcher = None
+        self.dual_img = mw.select('dual_img')
         self.dual_img.image_a_click.connect(self.image_a_clicked)
         self.dual_img.image_b_click.connect(self.image_b_clicked)
-        self.corr_view = ui.select('corr_list')
-        self.corr_model = QStandardItemModel(self.corr_view)
+        self.corr_view = mw.select('corr_list')
+        self.corr_model = ui.CorrespondenceTableModel(self.corr_view)
         self.corr_view.setModel(self.corr_model)
-        self.pair_view = ui.select('pair_list')
-        self.pair_model = QStandardItemModel(self.pair_view)
+        self.pair_view = mw.select('pair_list')
+        self.thumbnails = cache.ThumbnailCache(cache_path(cache_dir, cache.THUMB_DIR))
+        self.pair_model = ui.PairListModel(self.pair_view, self.thumbnails)
         self.pair_view.setModel(self.pair_model)
-        self.status_field = ui.select('status_msg')
-        ui.select('next_button').clicked.connect(self.on_next_pair)
-        ui.select('prev_button').clicked.connect(self.on_prev_pair)
+        self.status_field = mw.select('status_msg')
+        self.timing_field = mw.select('timing_msg')
+        mw.select('next_button').clicked.connect(self.on_next_pair)
+        mw.select('prev_button').clicked.connect(self.on_prev_pair)
 
         self.pair_view.selectionModel().selectionChanged.connect(self.pair_selected)
         self.dual_img.annotation_selected.connect(self.annotation_selected)
         self.dual_img.no_selection.connect(self.clear_selection)
         self.dual_img.key_event.connect(self.on_key)
+        self.dual_img.region_selected.connect(self.select_region)
+        self.dual_img.region_moved.connect(self.move_region)
 
         self.a_point = None
         self.b_point = None
         self.selection = None
         self.keypoints = {}
         self.correspondences = {}
-
-        self.undo_stack = QUndoStack()
+        # correspondence row -> annotation id
+        self.corr_ids = {}
+        # the selected region, its correspondence rows and which ends of
+        # them lie inside it
+        self.region = None
+        self.region_rows = None
+        self.region_ends = None
+        # spatial index of the keypoints shown in each image
+        self.kp_index = [mdl.PointGrid(), mdl.PointGrid()]
+
+        # undo histories of every pair, kept across frame switches
+        self.history = hist.UndoHistory()
+
+        self.image_cache = cache.ImageCache(cache.DEFAULT_CACHE_BYTES)
+        self.pyramids = pyr.PyramidCache(cache_path(cache_dir, pyr.PYRAMID_DIR))
+        self.prefetcher = cache.ImagePrefetcher(self.image_cache,
+                                                cache.DEFAULT_PREFETCH_PAIRS,
+                                                pyramids=self.pyramids)
+        # opt-in disk cache of decoded frames
+        self.raw_frames = None
+        self.proposals = prop.ProposalEngine(cache_path(cache_dir, prop.PROPOSAL_DIR))
+        # proposal annotation id -> row, and rejected rows per pair
+        self.candidates = {}
+        self.rejected = {}
+        self.proposals_progress.connect(self.on_proposals_progress)
+        self.proposed.connect(self.on_proposed)
+        self.propagator = flow.PropagationEngine(cache_path(cache_dir, flow.FLOW_DIR))
+        self.propagate = True
+        self.propagated.connect(self.on_propagated)
+        self.segments = seg.SegmentationEngine(cache_path(cache_dir, seg.SEGMENT_DIR))
+        # no overlay while the method is None
+        self.segment_method = None
+        self.segment_mode = seg.BOUNDARIES
+        self.segments_ready.connect(self.on_segments_ready)
+        # display enhancement, from cached histograms
+        self.stats = enh.ImageStats()
+        self.enhance = mw.select('enhance')
+        self.enhance.changed.connect(self.on_enhance_changed)
+        self.overlay_opacity = mw.select('overlay_opacity')
+        self.overlay_opacity.valueChanged.connect(
+            lambda v: self.dual_img.set_overlay_opacity(v / 100.0))
 
         self.file_menu = self.ui_.select('file')
         self.edit_menu = self.ui_.select('edit')
@@ -338,14 +507,22 @@ class CorrespondenceController(AnnotationController):
         self.create_actions()
 
     def clear(self, clear_pairs=False):
-        self.undo_stack.clear()
         self.a_point = None
         self.b_point = None
         self.selection = None
+        self.keypoints.clear()
+        self.correspondences.clear()
+        self.corr_ids.clear()
+        self.clear_region()
+        self.candidates.clear()
+        for grid in self.kp_index:
+            grid.clear()
         self.dual_img.clear_annotations()
-        self.corr_model.clear()
+        self.corr_model.set_correspondences(None)
         if clear_pairs:
-            self.pair_model.clear()
+            self.pair_model.set_pairs(None)
+            self.rejected.clear()
+            self.history.clear()
 
     def check_save(self, checked):
         if self.state == 'dirty_project' or self.state == 'new_project':
@@ -356,12 +533,71 @@ class CorrespondenceController(AnnotationController):
         return self.check_save(checked)
 
     def add_correspondence(self):
-        self.undo_stack.push(AddCorrespondenceCmd(self.current_project, self,
-                                                  self.a_point, self.b_point))
+        self.edit("add correspondence",
+                  added=np.concatenate([self.a_point, self.b_point]))
         return True
 
+    def edit(self, text, removed=None, added=None):
+        """ Remove and add correspondence rows of the current pair as one
+        undoable edit """
+        e = hist.Edit(text, removed, added)
+        e = self.apply_edit_(e)
+        if len(e):
+            self.history.push(self.current_project['index'], e)
+            self.propagate_next_()
+        self.update_undo_actions()
+        return e
+
+    def propagate_next_(self):
+        if self.propagate:
+            request_propagation(self.current_project, self,
+                                self.current_project['index'])
+
+    def apply_edit_(self, e):
+        """ Apply an edit to the current pair, returning the edit of the
+        rows that actually changed """
+        proj = self.current_project
+        idx = proj['index']
+        removed = remove_rows(proj, self, e.removed)
+        added = add_rows(proj, self, e.added)
+        if len(removed) or len(added):
+            mdl.mark_edited(proj, idx)
+        if self.journal is not None:
+            self.journal.append_edit(idx, removed, added)
+        return hist.Edit(e.text, removed, added)
+
+    def do_undo(self, checked):
+        if self.current_project is None:
+            return
+        e = self.history.undo(self.current_project['index'])
+        if e is not None:
+            self.apply_edit_(e.inverse())
+            self.propagate_next_()
+            self.update_undo_actions()
+            self.to_dirty_project()
+
+    def do_redo(self, checked):
+        if self.current_project is None:
+            return
+        e = self.history.redo(self.current_project['index'])
+        if e is not None:
+            self.apply_edit_(e)
+            self.propagate_next_()
+            self.update_undo_actions()
+            self.to_dirty_project()
+
+    def update_undo_actions(self):
+        idx = None if self.current_project is None else self.current_project['index']
+        undo = self.history.undo_text(idx)
+        redo = self.history.redo_text(idx)
+        self.do_undo_.setEnabled(undo is not None)
+        self.do_undo_.setText("&Undo " + undo if undo else "&Undo")
+        self.do_redo_.setEnabled(redo is not None)
+        self.do_redo_.setText("&Redo " + redo if redo else "&Redo")
+
     def clear_selection(self):
-        self.selection[1].deselect()
+        if self.selection:
+            self.selection[1].deselect()
         self.selection = None
 
     def annotation_selected(self, idx):
@@ -388,6 +624,9 @@ class CorrespondenceController(AnnotationController):
             pair_idx = item_selections.indexes()[0].row()
             self.current_project['index'] = pair_idx
             load_frame(self.current_project, self, pair_idx)
+            mdl.evict_far_groups(self.current_project, pair_idx)
+            self.update_undo_actions()
+            self.show_timing("load_frame")
 
     def select_pair(self, idx):
         # set the selection and trigger the load
@@ -397,22 +636,47 @@ class CorrespondenceController(AnnotationController):
 
     def cancel(self):
         self.clear_selection()
+        self.clear_region()
         self.a_point = None
         self.b_point = None
         self.to_clean_project()        
 
     def delete(self, ann):
-        if ann.is_line:
-            self.undo_stack.push(DeleteCorrespondenceCmd(self.current_project, self, ann))
+        if ann.index in self.candidates:
+            self.reject_candidate(ann)
+        elif ann.is_line:
+            self.selection = None
+            self.edit("delete correspondence",
+                      removed=mdl.corr_row(self.correspondences[ann.index]))
+
+    def remove_candidate(self, ann):
+        self.selection = None
+        self.dual_img.remove_annotation(ann.index)
+        return self.candidates.pop(ann.index)
+
+    def accept_candidate(self, ann):
+        """ Turn a proposal into a correspondence through the undo stack """
+        r = self.remove_candidate(ann)
+        self.edit("accept proposal", added=r)
+        self.to_dirty_project()
+
+    def reject_candidate(self, ann):
+        r = self.remove_candidate(ann)
+        self.rejected.setdefault(self.current_project['index'], set()).add(r)
 
     def on_key(self, key):
         if key == Qt.Key_Escape:
             self.cancel()
         elif key == Qt.Key_Delete:
-            if self.selection:
+            if self.region is not None:
+                self.delete_region()
+            elif self.selection:
                 ann = self.selection[1]
                 # remove annotation view
                 self.delete(ann)
+        elif key in (Qt.Key_Return, Qt.Key_Enter):
+            if self.selection and self.selection[1].index in self.candidates:
+                self.accept_candidate(self.selection[1])
                 
 
     def on_next_pair(self):
@@ -431,14 +695,90 @@ class CorrespondenceController(AnnotationController):
         #load_frame(self.current_project, self, idx)
         self.select_pair(idx)
 
+    def snap(self, which, x, y):
+        """ Return the keypoint of image which nearest to (x,y) within
+        SNAP_RADIUS, or (x,y) itself """
+        hit = self.kp_index[which].nearest((x,y), SNAP_RADIUS)
+        if hit is None:
+            return np.array([x,y])
+        return np.array(hit[0])
+
+    def select_region(self, poly):
+        """ Select the correspondences of the current pair with an end
+        inside poly, an (N,2) polygon in view coordinates """
+        self.clear_region()
+        if self.current_project is None:
+            return
+        view = self.dual_img
+        offset = view.image_b_offset
+        _, corrs = mdl.get_correspondences(self.current_project)
+        rows = corrs.rows()
+        ina = mdl.points_in_polygon(rows[:,0:2], poly)
+        inb = mdl.points_in_polygon(rows[:,2:4] + offset, poly)
+        hit = ina | inb
+        self.region = np.asarray(poly)
+        self.region_rows = rows[hit].copy()
+        self.region_ends = np.column_stack([ina[hit], inb[hit]])
+        ids = [self.corr_ids[r] for r in map(tuple, self.region_rows.tolist())]
+        lo = self.region.min(axis=0)
+        hi = self.region.max(axis=0)
+        for which, off in ((ui.DualImageView.IMAGE_A, 0),
+                           (ui.DualImageView.IMAGE_B, offset)):
+            found = self.kp_index[which].in_rect(lo - off, hi - off)
+            if not found:
+                continue
+            inside = mdl.points_in_polygon(np.array([p for p, _ in found]) + off, poly)
+            for (p, values), ok in zip(found, inside):
+                if ok:
+                    ids.extend(values)
+        view.set_region_selection(self.region, ids)
+        self.status_field.setText("{0} correspondences selected".format(len(self.region_rows)))
+
+    def clear_region(self):
+        if self.region is not None:
+            self.dual_img.clear_region_selection()
+        self.region = None
+        self.region_rows = None
+        self.region_ends = None
+
+    def delete_region(self):
+        """ Delete the selected correspondences as one edit """
+        rows = self.region_rows
+        self.clear_region()
+        if len(rows):
+            self.edit("delete correspondences", removed=rows)
+            self.to_dirty_project()
+
+    def move_region(self, dx, dy):
+        """ Move the ends of the selected correspondences inside the region
+        by dx, dy as one edit """
+        if self.region is None:
+            return
+        rows = self.region_rows
+        moved = rows.copy()
+        moved[self.region_ends[:,0], 0:2] += (dx, dy)
+        moved[self.region_ends[:,1], 2:4] += (dx, dy)
+        poly = self.region + (dx, dy)
+        self.clear_region()
+        if len(rows):
+            self.edit("move correspondences", removed=rows, added=moved)
+            self.to_dirty_project()
+        self.select_region(poly)
+
     def image_a_clicked(self, x, y):
         log.debug("image A clicked: {0}".format((x,y)))
-        self.a_point = np.array([x,y])
+        if self.region is not None:
+            self.clear_region()
+            return
+        self.a_point = self.snap(ui.DualImageView.IMAGE_A, x, y)
         self.on_image_a_point()
 
     def image_b_clicked(self, x, y):
         log.debug("image B clicked: {0}".format((x,y)))
-        self.b_point = np.array([x,y])
+        if self.region is not None:
+            self.clear_region()
+            return
+        self.b_point = self.snap(ui.DualImageView.IMAGE_B, x, y)
         self.on_image_b_point()
 
     def on_project_changed(self):
@@ -453,6 +793,9 @@ class CorrespondenceController(AnnotationController):
             name = npd.name
             path = pl.Path(npd.path)
             skip_images = npd.skip
+            self.stop_watch()
+            self.close_journal()
+            self.current_filename = None
             self.current_project = mdl.new_correspondence_project(name, path, skip_images)
             load_project(self.current_project, self)
             return True
@@ -461,18 +804,30 @@ class CorrespondenceController(AnnotationController):
     def do_open_project(self, checked):
         log.debug("open project")
         fn = QFileDialog.getOpenFileName(self.ui_, "Open file", os.getcwd(), "*.pya")
+        if not fn:
+            return False
+        self.stop_watch()
+        self.close_journal()
         self.current_filename = str(fn)
-        if self.current_filename:
-            self.current_project = mdl.load_correspondence_project(self.current_filename)
-            load_project(self.current_project, self)
-            return True
-        return False
+        self.current_project = mdl.load_correspondence_project(self.current_filename)
+        replayed = jrnl.replay_journal(self.current_project, self.current_filename)
+        self.open_journal()
+        if replayed or not pf.is_project_file(self.current_filename):
+            # recover the edits, or convert a pickled project, right away
+            self.compact()
+        load_project(self.current_project, self)
+        return True
     
     def do_close_project(self, checked):
         log.debug("close project")
+        self.stop_watch()
+        self.close_journal()
         self.current_project = None
-        self.corr_model.clear()
-        self.pair_model.clear()
+        self.corr_model.set_correspondences(None)
+        self.pair_model.set_pairs(None)
+        self.history.clear()
+        self.update_undo_actions()
+        self.image_cache.clear()
         return True
 
     def do_save_project(self, checked):
@@ -488,22 +843,233 @@ class CorrespondenceController(AnnotationController):
         return False
 
     def save(self):
-        log.debug("current filename: {0}".format(self.current_filename))
+        with trace.span("save"):
+            saved = self.save_()
+        self.show_timing("save")
+        return saved
+
+    def save_(self):
+        log.debug("current filename: %s", self.current_filename)
         if self.current_filename is None:
             imgpath = self.current_project['image_path']
             fn = QFileDialog.getSaveFileName(self.ui_, "Save File As", str(imgpath), "*.pya")
             self.current_filename = str(fn)
+            if self.current_filename:
+                self.open_journal()
+                self.compact()
+        elif self.journal is None or self.journal.needs_compaction or self.extended:
+            # journaled edits of ingested pairs need them in the file
+            self.compact()
+        else:
+            # the edits are already in the journal
+            with trace.span("journal_sync"):
+                self.journal.sync()
         if self.current_filename:
-            mdl.save_correspondence_project(self.current_project, self.current_filename)
             self.do_save_project_.setEnabled(False)
             return True
         return False            
 
+    def open_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = jrnl.EditJournal(self.current_filename)
+
+    def close_journal(self):
+        if self.journal is not None:
+            if self.journal.count > 0:
+                self.compact()
+            self.journal.close()
+            self.journal = None
+        self.extended = False
+
+    @trace.traced("compact")
+    def compact(self):
+        """ Fold the journal into the project file """
+        log.debug("compacting %s", self.current_filename)
+        mdl.save_correspondence_project(self.current_project, self.current_filename)
+        self.extended = False
+        if self.journal is not None:
+            self.journal.truncate()
+
+    def do_watch(self, checked):
+        self.stop_watch()
+        if checked and self.current_project is not None:
+            proj = self.current_project
+            # the directory is listed by the watcher's scan thread
+            index = dirindex.DirectoryIndex(proj['image_path'], proj.get('pat', "*.png"),
+                                            cache_path(self.cache_dir, dirindex.INDEX_DIR),
+                                            scan=False)
+            images = proj['images']
+            last = images[len(images) - 1].name if len(images) else None
+            self.watcher = dirindex.DirectoryWatcher(index, last, self)
+            self.watcher.images_added.connect(self.on_images_added)
+            # pick up the frames that arrived while the project was closed
+            self.watcher.rescan()
+        self.do_watch_.setChecked(self.watcher is not None)
+
+    def stop_watch(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        self.do_watch_.setChecked(False)
+
+    def on_images_added(self, paths):
+        if self.watcher is None or self.current_project is None:
+            # queued by a scan that finished after the watch stopped
+            return
+        added = mdl.extend_project(self.current_project, paths)
+        if added:
+            self.extended = True
+        self.pair_model.sync()
+        self.status_field.setText("{0} new images, {1} new pairs".format(len(paths), added))
+
+    def do_raw_cache(self, checked):
+        """ Read frames through the raw frame disk cache, or decode them
+        every time """
+        if checked:
+            if self.raw_frames is None:
+                self.raw_frames = cache.RawFrameCache(cache_path(self.cache_dir,
+                                                                 cache.RAW_DIR))
+            self.image_cache.loader = self.raw_frames.load
+        else:
+            self.image_cache.loader = cache.imread
+
+    def do_propose(self, checked):
+        """ Propose correspondences for the current pair """
+        if self.current_project is None:
+            return
+        proj = self.current_project
+        idx = proj['index']
+        self.status_field.setText("Proposing correspondences...")
+        rows = self.proposals.propose(proj['pairs'][idx],
+                                      lambda pair: self.proposed.emit(idx))
+        if rows is not None:
+            self.show_proposals_(idx, rows)
+
+    def on_proposed(self, idx):
+        proj = self.current_project
+        if proj is None or idx != proj['index']:
+            return
+        rows = self.proposals.get(proj['pairs'][idx])
+        if rows is None:
+            self.status_field.setText("No proposals")
+            return
+        self.show_proposals_(idx, rows)
+
+    def show_proposals_(self, idx, rows):
+        for cid in list(self.candidates):
+            self.remove_candidate(self.dual_img.annotation(cid))
+        show_candidates(self.current_project, self, idx, rows)
+        self.status_field.setText("{0} proposals".format(len(self.candidates)))
+
+    def do_accept_all(self, checked):
+        if not self.candidates:
+            return
+        rows = self.candidates.values()
+        self.selection = None
+        self.dual_img.remove_annotations(list(self.candidates))
+        self.candidates.clear()
+        self.edit("accept proposals", added=rows)
+        self.to_dirty_project()
+
+    def do_precompute_proposals(self, checked):
+        if self.current_project is not None:
+            self.proposals.precompute(self.current_project['pairs'],
+                                      self.proposals_progress.emit)
+
+    def on_proposals_progress(self, done, total, idx):
+        self.status_field.setText("Proposals: {0}/{1} pairs".format(done, total))
+        if self.current_project is not None and idx == self.current_project['index']:
+            rows = self.proposals.get(self.current_project['pairs'][idx])
+            if rows is not None and not self.candidates:
+                show_candidates(self.current_project, self, idx, rows)
+
+    def do_show_timing(self, checked):
+        trace.enable(checked)
+        if not checked:
+            trace.clear()
+        self.timing_field.setText("")
+        self.timing_field.setVisible(checked)
+
+    def show_timing(self, name):
+        """ Show the breakdown of the last span called name in the timing
+        overlay """
+        if trace.enabled:
+            self.timing_field.setText(trace.format_breakdown(name))
+
+    def do_export_trace(self, checked):
+        fn = QFileDialog.getSaveFileName(self.ui_, "Export Trace", "trace.json", "*.json")
+        if fn:
+            count = trace.export_trace(str(fn))
+            self.status_field.setText("Exported {0} spans".format(count))
+
+    def on_propagated(self, idx):
+        """ Show the tracks of a pair that finished after it was loaded """
+        proj = self.current_project
+        if proj is not None and self.propagate and idx == proj['index']:
+            rows = propagated_rows(proj, self, idx)
+            if rows is not None:
+                show_candidates(proj, self, idx, rows, PROPAGATED_COLOR, "propagated")
+
+    def do_propagate(self, checked):
+        self.propagate = checked
+        if checked and self.current_project is not None:
+            self.on_propagated(self.current_project['index'])
+            self.propagate_next_()
+
+    def on_segments_ready(self, path):
+        proj = self.current_project
+        if proj is None or self.segment_method is None:
+            return
+        for which, p in enumerate(proj['pairs'][proj['index']]):
+            if str(p) == str(path):
+                show_segment(self, which, p)
+
+    def do_segment_method(self, method, checked=True):
+        self.segment_method = method
+        self.overlay_opacity.setVisible(method is not None)
+        self.do_show_overlay_.setChecked(method is not None)
+        self.dual_img.set_overlay_visible(True)
+        if self.current_project is None:
+            return
+        if method is None:
+            for which in (ui.DualImageView.IMAGE_A, ui.DualImageView.IMAGE_B):
+                self.dual_img.set_overlay(which, None)
+        else:
+            show_segments(self.current_project, self, self.current_project['index'])
+
+    def do_fill_segments(self, checked):
+        self.segment_mode = seg.REGIONS if checked else seg.BOUNDARIES
+        if self.segment_method is not None and self.current_project is not None:
+            show_segments(self.current_project, self, self.current_project['index'])
+
+    def do_show_overlay(self, checked):
+        # hides the overlay without dropping it, so showing it is instant
+        self.dual_img.set_overlay_visible(checked)
+
+    def on_enhance_changed(self):
+        proj = self.current_project
+        if proj is None:
+            return
+        imgs = self.dual_img.images
+        if any(img is None for img in imgs):
+            return
+        with trace.span("enhance"):
+            img_pair = proj['pairs'][proj['index']]
+            self.dual_img.set_luts(display_luts(img_pair, imgs, self))
+
     def do_exit(self, checked):
         log.debug("exit")
         # check whether the project should be saved
         # save it
         # shutdown the application
+        self.prefetcher.close()
+        self.thumbnails.close()
+        self.proposals.close()
+        self.propagator.close()
+        self.segments.close()
+        self.stop_watch()
+        self.close_journal()
         self.ui_.close()
 
     def create_actions(self):
@@ -535,5 +1101,79 @@ class CorrespondenceController(AnnotationController):
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.do_exit_)
         
-        self.edit_menu.addAction(self.undo_stack.createUndoAction(self.ui_))
-        self.edit_menu.addAction(self.undo_stack.createRedoAction(self.ui_))
+        self.do_watch_ = QAction("&Watch Image Folder", self.ui_)
+        self.do_watch_.setCheckable(True)
+        self.do_watch_.triggered.connect(self.do_watch)
+        self.options_menu.addAction(self.do_watch_)
+
+        self.do_raw_cache_ = QAction("Cache &Decoded Frames", self.ui_)
+        self.do_raw_cache_.setCheckable(True)
+        self.do_raw_cache_.triggered.connect(self.do_raw_cache)
+        self.options_menu.addAction(self.do_raw_cache_)
+
+        self.do_propose_ = QAction("&Propose Correspondences", self.ui_)
+        self.do_propose_.setShortcut("Ctrl+P")
+        self.do_propose_.triggered.connect(self.do_propose)
+        self.edit_menu.addAction(self.do_propose_)
+
+        self.do_accept_all_ = QAction("&Accept All Proposals", self.ui_)
+        self.do_accept_all_.triggered.connect(self.do_accept_all)
+        self.edit_menu.addAction(self.do_accept_all_)
+
+        self.do_precompute_ = QAction("Precompute &Proposals", self.ui_)
+        self.do_precompute_.triggered.connect(self.do_precompute_proposals)
+        self.options_menu.addAction(self.do_precompute_)
+
+        self.do_propagate_ = QAction("Propagate to &Next Pair", self.ui_)
+        self.do_propagate_.setCheckable(True)
+        self.do_propagate_.setChecked(self.propagate)
+        self.do_propagate_.triggered.connect(self.do_propagate)
+        self.options_menu.addAction(self.do_propagate_)
+
+        self.do_enhance_ = self.ui_.select('enhance_dock').toggleViewAction()
+        self.do_enhance_.setText("&Contrast...")
+        self.do_enhance_.setShortcut("Ctrl+E")
+        self.options_menu.addAction(self.do_enhance_)
+
+        self.segment_menu_ = self.options_menu.addMenu("Segment &Overlay")
+        self.segment_group_ = QActionGroup(self.ui_)
+        for method in [None] + list(seg.METHODS):
+            a = QAction(method.capitalize() if method else "Off", self.ui_)
+            a.setCheckable(True)
+            a.setChecked(method is None)
+            a.triggered.connect(partial(self.do_segment_method, method))
+            self.segment_group_.addAction(a)
+            self.segment_menu_.addAction(a)
+        self.segment_menu_.addSeparator()
+
+        self.do_fill_segments_ = QAction("&Fill Segments", self.ui_)
+        self.do_fill_segments_.setCheckable(True)
+        self.do_fill_segments_.triggered.connect(self.do_fill_segments)
+        self.segment_menu_.addAction(self.do_fill_segments_)
+
+        self.do_show_overlay_ = QAction("&Show Overlay", self.ui_)
+        self.do_show_overlay_.setCheckable(True)
+        self.do_show_overlay_.setShortcut("Ctrl+G")
+        self.do_show_overlay_.triggered.connect(self.do_show_overlay)
+        self.segment_menu_.addAction(self.do_show_overlay_)
+
+        self.do_show_timing_ = QAction("Show &Timing", self.ui_)
+        self.do_show_timing_.setCheckable(True)
+        self.do_show_timing_.triggered.connect(self.do_show_timing)
+        self.options_menu.addAction(self.do_show_timing_)
+
+        self.do_export_trace_ = QAction("Export T&race...", self.ui_)
+        self.do_export_trace_.triggered.connect(self.do_export_trace)
+        self.options_menu.addAction(self.do_export_trace_)
+        self.edit_menu.addSeparator()
+
+        self.do_undo_ = QAction("&Undo", self.ui_)
+        self.do_undo_.setShortcut(QKeySequence.Undo)
+        self.do_undo_.triggered.connect(self.do_undo)
+        self.edit_menu.addAction(self.do_undo_)
+
+        self.do_redo_ = QAction("&Redo", self.ui_)
+        self.do_redo_.setShortcut(QKeySequence.Redo)
+        self.do_redo_.triggered.connect(self.do_redo)
+        self.edit_menu.addAction(self.do_redo_)
+        self.update_undo_actions()
@@ -0,0 +1,164 @@
+""" Persistent, incrementally updated index of the images in a directory.
+
+The sorted image names of a directory are cached on disk together with the
+directory mtime. While the mtime is unchanged the cached names are used
+without listing the directory; otherwise the directory is scanned once and
+the new names are merged in, appended in place when they sort after every
+known name (as frames from a running capture do).
+"""
+import os
+import json
+import bisect
+import hashlib
+import fnmatch
+import logging
+import threading
+from PyQt4.QtCore import QObject, QTimer, QFileSystemWatcher, pyqtSignal
+import pyimgann.cache as cache
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+log = logging.getLogger("pyimgann.dirindex")
+log.setLevel(logging.DEBUG)
+
+INDEX_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, "index")
+# delay before rescanning a watched directory, so a burst of new frames is
+# picked up by a single scan
+WATCH_DELAY_MS = 250
+
+def list_names(dirname, pat):
+    """ Return the names of the files in dirname matching pat """
+    if scandir is not None:
+        return [e.name for e in scandir(dirname)
+                if fnmatch.fnmatchcase(e.name, pat) and e.is_file()]
+    return [n for n in os.listdir(dirname)
+            if fnmatch.fnmatchcase(n, pat)
+            and os.path.isfile(os.path.join(dirname, n))]
+
+class DirectoryIndex(object):
+    """ Sorted names of the files in a directory that match a pattern """
+    def __init__(self, dirname, pat="*.png", index_dir=INDEX_DIR, scan=True):
+        self.dirname = os.path.abspath(str(dirname))
+        if not os.path.isdir(self.dirname):
+            raise IOError("Not a directory: " + self.dirname)
+        self.pat = pat
+        key = hashlib.sha1(repr((self.dirname, pat))).hexdigest()
+        self.filename_ = os.path.join(index_dir, key + ".json")
+        self.mtime_ = None
+        self.names = []
+        self.load_()
+        if scan:
+            self.refresh()
+
+    def __len__(self):
+        return len(self.names)
+
+    def paths(self, start=0):
+        """ Return the full paths of the names from start on """
+        return [os.path.join(self.dirname, n) for n in self.names[start:]]
+
+    def load_(self):
+        try:
+            with open(self.filename_, "r") as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return
+        if saved.get('dir') == self.dirname and saved.get('pat') == self.pat:
+            self.mtime_ = saved['mtime']
+            self.names = saved['names']
+
+    def save_(self):
+        tmpname = self.filename_ + ".tmp"
+        try:
+            if not os.path.isdir(os.path.dirname(self.filename_)):
+                os.makedirs(os.path.dirname(self.filename_))
+            with open(tmpname, "w") as f:
+                json.dump({'dir': self.dirname, 'pat': self.pat,
+                           'mtime': self.mtime_, 'names': self.names}, f)
+            os.rename(tmpname, self.filename_)
+        except (IOError, OSError):
+            log.exception("failed to save the index of {0}".format(self.dirname))
+
+    def refresh(self):
+        """ Bring the index up to date with the directory """
+        mtime = os.stat(self.dirname).st_mtime
+        if mtime == self.mtime_:
+            return
+        # a change within the mtime resolution after this scan must still
+        # be seen, so the mtime is read before listing
+        self.mtime_ = mtime
+        found = list_names(self.dirname, self.pat)
+        known = set(self.names)
+        new = sorted(n for n in found if n not in known)
+        if len(found) - len(new) != len(known):
+            # files were removed
+            self.names = sorted(found)
+        elif new and self.names and new[0] < self.names[-1]:
+            for n in new:
+                bisect.insort(self.names, n)
+        else:
+            self.names.extend(new)
+        self.save_()
+        log.debug("indexed {0}: {1} images".format(self.dirname, len(self.names)))
+
+class DirectoryWatcher(QObject):
+    """ Watch an indexed directory and report the images that sort after
+    the last image seen. The directory is rescanned in a background thread,
+    and images_added is emitted from it """
+    # full paths of the newly arrived images
+    images_added = pyqtSignal(list)
+
+    def __init__(self, index, last=None, parent=None):
+        super(DirectoryWatcher,self).__init__(parent)
+        self.index_ = index
+        self.last_ = last
+        self.timer_ = QTimer(self)
+        self.timer_.setSingleShot(True)
+        self.timer_.setInterval(WATCH_DELAY_MS)
+        self.timer_.timeout.connect(self.rescan)
+        self.watcher_ = QFileSystemWatcher([index.dirname], self)
+        self.watcher_.directoryChanged.connect(lambda d: self.timer_.start())
+        self.lock_ = threading.Lock()
+        self.scanning_ = False
+        self.again_ = False
+        self.closed_ = False
+
+    def rescan(self):
+        """ Scan the directory in the background; a change during a scan
+        is picked up by one more scan after it """
+        with self.lock_:
+            if self.scanning_:
+                self.again_ = True
+                return
+            self.scanning_ = True
+        t = threading.Thread(target=self.scan_)
+        t.daemon = True
+        t.start()
+
+    def scan_(self):
+        while True:
+            try:
+                self.index_.refresh()
+                names = self.index_.names
+                start = 0 if self.last_ is None else bisect.bisect_right(names, self.last_)
+                if start < len(names) and not self.closed_:
+                    self.last_ = names[-1]
+                    self.images_added.emit(self.index_.paths(start))
+            except (IOError, OSError):
+                log.exception("failed to scan {0}".format(self.index_.dirname))
+            with self.lock_:
+                if not self.again_ or self.closed_:
+                    self.scanning_ = False
+                    return
+                self.again_ = False
+
+    def close(self):
+        self.closed_ = True
+        self.timer_.stop()
+        self.watcher_.removePath(self.index_.dirname)
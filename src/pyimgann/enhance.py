@@ -0,0 +1,124 @@
+""" Display enhancement of images through 8-bit lookup tables.
+
+A percentile stretch, a gamma and a contrast-limited histogram equalisation
+are folded into one 256 entry table per image, computed from the image's
+histogram. Histograms are computed once per image and cached, so changing
+the adjustment only rebuilds the tables and reapplies them with cv2.LUT to
+the display buffers; the pixels used for coordinates are never touched.
+"""
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+import pyimgann.pyramid as pyr
+
+log = logging.getLogger("pyimgann.enhance")
+log.setLevel(logging.DEBUG)
+
+# histograms kept in memory
+STATS_CACHE_SIZE = 4096
+# histogram counts above this multiple of the mean are clipped before
+# equalising, as CLAHE does per tile
+CLIP_LIMIT = 4.0
+
+class Adjustment(object):
+    """ Parameters of the display enhancement """
+    __slots__ = ('low', 'high', 'gamma', 'equalize')
+
+    def __init__(self, low=0.0, high=100.0, gamma=1.0, equalize=0.0):
+        # percentiles mapped to black and white, the gamma, and the blend of
+        # the equalised table in [0,1]
+        self.low = low
+        self.high = high
+        self.gamma = gamma
+        self.equalize = equalize
+
+    @property
+    def is_identity(self):
+        return (self.low <= 0 and self.high >= 100 and self.gamma == 1.0 and
+                self.equalize <= 0)
+
+def histogram(img):
+    """ Return the 256 bin histogram of an 8-bit image, over all channels """
+    img = np.ascontiguousarray(img)
+    channels = 1 if img.ndim == 2 else min(img.shape[2], 3)
+    hist = np.zeros(256, dtype=np.int64)
+    for c in xrange(channels):
+        hist += cv2.calcHist([img], [c], None, [256], [0, 256]).ravel().astype(np.int64)
+    return hist
+
+def make_lut(hist, adj):
+    """ Return the uint8 lookup table of an adjustment for an image with
+    histogram hist """
+    x = np.arange(256, dtype=np.float64)
+    cdf = np.cumsum(hist).astype(np.float64)
+    total = max(cdf[-1], 1.0)
+    lo = np.searchsorted(cdf, total * adj.low / 100.0)
+    hi = np.searchsorted(cdf, total * adj.high / 100.0)
+    hi = max(hi, lo + 1)
+    v = np.clip((x - lo) / float(hi - lo), 0.0, 1.0)
+    if adj.equalize > 0:
+        limit = CLIP_LIMIT * total / 256.0
+        clipped = np.minimum(hist, limit).astype(np.float64)
+        # redistribute the clipped counts evenly
+        clipped += (total - clipped.sum()) / 256.0
+        eq = np.cumsum(clipped)
+        eq = (eq - eq[0]) / max(eq[-1] - eq[0], 1.0)
+        v = (1 - adj.equalize) * v + adj.equalize * eq[np.round(v * 255).astype(int)]
+    if adj.gamma != 1.0:
+        v = v ** (1.0 / adj.gamma)
+    return np.round(v * 255).astype(np.uint8)
+
+def apply_lut(img, lut):
+    """ Return a copy of the 8-bit image img mapped through lut. Alpha
+    channels are kept """
+    if lut is None or img.dtype != np.uint8:
+        return img
+    if img.ndim == 3 and img.shape[2] == 4:
+        out = img.copy()
+        out[...,:3] = cv2.LUT(np.ascontiguousarray(img[...,:3]), lut)
+        return out
+    return cv2.LUT(np.ascontiguousarray(img), lut)
+
+class ImageStats(object):
+    """ Histograms of the shown images, by path """
+    def __init__(self, size=STATS_CACHE_SIZE):
+        self.size_ = size
+        self.hists_ = OrderedDict()
+        self.lock_ = threading.Lock()
+
+    def get(self, path, img):
+        """ Return the histogram of the image img loaded from path """
+        key = str(path)
+        with self.lock_:
+            hist = self.hists_.pop(key, None)
+            if hist is not None:
+                self.hists_[key] = hist
+                return hist
+        if isinstance(img, pyr.ImagePyramid):
+            # the coarsest level has the same distribution, at a fraction of
+            # the pixels
+            img = img.levels[-1]
+        if img.dtype != np.uint8:
+            return None
+        hist = histogram(img)
+        with self.lock_:
+            self.hists_[key] = hist
+            while len(self.hists_) > self.size_:
+                self.hists_.popitem(last=False)
+        return hist
+
+    def lut(self, path, img, adj):
+        """ Return the lookup table of adj for an image, or None when the
+        adjustment leaves it unchanged """
+        if adj.is_identity:
+            return None
+        hist = self.get(path, img)
+        if hist is None:
+            return None
+        return make_lut(hist, adj)
+
+    def clear(self):
+        with self.lock_:
+            self.hists_.clear()
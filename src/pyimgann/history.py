@@ -0,0 +1,142 @@
+""" Per-pair undo history of correspondence edits.
+
+An edit records the rows it removed and the rows it added as (N,4) int32
+arrays, so a bulk edit is a single entry and no Qt objects or annotations
+are kept alive by the history. The histories of all pairs are kept across
+frame switches within a memory budget; past it, the oldest edits of the
+least recently edited pairs are dropped first, after any of their edits
+that were undone.
+"""
+import numpy as np
+from collections import OrderedDict
+
+# memory budget of the edit rows of all pairs
+HISTORY_BYTES = 16 * 1024 * 1024
+
+def as_rows(rows):
+    if rows is None:
+        return np.empty((0, 4), dtype=np.int32)
+    return np.asarray(rows, dtype=np.int32).reshape(-1, 4)
+
+class Edit(object):
+    """ Rows removed from and rows added to one pair """
+    __slots__ = ('text', 'removed', 'added')
+
+    def __init__(self, text, removed=None, added=None):
+        self.text = text
+        self.removed = as_rows(removed)
+        self.added = as_rows(added)
+
+    def __len__(self):
+        return len(self.removed) + len(self.added)
+
+    @property
+    def nbytes(self):
+        return self.removed.nbytes + self.added.nbytes
+
+    def inverse(self):
+        return Edit(self.text, self.added, self.removed)
+
+class PairHistory(object):
+    """ Edits of one pair; the first pos of them are applied """
+    def __init__(self):
+        self.edits = []
+        self.pos = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.edits)
+
+    def push(self, edit):
+        """ Add an applied edit, dropping the edits that were undone.
+        Returns the change in size """
+        before = self.nbytes
+        for e in self.edits[self.pos:]:
+            self.nbytes -= e.nbytes
+        del self.edits[self.pos:]
+        self.edits.append(edit)
+        self.nbytes += edit.nbytes
+        self.pos = len(self.edits)
+        return self.nbytes - before
+
+    def undo(self):
+        self.pos -= 1
+        return self.edits[self.pos]
+
+    def redo(self):
+        self.pos += 1
+        return self.edits[self.pos - 1]
+
+    def drop(self):
+        """ Forget the newest undone edit, or the oldest edit if none was
+        undone, returning its size. An undone edit can only be redone after
+        those before it """
+        if self.pos < len(self.edits):
+            e = self.edits.pop()
+        else:
+            e = self.edits.pop(0)
+            self.pos -= 1
+        self.nbytes -= e.nbytes
+        return e.nbytes
+
+class UndoHistory(object):
+    """ Undo histories of all pairs, by pair index """
+    def __init__(self, max_bytes=HISTORY_BYTES):
+        self.max_bytes_ = max_bytes
+        # least recently edited first
+        self.pairs_ = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, pair_index):
+        return self.pairs_.get(pair_index)
+
+    def can_undo(self, pair_index):
+        h = self.pairs_.get(pair_index)
+        return h is not None and h.pos > 0
+
+    def can_redo(self, pair_index):
+        h = self.pairs_.get(pair_index)
+        return h is not None and h.pos < len(h)
+
+    def undo_text(self, pair_index):
+        h = self.pairs_.get(pair_index)
+        return h.edits[h.pos - 1].text if h is not None and h.pos > 0 else None
+
+    def redo_text(self, pair_index):
+        h = self.pairs_.get(pair_index)
+        return h.edits[h.pos].text if h is not None and h.pos < len(h) else None
+
+    def push(self, pair_index, edit):
+        """ Record an applied edit of pair_index """
+        h = self.pairs_.pop(pair_index, None)
+        if h is None:
+            h = PairHistory()
+        self.pairs_[pair_index] = h
+        self.nbytes += h.push(edit)
+        self.evict_()
+
+    def undo(self, pair_index):
+        """ Return the edit to revert, or None """
+        if not self.can_undo(pair_index):
+            return None
+        return self.pairs_[pair_index].undo()
+
+    def redo(self, pair_index):
+        """ Return the edit to apply again, or None """
+        if not self.can_redo(pair_index):
+            return None
+        return self.pairs_[pair_index].redo()
+
+    def evict_(self):
+        while self.nbytes > self.max_bytes_ and self.pairs_:
+            pair_index, h = next(self.pairs_.iteritems())
+            if len(self.pairs_) == 1 and len(h) == 1:
+                # keep the edit just made, however large
+                break
+            self.nbytes -= h.drop()
+            if len(h) == 0:
+                del self.pairs_[pair_index]
+
+    def clear(self):
+        self.pairs_.clear()
+        self.nbytes = 0
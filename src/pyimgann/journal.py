@@ -0,0 +1,137 @@
+""" Append-only edit journal kept next to a project file.
+
+Every correspondence edit is appended as a fixed-size record, so saving only
+has to flush the records written since the last save. The journal is folded
+into the project file by compaction, and a journal left behind by a crash is
+replayed when the project is opened again.
+"""
+import os
+import struct
+import logging
+import numpy as np
+import pyimgann.model as mdl
+
+log = logging.getLogger("pyimgann.journal")
+log.setLevel(logging.DEBUG)
+
+MAGIC = b"PYAJRNL1"
+# op, pair index, ax, ay, bx, by
+RECORD = struct.Struct("<Bi4i")
+# the same record as an array dtype, to pack the rows of an edit at once
+RECORD_DTYPE = np.dtype([('op', 'u1'), ('pair', '<i4'), ('row', '<i4', (4,))])
+ADD_CORRESPONDENCE = 1
+REMOVE_CORRESPONDENCE = 2
+# records written between fsyncs, bounding the edits lost to a crash
+SYNC_RECORDS = 8
+# records after which the journal is folded into the project file on save
+COMPACT_RECORDS = 4096
+
+def journal_filename(filename):
+    return str(filename) + ".journal"
+
+class EditJournal(object):
+    """ Appends edit records to the journal of a project file """
+    def __init__(self, filename):
+        self.filename = journal_filename(filename)
+        size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        if size >= len(MAGIC):
+            with open(self.filename, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise IOError("Not an edit journal: " + self.filename)
+        self.file_ = open(self.filename, "ab")
+        if size < len(MAGIC):
+            self.file_.truncate(0)
+            self.file_.write(MAGIC)
+            self.file_.flush()
+            size = len(MAGIC)
+        self.count = (size - len(MAGIC)) // RECORD.size
+        end = len(MAGIC) + self.count * RECORD.size
+        if size > end:
+            # drop a record torn by a crash, so appends stay aligned
+            log.warning("dropping %d bytes of a partial record from %s",
+                        size - end, self.filename)
+            self.file_.truncate(end)
+            self.file_.flush()
+        self.unsynced_ = 0
+
+    @property
+    def needs_compaction(self):
+        return self.count >= COMPACT_RECORDS
+
+    def append(self, op, pair_index, c):
+        self.append_rows(op, pair_index, [[c[0][0], c[0][1], c[1][0], c[1][1]]])
+
+    def append_edit(self, pair_index, removed, added):
+        """ Append the (N,4) rows removed and added by one edit, with a
+        single write """
+        self.append_rows([REMOVE_CORRESPONDENCE] * len(removed) +
+                         [ADD_CORRESPONDENCE] * len(added), pair_index,
+                         np.concatenate([np.reshape(removed, (-1, 4)),
+                                         np.reshape(added, (-1, 4))]))
+
+    def append_rows(self, ops, pair_index, rows):
+        rows = np.asarray(rows).reshape(-1, 4)
+        if len(rows) == 0:
+            return
+        records = np.empty(len(rows), dtype=RECORD_DTYPE)
+        records['op'] = ops
+        records['pair'] = pair_index
+        records['row'] = rows
+        self.file_.write(records.tobytes())
+        # flushed records survive a crash of the application, synced records
+        # a crash of the machine
+        self.file_.flush()
+        self.count += len(rows)
+        self.unsynced_ += len(rows)
+        if self.unsynced_ >= SYNC_RECORDS:
+            self.sync()
+
+    def sync(self):
+        self.file_.flush()
+        os.fsync(self.file_.fileno())
+        self.unsynced_ = 0
+
+    def truncate(self):
+        """ Drop all records, once they are part of the project file """
+        self.file_.truncate(len(MAGIC))
+        self.sync()
+        self.count = 0
+
+    def close(self):
+        self.sync()
+        self.file_.close()
+
+def read_journal(filename):
+    """ Return the (op, pair_index, correspondence) records in the journal of
+    filename. A partially written trailing record is ignored """
+    jfn = journal_filename(filename)
+    if not os.path.exists(jfn):
+        return []
+    with open(jfn, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise IOError("Not an edit journal: " + jfn)
+    records = []
+    count = (len(data) - len(MAGIC)) // RECORD.size
+    for i in range(count):
+        op, pair_index, ax, ay, bx, by = \
+            RECORD.unpack_from(data, len(MAGIC) + i * RECORD.size)
+        records.append((op, pair_index, mdl.Correspondence((ax,ay), (bx,by))))
+    return records
+
+def replay_journal(proj, filename):
+    """ Apply the journal of filename to proj, returning the number of
+    records applied """
+    records = read_journal(filename)
+    count = len(proj['pairs'])
+    for op, pair_index, c in records:
+        if pair_index >= count:
+            # an edit of a pair ingested after the file was written
+            log.warning("skipping an edit of pair {0} of {1}".format(pair_index, count))
+            continue
+        mdl.apply_correspondence(proj, pair_index, c,
+                                 add=(op == ADD_CORRESPONDENCE))
+    if records:
+        log.info("replayed {0} edits from {1}".format(len(records),
+                                                      journal_filename(filename)))
+    return len(records)
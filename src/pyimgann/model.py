@@ -1,32 +1,197 @@
+import os
+import bisect
 import numpy as np
 import logging
 import pathlib as pl
 import cPickle as pkl
 from collections import defaultdict
-from sortedcontainers import SortedSet
+from multiprocessing.pool import ThreadPool
 from PyQt4.QtCore import QObject, pyqtSignal
+import pyimgann.projfile as pf
+import pyimgann.shards as shards
+import pyimgann.dirindex as dirindex
 
 log = logging.getLogger("pyimgann.model")
 log.setLevel(logging.DEBUG)
 
+# threads reading correspondence files in bulk
+LOAD_WORKERS = 8
+# points tested against a polygon at a time
+POLYGON_CHUNK = 4096
+
+def point_keys(pts):
+    """ Pack (N,2) int32 points into int64 keys for vectorized set tests """
+    pts = np.asarray(pts, dtype=np.int64).reshape(-1, 2)
+    return (pts[:,0] << 32) | (pts[:,1] & 0xffffffff)
+
+def points_in_polygon(pts, poly):
+    """ Return a boolean mask of the (N,2) points inside the (M,2) polygon
+    poly, by even-odd ray casting """
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    poly = np.asarray(poly, dtype=np.float64).reshape(-1, 2)
+    inside = np.zeros(len(pts), dtype=bool)
+    if len(poly) < 3 or len(pts) == 0:
+        return inside
+    lo = poly.min(axis=0)
+    hi = poly.max(axis=0)
+    cand = np.flatnonzero((pts >= lo).all(axis=1) & (pts <= hi).all(axis=1))
+    x0, y0 = poly[:,0], poly[:,1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    # test in chunks, the crossings are (points, edges) arrays
+    for i in xrange(0, len(cand), POLYGON_CHUNK):
+        c = cand[i:i + POLYGON_CHUNK]
+        x = pts[c,0:1]
+        y = pts[c,1:2]
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside[c] = (crosses & (x < xs)).sum(axis=1) % 2 == 1
+    return inside
+
 class PointSet2D(object):
-    def __init__(self):
-        self.xs_ = defaultdict(SortedSet)
-        
+    """ Set of integer 2d points stored in one growable (N,2) int32 array """
+    def __init__(self, pts=None):
+        self.pts_ = np.empty((16, 2), dtype=np.int32)
+        self.n_ = 0
+        if pts is not None:
+            self.add_points(pts)
+
+    def __len__(self):
+        return self.n_
+
+    def __iter__(self):
+        # iterate over a snapshot, so the set can change while iterating
+        for x, y in self.points().tolist():
+            yield (x, y)
+
+    def __contains__(self, pt):
+        return self.find_(pt) >= 0
+
+    def find_(self, pt):
+        hits = np.flatnonzero((self.points()[:,0] == pt[0]) &
+                              (self.points()[:,1] == pt[1]))
+        return hits[0] if len(hits) else -1
+
+    def reserve_(self, n):
+        if n > len(self.pts_):
+            cap = max(n, 2 * len(self.pts_))
+            pts = np.empty((cap, 2), dtype=np.int32)
+            pts[:self.n_] = self.pts_[:self.n_]
+            self.pts_ = pts
+
     def add(self, pt):
-        self.xs_[pt[0]].add(pt[1])
-        
-    def remove(self, pt):
-        x = self.xs_[pt[0]]
-        if x:
-            x.discard(pt[1])
-            
+        if self.find_(pt) < 0:
+            self.reserve_(self.n_ + 1)
+            self.pts_[self.n_] = pt[0], pt[1]
+            self.n_ += 1
+
+    def discard(self, pt):
+        i = self.find_(pt)
+        if i >= 0:
+            # swap the last point into the hole
+            self.n_ -= 1
+            self.pts_[i] = self.pts_[self.n_]
+
+    remove = discard
+
+    def add_points(self, pts):
+        """ Add the rows of an (N,2) array that are not in the set yet """
+        pts = np.asarray(pts, dtype=np.int32).reshape(-1, 2)
+        keys = point_keys(pts)
+        _, first = np.unique(keys, return_index=True)
+        first.sort()
+        new = first[~np.in1d(keys[first], point_keys(self.points()))]
+        self.reserve_(self.n_ + len(new))
+        self.pts_[self.n_:self.n_ + len(new)] = pts[new]
+        self.n_ += len(new)
+
+    def remove_points(self, pts):
+        """ Remove the rows of an (N,2) array from the set """
+        keep = ~np.in1d(point_keys(self.points()), point_keys(pts))
+        kept = self.points()[keep]
+        self.n_ = len(kept)
+        self.pts_[:self.n_] = kept
+
     def points(self):
-        pts = []
-        for x,v in self.xs_.iteritems():
-            for y in v:
-                pts.append(np.array([x,y]))
-        return pts
+        """ Return the (N,2) points. This is a view, valid until the set
+        changes """
+        return self.pts_[:self.n_]
+
+    def in_rect(self, lo, hi):
+        """ Return the points with lo <= point <= hi """
+        pts = self.points()
+        mask = ((pts[:,0] >= lo[0]) & (pts[:,0] <= hi[0]) &
+                (pts[:,1] >= lo[1]) & (pts[:,1] <= hi[1]))
+        return pts[mask]
+
+    def in_radius(self, pt, radius):
+        """ Return the points within radius of pt """
+        d = self.points() - np.asarray(pt, dtype=np.int32)[:2]
+        d2 = (d.astype(np.int64) ** 2).sum(axis=1)
+        return self.points()[d2 <= radius * radius]
+
+class PointGrid(object):
+    """ Uniform grid over integer image points for radius and rectangle
+    queries. Each point maps to the set of values (e.g. annotation ids)
+    added at it """
+    def __init__(self, cell=32):
+        self.cell_ = cell
+        self.cells_ = defaultdict(dict)
+
+    def __len__(self):
+        return sum(len(c) for c in self.cells_.itervalues())
+
+    def key_(self, x, y):
+        return (int(x) // self.cell_, int(y) // self.cell_)
+
+    def add(self, pt, value=None):
+        x, y = int(pt[0]), int(pt[1])
+        self.cells_[self.key_(x, y)].setdefault((x, y), set()).add(value)
+
+    def remove(self, pt, value=None):
+        x, y = int(pt[0]), int(pt[1])
+        key = self.key_(x, y)
+        cell = self.cells_.get(key)
+        if cell is None or (x, y) not in cell:
+            return
+        values = cell[(x, y)]
+        values.discard(value)
+        if not values:
+            del cell[(x, y)]
+            if not cell:
+                del self.cells_[key]
+
+    def clear(self):
+        self.cells_.clear()
+
+    def in_rect(self, lo, hi):
+        """ Return the (point, values) pairs with lo <= point <= hi """
+        x0, y0 = self.key_(lo[0], lo[1])
+        x1, y1 = self.key_(hi[0], hi[1])
+        found = []
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = self.cells_.get((cx, cy))
+                if cell is None:
+                    continue
+                for p, values in cell.iteritems():
+                    if lo[0] <= p[0] <= hi[0] and lo[1] <= p[1] <= hi[1]:
+                        found.append((p, values))
+        return found
+
+    def nearest(self, pt, radius):
+        """ Return the (point, values) pair nearest to pt within radius, or
+        None """
+        best = None
+        best_d2 = radius * radius
+        lo = (pt[0] - radius, pt[1] - radius)
+        hi = (pt[0] + radius, pt[1] + radius)
+        for p, values in self.in_rect(lo, hi):
+            d2 = (p[0] - pt[0]) ** 2 + (p[1] - pt[1]) ** 2
+            if d2 <= best_d2:
+                best = (p, values)
+                best_d2 = d2
+        return best
 
 class ImageAnnotationModel(object):
     def __init__(self):
@@ -59,46 +224,376 @@ class Correspondence(object):
     def __eq__(self, o):
         return np.all(self.pts_ == o.pts_)
 
-def gen_pairs(images, skip, offset=0):
-    pairs = []
-    count = len(images)
-    left = offset
-    right = offset + skip
-    while right < count:
-        pairs.append((images[left],images[right]))
-        left = right
-        right += skip
-    return pairs
+def corr_ends(rows):
+    """ Return the a and b ends of (N,4) correspondence rows """
+    rows = np.asarray(rows).reshape(-1, 4)
+    return rows[:,0:2], rows[:,2:4]
+
+def corr_row(c):
+    """ Return correspondence c as an ax, ay, bx, by int32 row """
+    return np.array([c[0][0], c[0][1], c[1][0], c[1][1]], dtype=np.int32)
+
+class CorrespondenceSet(object):
+    """ Correspondences of one image pair, stored as rows of a growable (N,4)
+    int32 array of ax, ay, bx, by. Every row has an id that stays valid
+    until the row is removed """
+    def __init__(self, rows=None):
+        self.rows_ = np.empty((16, 4), dtype=np.int32)
+        self.ids_ = np.empty(16, dtype=np.int64)
+        self.n_ = 0
+        self.next_id_ = 0
+        self.row_of_ = {}
+        if rows is not None:
+            self.add_rows(rows)
+
+    def __len__(self):
+        return self.n_
+
+    def __iter__(self):
+        # (2,2) copies, so the set can change while iterating
+        for c in self.rows().reshape(-1, 2, 2).copy():
+            yield c
+
+    def __contains__(self, c):
+        return self.find_(corr_row(c)) >= 0
+
+    def find_(self, row):
+        hits = np.flatnonzero((self.rows() == row).all(axis=1))
+        return hits[0] if len(hits) else -1
+
+    def reserve_(self, n):
+        if n > len(self.rows_):
+            cap = max(n, 2 * len(self.rows_))
+            rows = np.empty((cap, 4), dtype=np.int32)
+            rows[:self.n_] = self.rows_[:self.n_]
+            ids = np.empty(cap, dtype=np.int64)
+            ids[:self.n_] = self.ids_[:self.n_]
+            self.rows_ = rows
+            self.ids_ = ids
+
+    def append_(self, rows):
+        n = len(rows)
+        self.reserve_(self.n_ + n)
+        ids = np.arange(self.next_id_, self.next_id_ + n)
+        self.rows_[self.n_:self.n_ + n] = rows
+        self.ids_[self.n_:self.n_ + n] = ids
+        self.row_of_.update(zip(ids.tolist(), range(self.n_, self.n_ + n)))
+        self.n_ += n
+        self.next_id_ += n
+        return ids
+
+    def add(self, c):
+        """ Add c, returning its id (the existing id if c is present) """
+        row = corr_row(c)
+        i = self.find_(row)
+        if i >= 0:
+            return int(self.ids_[i])
+        return int(self.append_(row.reshape(1, 4))[0])
+
+    def append(self, rows):
+        """ Add the rows of an (N,4) array known not to be present,
+        returning their ids """
+        return self.append_(np.asarray(rows, dtype=np.int32).reshape(-1, 4))
+
+    def add_rows(self, rows):
+        """ Add the rows of an (N,4) array that are not present yet,
+        returning the ids of the added rows """
+        rows = np.asarray(rows, dtype=np.int32).reshape(-1, 4)
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64)
+        both = np.concatenate([self.rows(), rows])
+        _, first = np.unique(both, axis=0, return_index=True)
+        new = np.sort(first[first >= self.n_]) - self.n_
+        return self.append_(rows[new])
+
+    def remove_id(self, cid):
+        """ Remove the row with id cid, moving the last row into its place """
+        i = self.row_of_.pop(cid)
+        self.n_ -= 1
+        if i != self.n_:
+            self.rows_[i] = self.rows_[self.n_]
+            self.ids_[i] = self.ids_[self.n_]
+            self.row_of_[int(self.ids_[i])] = i
+
+    def position(self, cid):
+        """ Return the index in rows() of the row with id cid """
+        return self.row_of_[cid]
+
+    def discard(self, c):
+        i = self.find_(corr_row(c))
+        if i >= 0:
+            self.remove_id(int(self.ids_[i]))
+
+    def remove_rows(self, rows):
+        """ Remove the rows of an (N,4) array that are present, keeping the
+        order of the rest """
+        rows = np.asarray(rows, dtype=np.int32).reshape(-1, 4)
+        if len(rows) == 0 or self.n_ == 0:
+            return
+        both = np.concatenate([self.rows(), rows])
+        _, inv = np.unique(both, axis=0, return_inverse=True)
+        keep = ~np.in1d(inv[:self.n_], inv[self.n_:])
+        kept_rows = self.rows()[keep]
+        kept_ids = self.ids()[keep]
+        self.n_ = len(kept_rows)
+        self.rows_[:self.n_] = kept_rows
+        self.ids_[:self.n_] = kept_ids
+        self.row_of_ = dict(zip(kept_ids.tolist(), range(self.n_)))
+
+    def rows(self):
+        """ Return the (N,4) rows. This is a view, valid until the set
+        changes """
+        return self.rows_[:self.n_]
+
+    def ids(self):
+        return self.ids_[:self.n_]
+
+class PairSequence(object):
+    """ Pairs of images skip apart, each pair starting at the image the
+    previous one ended on, as a read-only sequence computed on demand """
+    def __init__(self, images, skip, offset=0):
+        self.images = images
+        self.skip = skip
+        self.offset = offset
+
+    def __len__(self):
+        if self.skip <= 0:
+            return 0
+        return max(0, (len(self.images) - 1 - self.offset) // self.skip)
+
+    def __getitem__(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("pair index out of range")
+        left = self.offset + i * self.skip
+        return (self.images[left], self.images[left + self.skip])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+class IndexedPairs(object):
+    """ Image pairs given by an (P,2) array of indices into images """
+    def __init__(self, images, index):
+        self.images = images
+        self.index_ = index
+        self.extra_ = []
+
+    def __len__(self):
+        return len(self.index_) + len(self.extra_)
+
+    def __getitem__(self, i):
+        a, b = self.row(i)
+        return (self.images[a], self.images[b])
+
+    def row(self, i):
+        """ Return the image indices of pair i """
+        if i < 0:
+            i += len(self)
+        n = len(self.index_)
+        return self.index_[i] if i < n else self.extra_[i - n]
+
+    def extend(self, rows):
+        """ Append (a, b) index rows without copying the existing index """
+        self.extra_.extend(rows)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+class PathTable(object):
+    """ Sequence of pathlib paths over a list of path strings, creating each
+    path on access """
+    def __init__(self, paths):
+        self.paths_ = paths
+
+    def __len__(self):
+        return len(self.paths_)
+
+    def __getitem__(self, i):
+        return pl.Path(self.paths_[i])
+
+    def __iter__(self):
+        for p in self.paths_:
+            yield pl.Path(p)
+
+    def extend(self, paths):
+        self.paths_.extend(str(p) for p in paths)
+
+class LazyIndex(object):
+    """ Position of each item of a sequence, built on the first lookup and
+    extended when the sequence grows """
+    def __init__(self, seq):
+        self.seq_ = seq
+        self.index_ = {}
+        self.count_ = 0
+
+    def get(self, key, default=None):
+        n = len(self.seq_)
+        if self.count_ < n:
+            for i in xrange(self.count_, n):
+                self.index_.setdefault(self.seq_[i], i)
+            self.count_ = n
+        return self.index_.get(key, default)
+
+class PathIndex(object):
+    """ Position of each path of a PathTable. The table is sorted when it
+    comes from a directory index, so paths are binary searched; a table
+    that is not falls back to a LazyIndex """
+    def __init__(self, table):
+        self.table_ = table
+        self.fallback_ = None
+
+    def get(self, key, default=None):
+        paths = self.table_.paths_
+        s = str(key)
+        if paths and isinstance(paths[0], unicode):
+            s = s.decode("utf-8")
+        i = bisect.bisect_left(paths, s)
+        if i < len(paths) and paths[i] == s:
+            return i
+        if self.fallback_ is None:
+            self.fallback_ = LazyIndex(self.table_)
+        return self.fallback_.get(key, default)
+
+def bisect_column(rows, value):
+    """ Return the first row of rows, sorted by their first column, whose
+    first column is not below value, without copying the column """
+    lo, hi = 0, len(rows)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if rows[mid][0] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class PairIndex(object):
+    """ Position of each pair of a PairSequence or IndexedPairs, computed
+    from the positions of its images """
+    def __init__(self, pairs, path_index):
+        self.pairs_ = pairs
+        self.path_index_ = path_index
+
+    def get(self, key, default=None):
+        a = self.path_index_.get(key[0])
+        b = self.path_index_.get(key[1])
+        if a is None or b is None:
+            return default
+        pairs = self.pairs_
+        if isinstance(pairs, PairSequence):
+            i, r = divmod(a - pairs.offset, pairs.skip)
+            if r == 0 and b == a + pairs.skip and 0 <= i < len(pairs):
+                return i
+            return default
+        index = pairs.index_
+        i = bisect_column(index, a)
+        if i < len(index) and index[i][0] == a and index[i][1] == b:
+            return i
+        if len(index):
+            # the pairs of a project are in image order; search them all if not
+            hits = np.flatnonzero((index[:,0] == a) & (index[:,1] == b))
+            if len(hits):
+                return int(hits[0])
+        for j, row in enumerate(pairs.extra_):
+            if tuple(row) == (a, b):
+                return len(index) + j
+        return default
 
 def load_images(d, pat, skip):
     log.debug("loading images from {0}".format(str(d)))
-    dpath = pl.Path(d)
-    assert dpath.exists() and dpath.is_dir()
-    images = sorted(dpath.glob(pat))
-    pairs = gen_pairs(images, skip)
+    index = dirindex.DirectoryIndex(d, pat)
+    images = PathTable(index.paths())
+    pairs = PairSequence(images, skip)
     return images, pairs
 
+def extend_project(proj, paths):
+    """ Append newly arrived images to proj, generating the pairs that
+    continue its pair sequence. Returns the number of pairs added """
+    images = proj['images']
+    pairs = proj['pairs']
+    count = len(pairs)
+    if isinstance(images, PathTable):
+        images.extend(paths)
+    else:
+        images.extend(pl.Path(p) for p in paths)
+    if isinstance(pairs, PairSequence):
+        # the sequence follows its image list
+        return len(pairs) - count
+    skip = proj['skip']
+    if count == 0:
+        left = 0
+    elif isinstance(pairs, IndexedPairs):
+        left = int(pairs.row(count - 1)[1])
+    else:
+        left = LazyIndex(images).get(pairs[-1][1])
+    new = []
+    while skip > 0 and left + skip < len(images):
+        new.append((left, left + skip))
+        left += skip
+    if isinstance(pairs, IndexedPairs):
+        pairs.extend(new)
+    else:
+        pairs.extend((images[a], images[b]) for a, b in new)
+    return len(pairs) - count
+
 def new_correspondence_project(name, image_path, skip, pat="*.png"):
     imgs, pairs = load_images(image_path, pat, skip)
     return {'name': name,
             'image_path': image_path,
             'images': imgs,
-            'kps': defaultdict(set),
+            'kps': defaultdict(PointSet2D),
             'pairs': pairs,
             'skip': skip,
-            'correspondences': defaultdict(set),
+            'correspondences': defaultdict(CorrespondenceSet),
             'pat': pat}
 
 def get_kps(proj, index=None):
-    pair_index = index or proj.get('index',0)
+    pair_index = proj.get('index',0) if index is None else index
     img_pair = proj['pairs'][pair_index]
     return proj['kps'][img_pair[0]], proj['kps'][img_pair[1]]
 
 def get_correspondences(proj, index=None):
-    pair_index = index or proj.get('index',0)
+    pair_index = proj.get('index',0) if index is None else index
     img_pair = proj['pairs'][pair_index]
     return pair_index, proj['correspondences'][img_pair]
 
+def image_ends(proj, pair_index, which):
+    """ Return the (N,2) points that correspondences use on image which (0
+    or 1) of the pair at pair_index, in that pair and in the neighbouring
+    pairs showing the same image """
+    pairs = proj['pairs']
+    img = pairs[pair_index][which]
+    ends = [np.empty((0, 2), dtype=np.int32)]
+    for i in xrange(max(pair_index - 1, 0), min(pair_index + 2, len(pairs))):
+        pair = pairs[i]
+        rows = corr_rows(proj['correspondences'], pair)
+        ends.extend(e for side, e in enumerate(corr_ends(rows)) if pair[side] == img)
+    return np.concatenate(ends)
+
+def apply_correspondence(proj, pair_index, c, add=True):
+    """ Add (or remove) correspondence c and its keypoints in the pair at
+    pair_index """
+    img_pair = proj['pairs'][pair_index]
+    corrs = proj['correspondences'][img_pair]
+    akps = proj['kps'][img_pair[0]]
+    bkps = proj['kps'][img_pair[1]]
+    mark_edited(proj, pair_index)
+    if add:
+        corrs.add(c)
+        akps.add(tuple(c[0]))
+        bkps.add(tuple(c[1]))
+    else:
+        corrs.discard(c)
+        # keep the keypoints other correspondences still use, here or in
+        # the neighbouring pair sharing the image
+        for which, (kps, pt) in enumerate(zip((akps, bkps), c)):
+            pt = tuple(pt)
+            if not (image_ends(proj, pair_index, which) == pt).all(axis=1).any():
+                kps.discard(pt)
+
 def corr_filename(basedir, left, right):
     """ Return the correspondence filename given the basedir and left/right
     image filenames """
@@ -107,22 +602,303 @@ def corr_filename(basedir, left, right):
     filename = "correspondences_{0}_{1}.csv".format(leftid,rightid)
     return basedir / filename
 
+def format_rows(rows):
+    """ Return (N,4) rows as comma separated lines, formatted in one step """
+    rows = np.asarray(rows).reshape(-1, 4)
+    return ("%d,%d,%d,%d\n" * len(rows)) % tuple(rows.ravel().tolist())
+
+def write_correspondence_file(filename, rows):
+    with open(str(filename), "w") as f:
+        f.write(format_rows(rows))
+
 def write_correspondences(corrs, basedir = pl.Path(".")):
     for k,v in corrs.iteritems():
         left, right = k
         filename = corr_filename(basedir, left, right)
-        # correspondences should be Nx4 matrix for N correspondences
-        np.savetxt(str(filename), v, fmt='%d', delimeter=',')
+        write_correspondence_file(filename, v.rows())
+
+def parse_rows(text):
+    """ Parse comma separated integer rows of 4 into an (N,4) int32 array.
+    Raises ValueError on a malformed or truncated text """
+    text = text.replace(",", " ")
+    values = np.fromstring(text, dtype=np.int32, sep=" ")
+    # fromstring stops quietly at the first bad token
+    count = len(text.split())
+    if len(values) != count or count % 4:
+        raise ValueError("expected rows of 4 integers, parsed {0} of {1} values"
+                         .format(len(values), count))
+    return values.reshape(-1, 4)
 
 def read_correspondences(path):
-    C = np.loadtxt(str(path), dtype=np.int32, delimeter=',')
-    return C
+    with open(str(path), "r") as f:
+        return parse_rows(f.read())
+
+def read_correspondences_or_none(path):
+    try:
+        return read_correspondences(path)
+    except IOError:
+        return None
+    except ValueError as e:
+        log.warning("skipping {0}: {1}".format(str(path), e))
+        return None
+
+def load_correspondence_files(proj, basedir, workers=LOAD_WORKERS, progress=None):
+    """ Read the correspondence file of every pair of proj from basedir on a
+    pool of threads. Pairs without a file get no correspondences.
+    progress(done, total) is called as files are read. Returns the
+    correspondences and the number of missing files """
+    pairs = proj['pairs']
+    total = len(pairs)
+    filenames = (corr_filename(basedir, a, b) for a, b in pairs)
+    corrs = defaultdict(CorrespondenceSet)
+    missing = 0
+    pool = ThreadPool(workers)
+    try:
+        # imap keeps the pair order, so results line up with pairs
+        for i, C in enumerate(pool.imap(read_correspondences_or_none, filenames, 64)):
+            if C is None:
+                missing += 1
+            elif len(C):
+                corrs[pairs[i]] = CorrespondenceSet(C)
+            if progress is not None and (i + 1) % 1000 == 0:
+                progress(i + 1, total)
+    finally:
+        pool.close()
+        pool.join()
+    if progress is not None:
+        progress(total, total)
+    if missing:
+        log.warning("{0} of {1} pairs have no correspondence file".format(missing, total))
+    return corrs, missing
+
+def correspondence_counts(proj):
+    """ Return the number of correspondences of every pair """
+    corrs = proj['correspondences']
+    if isinstance(corrs, LazyGroups):
+        counts = np.zeros(len(proj['pairs']), dtype=np.int64)
+        stored = np.diff(corrs.projfile.corr_idx)
+        # pairs added since the file was written have none stored
+        counts[:len(stored)] = stored
+        for k, v in corrs.iteritems():
+            counts[corrs.key_index_.get(k)] = len(v)
+        return counts
+    return np.array([len(corrs.get(p, ())) for p in proj['pairs']],
+                    dtype=np.int64)
+
+class LazyGroups(dict):
+    """ Per-key groups that are built from a ProjectFile the first time a
+    key is accessed. Keys that are not in the file start as empty groups,
+    like a defaultdict """
+    def __init__(self, projfile, key_index, rows, make_group):
+        super(LazyGroups,self).__init__()
+        self.projfile = projfile
+        self.key_index_ = key_index
+        self.rows_ = rows
+        self.make_group_ = make_group
+        self.edited_ = set()
+
+    def __missing__(self, key):
+        group = self.make_group_(self.rows(key))
+        self[key] = group
+        return group
+
+    def rows(self, key):
+        """ Return the group of key if it was loaded, otherwise its stored
+        rows without loading it """
+        if key in self:
+            return dict.__getitem__(self, key)
+        i = self.key_index_.get(key)
+        if i is None:
+            return []
+        return self.rows_(i)
+
+    def mark_edited(self, key):
+        self.edited_.add(key)
+
+    def evict(self, keep):
+        """ Drop the loaded groups whose keys are not in keep, unless they
+        were edited since the file was written """
+        for key in [k for k in self.iterkeys()
+                    if k not in keep and k not in self.edited_]:
+            del self[key]
+
+    def rebind(self, projfile, rows):
+        """ Read from projfile, just written with every loaded group """
+        self.projfile = projfile
+        self.rows_ = rows
+        self.edited_.clear()
+
+def corr_rows(corrs, key):
+    if isinstance(corrs, LazyGroups):
+        rows = corrs.rows(key)
+    else:
+        rows = corrs.get(key, [])
+    if isinstance(rows, CorrespondenceSet):
+        return rows.rows()
+    return np.asarray(rows, dtype=np.int32).reshape(-1, 4)
+
+def kp_rows(kps, key):
+    if isinstance(kps, LazyGroups):
+        rows = kps.rows(key)
+    else:
+        rows = kps.get(key, [])
+    if isinstance(rows, PointSet2D):
+        return rows.points()
+    return np.asarray(list(rows), dtype=np.int32).reshape(-1, 2)
+
+def project_meta(proj):
+    return {'name': unicode(proj['name']),
+            'image_path': str(proj['image_path']).decode("utf-8"),
+            'skip': proj['skip'],
+            'pat': proj.get('pat', "*.png"),
+            'index': proj.get('index', 0)}
+
+def mark_edited(proj, pair_index):
+    """ Record that the groups of a pair changed since the project was
+    written, so they are kept in memory and their shards rewritten """
+    pair = proj['pairs'][pair_index]
+    corrs = proj.get('correspondences')
+    kps = proj.get('kps')
+    if isinstance(corrs, LazyGroups):
+        corrs.mark_edited(pair)
+    if isinstance(kps, LazyGroups):
+        for p in pair:
+            kps.mark_edited(p)
+
+def edited_shards(proj, filename, owner, size):
+    """ Return the shards of filename holding groups of proj that changed
+    since proj was read from it, or None if every shard must be written """
+    corrs = proj.get('correspondences')
+    kps = proj.get('kps')
+    if not isinstance(corrs, LazyGroups) or not isinstance(kps, LazyGroups):
+        return None
+    store = corrs.projfile
+    if (not shards.is_sharded(store) or store.shard_size != size or
+        os.path.abspath(store.filename) != os.path.abspath(str(filename))):
+        return None
+    # the last stored shard and those after it when pairs were added
+    stored = len(store.pairs)
+    dirty = set(xrange(stored // size, shards.shard_count(len(proj['pairs']), size)))
+    for key in corrs.edited_:
+        i = corrs.key_index_.get(key)
+        if i is not None:
+            dirty.add(i // size)
+    for key in kps.edited_:
+        i = kps.key_index_.get(key)
+        if i is not None and i < len(owner):
+            dirty.add(max(owner[i], 0) // size)
+    return dirty
+
+def write_project(proj, filename, shard_size=shards.SHARD_SIZE):
+    """ Write proj as a sharded project. When proj was read from filename
+    only the shards holding edited groups are written again. Groups of a
+    lazily loaded project that were never touched are copied from its
+    file """
+    images = list(proj['images'])
+    path_index = dict((p, i) for i, p in enumerate(images))
+    for pair in proj['pairs']:
+        for p in pair:
+            if p not in path_index:
+                path_index[p] = len(images)
+                images.append(p)
+    pairs = np.array([(path_index[a], path_index[b]) for a, b in proj['pairs']],
+                     dtype=np.int32).reshape(-1, 2)
+    corrs = proj.get('correspondences', {})
+    kps = proj.get('kps', {})
+    count = shards.shard_count(len(pairs), shard_size)
+    owner = shards.image_owners(pairs, len(images))
+    owned = shards.images_by_shard(owner, shard_size, count)
+    dirty = edited_shards(proj, filename, owner, shard_size)
+    if dirty is None:
+        generation = shards.next_generation(filename)
+        kept = []
+    else:
+        generation = corrs.projfile.generation + 1
+        kept = corrs.projfile.shard_files
+    names = []
+    for k in xrange(count):
+        if dirty is not None and k not in dirty and k < len(kept):
+            names.append(kept[k])
+            continue
+        first = k * shard_size
+        stop = min(len(pairs), first + shard_size)
+        names.append(shards.write_shard(
+            filename, k, shard_size, generation,
+            [corr_rows(corrs, proj['pairs'][i]) for i in xrange(first, stop)],
+            owned[k], [kp_rows(kps, images[i]) for i in owned[k]]))
+    log.debug("wrote %d of %d shards", count if dirty is None else len(dirty), count)
+    # the new shards are only used once the manifest naming them is in place
+    shards.write_manifest(filename, project_meta(proj),
+                          [str(p).decode("utf-8") for p in images], pairs,
+                          correspondence_counts(proj), shard_size, generation, names)
+    shards.remove_unused_shards(filename, names)
+    if isinstance(corrs, LazyGroups) and isinstance(kps, LazyGroups):
+        store = shards.open_store(filename)
+        corrs.rebind(store, store.corrs)
+        kps.rebind(store, store.kps)
+
+def evict_far_groups(proj, index, window=shards.WINDOW_SHARDS):
+    """ Drop the loaded groups of a sharded project outside the shards
+    around pair index, except those edited since it was written """
+    corrs = proj['correspondences']
+    kps = proj['kps']
+    if not isinstance(corrs, LazyGroups) or not shards.is_sharded(corrs.projfile):
+        return
+    size = corrs.projfile.shard_size
+    pairs = proj['pairs']
+    k = index // size
+    near = [pairs[i] for i in xrange(max(0, (k - window) * size),
+                                     min(len(pairs), (k + window + 1) * size))]
+    corrs.evict(set(near))
+    if isinstance(kps, LazyGroups):
+        kps.evict(set(p for pair in near for p in pair))
+
+def open_project(filename):
+    """ Open a project file, sharded or not. Only the meta and path table
+    are read; keypoints and correspondences are loaded per key on first
+    access """
+    f = shards.open_store(filename)
+    meta = f.meta
+    images = PathTable(f.paths)
+    pairs = IndexedPairs(images, f.pairs)
+    path_index = PathIndex(images)
+    pair_index = PairIndex(pairs, path_index)
+    return {'name': meta['name'],
+            'image_path': pl.Path(meta['image_path']),
+            'images': images,
+            'kps': LazyGroups(f, path_index, f.kps, PointSet2D),
+            'pairs': pairs,
+            'skip': meta['skip'],
+            'correspondences': LazyGroups(f, pair_index, f.corrs, CorrespondenceSet),
+            'pat': meta.get('pat', "*.png"),
+            'index': meta.get('index', 0)}
+
+def load_pickled_project(filename):
+    with open(str(filename),"r") as f:
+        proj = pkl.load(f)
+    # pickled projects keep keypoints as sets of tuples and correspondences
+    # as sets of Correspondence objects
+    kps = defaultdict(PointSet2D)
+    for k, v in proj.get('kps', {}).iteritems():
+        kps[k] = PointSet2D(list(v))
+    proj['kps'] = kps
+    corrs = defaultdict(CorrespondenceSet)
+    for k, v in proj.get('correspondences', {}).iteritems():
+        corrs[k] = CorrespondenceSet([corr_row(c) for c in v])
+    proj['correspondences'] = corrs
+    return proj
+
+def convert_pickled_project(src, dst=None):
+    """ Convert a pickled project to the columnar format. The converted file
+    replaces src unless dst is given """
+    proj = load_pickled_project(src)
+    write_project(proj, dst or src)
+    return dst or src
 
 def save_correspondence_project(proj, filename, save_all_corrs=False):
     savepath = pl.Path(filename)
     if savepath.parent.exists():
-        with open(str(savepath),"w") as f:
-            pkl.dump(proj, f)
+        write_project(proj, savepath)
         if save_all_corrs:
             if 'correspondences' in proj:
                 corrs = proj['correspondences']
@@ -130,19 +906,18 @@ def save_correspondence_project(proj, filename, save_all_corrs=False):
     else:
         raise IOError("Cannot save to " + filename + ", since the parent doesn't exist")
 
-def load_correspondence_project(filename, load_all_corrs=False):
+def load_correspondence_project(filename, load_all_corrs=False, progress=None):
     loadpath = pl.Path(filename)
     if loadpath.exists():
-        with open(str(loadpath),"r") as f:
-            proj = pkl.load(f)        
+        if pf.is_project_file(loadpath):
+            proj = open_project(loadpath)
+        else:
+            # pickled projects are written in the columnar format on save
+            log.info("loading pickled project {0}".format(str(loadpath)))
+            proj = load_pickled_project(loadpath)
         if load_all_corrs:
-            basedir = loadpath.parent
-            #corr_paths = sorted(basedir.glob("*.csv"))
-            corrs = {}
-            for img_pair in proj['pairs']:
-                filename = corr_filename(basedir, img_pair[0], img_pair[1])
-                C = read_correspondences(filename)
-                corrs[img_pair] = C
+            corrs, missing = load_correspondence_files(proj, loadpath.parent,
+                                                       progress=progress)
             proj['correspondences'] = corrs
         return proj
     else:
@@ -0,0 +1,136 @@
+""" Columnar on-disk project format.
+
+A project file is a fixed-size header followed by aligned sections:
+
+  meta      json object with the scalar project fields
+  paths     newline separated utf-8 image paths (the path table)
+  pairs     int32 (P,2) path table indices of each image pair
+  corr_idx  int64 (P+1) row offsets of each pair's correspondences
+  corrs     int32 (M,4) correspondences as ax, ay, bx, by
+  kp_idx    int64 (I+1) row offsets of each image's keypoints
+  kps       int32 (K,2) keypoints as x, y
+
+The array sections are memory-mapped on open, so opening a project only
+reads the header, meta and path table; a pair's rows are paged in when they
+are first touched.
+"""
+import os
+import json
+import struct
+import logging
+import numpy as np
+
+log = logging.getLogger("pyimgann.projfile")
+log.setLevel(logging.DEBUG)
+
+MAGIC = b"PYIMGANN"
+VERSION = 1
+SECTIONS = ['meta', 'paths', 'pairs', 'corr_idx', 'corrs', 'kp_idx', 'kps']
+# magic, version, section count, then (offset, nbytes) per section
+HEADER = struct.Struct("<8sII" + "QQ" * len(SECTIONS))
+ALIGN = 64
+
+def is_project_file(filename):
+    """ Return True if filename starts with the columnar project magic """
+    with open(str(filename), "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def group_rows(groups, width):
+    """ Concatenate a list of (N,width) arrays, returning the int32 rows and
+    the int64 offset index into them """
+    counts = np.array([len(g) for g in groups], dtype=np.int64)
+    index = np.zeros(len(groups) + 1, dtype=np.int64)
+    np.cumsum(counts, out=index[1:])
+    nonempty = [np.asarray(g, dtype=np.int32).reshape(-1, width)
+                for g in groups if len(g) > 0]
+    if nonempty:
+        rows = np.concatenate(nonempty)
+    else:
+        rows = np.empty((0, width), dtype=np.int32)
+    return rows, index
+
+def write_project_file(filename, meta, paths, pairs, corr_groups, kp_groups,
+                       corr_idx=None):
+    """ Write a project file. pairs is a (P,2) array of path indices,
+    corr_groups a list of P (N,4) arrays and kp_groups a list of len(paths)
+    (N,2) arrays. A corr_idx given with no corr_groups is written as is,
+    for files that index rows stored elsewhere. The file is written next to
+    filename and renamed into place, so an open mapping of the old file
+    stays valid. """
+    if corr_idx is None:
+        corrs, corr_idx = group_rows(corr_groups, 4)
+    else:
+        corrs = np.empty((0, 4), dtype=np.int32)
+        corr_idx = np.asarray(corr_idx, dtype=np.int64)
+    kps, kp_idx = group_rows(kp_groups, 2)
+    blobs = [json.dumps(meta).encode("utf-8"),
+             u"\n".join(paths).encode("utf-8"),
+             np.asarray(pairs, dtype=np.int32).reshape(-1, 2).tobytes(),
+             corr_idx.tobytes(), corrs.tobytes(),
+             kp_idx.tobytes(), kps.tobytes()]
+    table = []
+    pos = HEADER.size
+    for b in blobs:
+        pos += -pos % ALIGN
+        table.extend([pos, len(b)])
+        pos += len(b)
+    tmpname = str(filename) + ".tmp"
+    with open(tmpname, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(SECTIONS), *table))
+        for i, b in enumerate(blobs):
+            f.seek(table[2 * i])
+            f.write(b)
+    os.rename(tmpname, str(filename))
+
+class ProjectFile(object):
+    """ Read-only view of a project file with memory-mapped arrays """
+    def __init__(self, filename):
+        self.filename = str(filename)
+        with open(self.filename, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise IOError("Not a project file: " + self.filename)
+            fields = HEADER.unpack(header)
+            version, count = fields[1], fields[2]
+            if version != VERSION or count != len(SECTIONS):
+                raise IOError("Unsupported project file version {0}: {1}"
+                              .format(version, self.filename))
+            self.sections_ = dict(zip(SECTIONS, zip(fields[3::2], fields[4::2])))
+            self.meta = json.loads(self.read_(f, 'meta').decode("utf-8"))
+            paths = self.read_(f, 'paths').decode("utf-8")
+            self.paths = paths.split(u"\n") if paths else []
+        self.pairs = self.map_('pairs', np.int32, 2)
+        self.corr_idx = self.map_('corr_idx', np.int64)
+        self.corr_rows = self.map_('corrs', np.int32, 4)
+        self.kp_idx = self.map_('kp_idx', np.int64)
+        self.kp_rows = self.map_('kps', np.int32, 2)
+
+    def read_(self, f, name):
+        offset, nbytes = self.sections_[name]
+        f.seek(offset)
+        return f.read(nbytes)
+
+    def map_(self, name, dtype, width=None):
+        offset, nbytes = self.sections_[name]
+        count = nbytes // np.dtype(dtype).itemsize
+        if count == 0:
+            arr = np.empty(0, dtype=dtype)
+        else:
+            arr = np.memmap(self.filename, dtype=dtype, mode="r",
+                            offset=offset, shape=(count,))
+        if width is not None:
+            arr = arr.reshape(-1, width)
+        return arr
+
+    def corrs(self, pair_index):
+        """ Return the (N,4) correspondence rows of a pair. Pairs added to
+        the project since the file was written have none """
+        if pair_index >= len(self.corr_idx) - 1:
+            return np.empty((0, 4), dtype=np.int32)
+        return self.corr_rows[self.corr_idx[pair_index]:self.corr_idx[pair_index+1]]
+
+    def kps(self, path_index):
+        """ Return the (N,2) keypoint rows of an image """
+        if path_index >= len(self.kp_idx) - 1:
+            return np.empty((0, 2), dtype=np.int32)
+        return self.kp_rows[self.kp_idx[path_index]:self.kp_idx[path_index+1]]
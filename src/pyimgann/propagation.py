@@ -0,0 +1,208 @@
+""" Propagation of correspondences along the pair sequence by optical flow.
+
+Consecutive pairs share an image. The correspondence ends on the shared
+image are tracked into the next pair's other image with pyramidal
+Lucas-Kanade, keeping only the points that track back to where they
+started. Tracks are computed in a background thread and cached on disk per
+(source, target) image pair, so points already tracked are never tracked
+again and the gui only ever reads the cache.
+"""
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+import pyimgann.cache as cache
+import pyimgann.model as mdl
+
+log = logging.getLogger("pyimgann.propagation")
+log.setLevel(logging.DEBUG)
+
+FLOW_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, "flow")
+DEFAULT_PARAMS = {'window': 21,
+                  'levels': 3,
+                  # largest forward-backward error of a kept track, in pixels
+                  'fb_px': 1.0}
+# track tables of image pairs kept in memory
+TRACK_CACHE_SIZE = 32
+# requests waiting for the worker; older ones are dropped
+PENDING_REQUESTS = 4
+
+def shared_image(pair, next_pair):
+    """ Return the sides (0 or 1) of pair and next_pair showing the image
+    they share, or None """
+    for s in (1, 0):
+        for t in (0, 1):
+            if pair[s] == next_pair[t]:
+                return s, t
+    return None
+
+def track_points(src, dst, pts, params=DEFAULT_PARAMS):
+    """ Return the (N,2) float32 positions in dst of the (N,2) points of
+    src, and a mask of the points tracked reliably """
+    p0 = np.asarray(pts, dtype=np.float32).reshape(-1, 1, 2)
+    lk = dict(winSize=(params['window'], params['window']),
+              maxLevel=params['levels'],
+              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+    p1, st, _ = cv2.calcOpticalFlowPyrLK(src, dst, p0, None, **lk)
+    back, st_back, _ = cv2.calcOpticalFlowPyrLK(dst, src, p1, None, **lk)
+    fb = np.abs(back - p0).reshape(-1, 2).max(axis=1)
+    p1 = p1.reshape(-1, 2)
+    h, w = dst.shape[:2]
+    ok = ((st.ravel() == 1) & (st_back.ravel() == 1) & (fb <= params['fb_px']) &
+          (p1[:,0] >= 0) & (p1[:,1] >= 0) & (p1[:,0] < w) & (p1[:,1] < h))
+    return p1, ok
+
+class Tracks(object):
+    """ Points of a source image tracked into a target image """
+    def __init__(self, src=None, dst=None, ok=None):
+        self.src = np.empty((0, 2), dtype=np.int32) if src is None else src
+        self.dst = np.empty((0, 2), dtype=np.float32) if dst is None else dst
+        self.ok = np.empty(0, dtype=bool) if ok is None else ok
+
+    def missing(self, pts):
+        """ Return the points of pts that were never tracked """
+        return pts[~np.in1d(mdl.point_keys(pts), mdl.point_keys(self.src))]
+
+    def lookup(self, pts):
+        """ Return the tracked positions of pts and a mask of those found and
+        tracked reliably """
+        dst = np.zeros((len(pts), 2), dtype=np.float32)
+        ok = np.zeros(len(pts), dtype=bool)
+        if len(self.src) == 0:
+            return dst, ok
+        keys = mdl.point_keys(self.src)
+        order = np.argsort(keys)
+        want = mdl.point_keys(pts)
+        pos = np.minimum(np.searchsorted(keys[order], want), len(keys) - 1)
+        i = order[pos]
+        found = keys[i] == want
+        dst[found] = self.dst[i[found]]
+        ok[found] = self.ok[i[found]]
+        return dst, ok
+
+    def merged(self, src, dst, ok):
+        return Tracks(np.concatenate([self.src, src]),
+                      np.concatenate([self.dst, dst]),
+                      np.concatenate([self.ok, ok]))
+
+class PropagationEngine(object):
+    """ Tracks correspondence ends into the next pair in a background
+    thread, caching the tracks of each image pair """
+    def __init__(self, cache_dir=FLOW_DIR, params=DEFAULT_PARAMS):
+        self.cache_dir_ = cache_dir
+        self.params_ = dict(params)
+        self.tracks_ = OrderedDict()
+        self.lock_ = threading.Lock()
+        self.cond_ = threading.Condition(self.lock_)
+        self.pending_ = OrderedDict()
+        self.closed_ = False
+        self.thread_ = threading.Thread(target=self.run_)
+        self.thread_.daemon = True
+        self.thread_.start()
+
+    def filename_(self, src, dst):
+        ident = repr((cache.file_key(src), cache.file_key(dst),
+                      sorted(self.params_.items())))
+        return os.path.join(self.cache_dir_, hashlib.sha1(ident).hexdigest() + ".npz")
+
+    def tracks_of_(self, src, dst):
+        try:
+            fn = self.filename_(src, dst)
+        except OSError:
+            return Tracks()
+        with self.lock_:
+            t = self.tracks_.pop(fn, None)
+            if t is not None:
+                self.tracks_[fn] = t
+                return t
+        try:
+            with np.load(fn) as f:
+                t = Tracks(f['src'], f['dst'], f['ok'])
+        except (IOError, OSError, ValueError, KeyError):
+            t = Tracks()
+        self.remember_(fn, t)
+        return t
+
+    def remember_(self, fn, t):
+        with self.lock_:
+            self.tracks_.pop(fn, None)
+            self.tracks_[fn] = t
+            while len(self.tracks_) > TRACK_CACHE_SIZE:
+                self.tracks_.popitem(last=False)
+
+    def get(self, src, dst, pts):
+        """ Return the cached positions in image dst of the (N,2) points
+        of image src, and a mask of the points tracked reliably. Points not
+        tracked yet are masked out """
+        pts = np.asarray(pts, dtype=np.int32).reshape(-1, 2)
+        return self.tracks_of_(src, dst).lookup(pts)
+
+    def tracked(self, src, dst, pts):
+        """ Return whether every point of pts was tracked from src to dst """
+        pts = np.asarray(pts, dtype=np.int32).reshape(-1, 2)
+        return len(self.tracks_of_(src, dst).missing(pts)) == 0
+
+    def track(self, src, dst, pts):
+        """ Track the points of pts that were not tracked yet, and cache
+        them. Returns False if an image could not be read """
+        pts = np.asarray(pts, dtype=np.int32).reshape(-1, 2)
+        t = self.tracks_of_(src, dst)
+        todo = t.missing(pts)
+        if len(todo) == 0:
+            return True
+        a = cv2.imread(str(src), 0)
+        b = cv2.imread(str(dst), 0)
+        if a is None or b is None:
+            # missing or still being written; tried again on the next request
+            log.warning("cannot read {0} or {1}".format(str(src), str(dst)))
+            return False
+        p1, ok = track_points(a, b, todo, self.params_)
+        t = t.merged(todo, p1, ok)
+        fn = self.filename_(src, dst)
+        self.remember_(fn, t)
+        try:
+            if not os.path.isdir(self.cache_dir_):
+                os.makedirs(self.cache_dir_)
+            tmpname = fn + ".tmp"
+            with open(tmpname, "wb") as f:
+                np.savez(f, src=t.src, dst=t.dst, ok=t.ok)
+            os.rename(tmpname, fn)
+        except (IOError, OSError):
+            log.exception("failed to cache the tracks of {0}".format(fn))
+        log.debug("tracked %d points, %d reliably", len(todo), ok.sum())
+        return True
+
+    def request(self, key, src, dst, pts, done):
+        """ Track pts from src to dst in the background thread, then call
+        done(key) from it unless the tracks could not be computed. A request
+        replaces the request of the same key that has not started yet """
+        with self.cond_:
+            self.pending_.pop(key, None)
+            self.pending_[key] = (src, dst, np.array(pts, dtype=np.int32), done)
+            while len(self.pending_) > PENDING_REQUESTS:
+                self.pending_.popitem(last=False)
+            self.cond_.notify()
+
+    def run_(self):
+        while True:
+            with self.cond_:
+                while not self.pending_ and not self.closed_:
+                    self.cond_.wait()
+                if self.closed_:
+                    return
+                key, (src, dst, pts, done) = self.pending_.popitem(last=False)
+            try:
+                # done would find the tracks still missing and ask again
+                if self.track(src, dst, pts):
+                    done(key)
+            except Exception:
+                log.exception("failed to propagate to {0}".format(str(dst)))
+
+    def close(self):
+        with self.cond_:
+            self.closed_ = True
+            self.cond_.notify()
+        self.thread_.join()
@@ -0,0 +1,197 @@
+""" Automatic correspondence proposals from matched image features.
+
+ORB features of both images are matched with a ratio test and the matches
+are filtered with a RANSAC fit of the fundamental matrix. Proposals are
+computed in a process pool and cached per pair on disk, keyed by the
+contents of both images and the matching parameters.
+"""
+import os
+import hashlib
+import logging
+import threading
+import multiprocessing
+import numpy as np
+import cv2
+import pyimgann.cache as cache
+
+log = logging.getLogger("pyimgann.proposals")
+log.setLevel(logging.DEBUG)
+
+PROPOSAL_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, "proposals")
+DEFAULT_PARAMS = {'features': 2000,
+                  'ratio': 0.75,
+                  'ransac_px': 3.0,
+                  'min_matches': 8}
+# pairs handed to a worker process at a time
+CHUNK_SIZE = 4
+# chunks per process queued by precompute at a time, bounding the work
+# left to run after a cancel
+QUEUED_CHUNKS = 2
+# seconds close waits for a precompute to stop before terminating the pool
+CLOSE_TIMEOUT = 2.0
+
+def make_orb(n):
+    # OpenCV 3 replaced the ORB constructor with a factory
+    if hasattr(cv2, "ORB_create"):
+        return cv2.ORB_create(nfeatures=n)
+    return cv2.ORB(nfeatures=n)
+
+def match_images(path_a, path_b, params=DEFAULT_PARAMS):
+    """ Return the (N,4) int32 ax, ay, bx, by correspondences proposed for
+    the images at path_a and path_b """
+    empty = np.empty((0, 4), dtype=np.int32)
+    a = cv2.imread(path_a, 0)
+    b = cv2.imread(path_b, 0)
+    if a is None or b is None:
+        return empty
+    orb = make_orb(params['features'])
+    ka, da = orb.detectAndCompute(a, None)
+    kb, db = orb.detectAndCompute(b, None)
+    if da is None or db is None or len(ka) < 2 or len(kb) < 2:
+        return empty
+    knn = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(da, db, k=2)
+    good = [m[0] for m in knn
+            if len(m) == 2 and m[0].distance < params['ratio'] * m[1].distance]
+    if len(good) < params['min_matches']:
+        return empty
+    pa = np.float32([ka[m.queryIdx].pt for m in good])
+    pb = np.float32([kb[m.trainIdx].pt for m in good])
+    F, mask = cv2.findFundamentalMat(pa, pb, cv2.FM_RANSAC,
+                                     params['ransac_px'], 0.99)
+    if mask is None:
+        return empty
+    keep = mask.ravel().astype(bool)
+    rows = np.hstack([pa[keep], pb[keep]])
+    rows = np.round(rows).astype(np.int32)
+    # several features may round to the same pixels
+    _, first = np.unique(rows, axis=0, return_index=True)
+    return rows[np.sort(first)]
+
+def match_job(job):
+    i, path_a, path_b, params = job
+    try:
+        return i, match_images(path_a, path_b, params)
+    except Exception:
+        log.exception("failed to match {0} and {1}".format(path_a, path_b))
+        return i, None
+
+class ProposalEngine(object):
+    """ Computes and caches the proposals of image pairs """
+    def __init__(self, cache_dir=PROPOSAL_DIR, params=DEFAULT_PARAMS,
+                 processes=None):
+        self.cache_dir_ = cache_dir
+        self.params_ = dict(params)
+        self.processes_ = processes or multiprocessing.cpu_count()
+        self.pool_ = None
+        # interactive proposals get a process of their own, so they do not
+        # wait behind a precompute
+        self.interactive_ = None
+        self.thread_ = None
+        self.cancelled_ = None
+
+    def pool_get_(self):
+        if self.pool_ is None:
+            self.pool_ = multiprocessing.Pool(self.processes_)
+        return self.pool_
+
+    def interactive_get_(self):
+        if self.interactive_ is None:
+            self.interactive_ = multiprocessing.Pool(1)
+        return self.interactive_
+
+    def filename_(self, pair):
+        ident = repr((cache.file_key(pair[0]), cache.file_key(pair[1]),
+                      sorted(self.params_.items())))
+        return os.path.join(self.cache_dir_, hashlib.sha1(ident).hexdigest() + ".npy")
+
+    def cached(self, pair):
+        try:
+            return os.path.exists(self.filename_(pair))
+        except OSError:
+            return False
+
+    def get(self, pair):
+        """ Return the cached proposals of pair, or None """
+        try:
+            return np.load(self.filename_(pair))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put_(self, pair, rows):
+        fn = self.filename_(pair)
+        try:
+            if not os.path.isdir(self.cache_dir_):
+                os.makedirs(self.cache_dir_)
+            tmpname = fn + ".tmp"
+            with open(tmpname, "wb") as f:
+                np.save(f, rows)
+            os.rename(tmpname, fn)
+        except (IOError, OSError):
+            log.exception("failed to cache the proposals of {0}".format(fn))
+
+    def propose(self, pair, done=None):
+        """ Return the cached proposals of pair. Otherwise return None and
+        compute them in the background, calling done(pair) from the pool's
+        result thread once they are cached """
+        rows = self.get(pair)
+        if rows is not None:
+            return rows
+        def finished(result):
+            rows = result[1]
+            if rows is not None:
+                self.put_(pair, rows)
+            if done is not None:
+                done(pair)
+        job = (0, str(pair[0]), str(pair[1]), self.params_)
+        self.interactive_get_().apply_async(match_job, (job,), callback=finished)
+        return None
+
+    def precompute(self, pairs, progress=None):
+        """ Compute the proposals of every uncached pair in a background
+        thread. progress(done, total, pair_index) is called from that thread
+        as each pair finishes """
+        self.cancel()
+        self.cancelled_ = threading.Event()
+        self.thread_ = threading.Thread(target=self.run_,
+                                        args=(pairs, progress, self.cancelled_))
+        self.thread_.daemon = True
+        self.thread_.start()
+
+    def run_(self, pairs, progress, cancelled):
+        todo = [i for i in xrange(len(pairs)) if not self.cached(pairs[i])]
+        batch = self.processes_ * CHUNK_SIZE * QUEUED_CHUNKS
+        done = 0
+        for start in xrange(0, len(todo), batch):
+            if cancelled.is_set():
+                break
+            jobs = [(i, str(pairs[i][0]), str(pairs[i][1]), self.params_)
+                    for i in todo[start:start + batch]]
+            for i, rows in self.pool_get_().imap_unordered(match_job, jobs, CHUNK_SIZE):
+                # the queued jobs of a cancelled run are still cached
+                if rows is not None:
+                    self.put_(pairs[i], rows)
+                done += 1
+                if progress is not None and not cancelled.is_set():
+                    progress(done, len(todo), i)
+
+    def cancel(self):
+        """ Stop queueing the pairs of a precompute. Returns at once; the
+        jobs already queued finish in the background """
+        if self.cancelled_ is not None:
+            self.cancelled_.set()
+        self.thread_ = None
+
+    def close(self):
+        if self.cancelled_ is not None:
+            self.cancelled_.set()
+        if self.thread_ is not None:
+            # terminating the pool does not wake a thread waiting on its
+            # results; a daemon thread still waiting is left behind
+            self.thread_.join(CLOSE_TIMEOUT)
+            self.thread_ = None
+        for pool in (self.pool_, self.interactive_):
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        self.pool_ = None
+        self.interactive_ = None
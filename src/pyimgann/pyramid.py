@@ -0,0 +1,153 @@
+""" Multi-resolution tiled image pyramids cached on disk.
+
+Level 0 is the full-resolution image and every following level halves both
+dimensions, down to a single tile. The levels are saved as .npy files and
+memory-mapped on load, so only the tiles that are drawn are read.
+"""
+import os
+import shutil
+import logging
+import threading
+import numpy as np
+import cv2
+from PIL import Image
+import pyimgann.cache as cache
+
+log = logging.getLogger("pyimgann.pyramid")
+log.setLevel(logging.DEBUG)
+
+TILE = 256
+PYRAMID_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, "pyramid")
+# images with more pixels than this are shown from a pyramid
+LARGE_IMAGE_PIXELS = 4096 * 4096
+
+def is_large(img):
+    return img.shape[0] * img.shape[1] > LARGE_IMAGE_PIXELS
+
+def is_large_file(path):
+    """ Return whether the image file at path is large, reading only its
+    header. Files whose header cannot be read count as small """
+    try:
+        im = Image.open(str(path))
+        try:
+            w, h = im.size
+        finally:
+            im.close()
+    except getattr(Image, 'DecompressionBombError', ()):
+        # Pillow refuses to open images far above its pixel limit
+        return True
+    except IOError:
+        return False
+    return w * h > LARGE_IMAGE_PIXELS
+
+def build_levels(img):
+    levels = [img]
+    while max(levels[-1].shape[:2]) > TILE:
+        prev = levels[-1]
+        h, w = prev.shape[:2]
+        down = cv2.resize(prev, (max(1, w // 2), max(1, h // 2)),
+                          interpolation=cv2.INTER_AREA)
+        if down.ndim < prev.ndim:
+            # cv2 drops a trailing channel axis of length 1
+            down = down.reshape(down.shape + (1,))
+        levels.append(down)
+    return levels
+
+class ImagePyramid(object):
+    """ Levels of an image, level 0 at full resolution """
+    def __init__(self, levels):
+        self.levels = levels
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def __len__(self):
+        return len(self.levels)
+
+    def level_for_scale(self, scale):
+        """ Return the coarsest level with at least one pixel per screen
+        pixel at the given view scale """
+        if scale <= 0:
+            return len(self.levels) - 1
+        level = int(np.floor(np.log2(1.0 / scale))) if scale < 1 else 0
+        return min(max(level, 0), len(self.levels) - 1)
+
+    def tile_range(self, level, x0, y0, x1, y1):
+        """ Return the tile columns and rows of level covering the full
+        resolution rectangle x0, y0, x1, y1 """
+        h, w = self.levels[level].shape[:2]
+        step = TILE << level
+        cols = range(max(0, int(x0) // step), min((w + TILE - 1) // TILE,
+                                                    int(x1) // step + 1))
+        rows = range(max(0, int(y0) // step), min((h + TILE - 1) // TILE,
+                                                    int(y1) // step + 1))
+        return cols, rows
+
+    def tile(self, level, tx, ty):
+        """ Return the pixels of a tile and its full resolution rectangle
+        (x, y, w, h) """
+        arr = self.levels[level]
+        h, w = arr.shape[:2]
+        px = arr[ty * TILE:(ty + 1) * TILE, tx * TILE:(tx + 1) * TILE]
+        step = TILE << level
+        # the last tile of a row or column stretches to the edge of level 0,
+        # which the halved levels may fall a few pixels short of
+        full_h, full_w = self.levels[0].shape[:2]
+        x = tx * step
+        y = ty * step
+        tw = full_w - x if (tx + 1) * TILE >= w else step
+        th = full_h - y if (ty + 1) * TILE >= h else step
+        return np.ascontiguousarray(px), (x, y, tw, th)
+
+class PyramidCache(object):
+    """ Pyramids of image files, stored below a cache directory """
+    def __init__(self, cache_dir=PYRAMID_DIR):
+        self.cache_dir_ = cache_dir
+
+    def dirname_(self, path):
+        return os.path.join(self.cache_dir_, cache.file_key(path))
+
+    def get(self, path):
+        """ Return the cached pyramid of path, or None """
+        d = self.dirname_(path)
+        if not os.path.isdir(d):
+            return None
+        levels = []
+        while os.path.exists(os.path.join(d, "level{0}.npy".format(len(levels)))):
+            levels.append(np.load(os.path.join(d, "level{0}.npy".format(len(levels))),
+                                  mmap_mode="r"))
+        return ImagePyramid(levels) if levels else None
+
+    def build(self, path, img):
+        """ Build, store and return the pyramid of the decoded image of
+        path """
+        d = self.dirname_(path)
+        # the prefetch workers and the gui may build the same pyramid
+        tmp = "{0}.{1}.tmp".format(d, threading.current_thread().ident)
+        levels = build_levels(img)
+        try:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp)
+            for i, level in enumerate(levels):
+                np.save(os.path.join(tmp, "level{0}.npy".format(i)), level)
+            os.rename(tmp, d)
+        except (IOError, OSError):
+            if os.path.isdir(d):
+                # built by another thread first
+                shutil.rmtree(tmp, ignore_errors=True)
+                return self.get(path)
+            log.exception("failed to cache the pyramid of {0}".format(str(path)))
+            return ImagePyramid(levels)
+        log.debug("built {0} level pyramid of {1}".format(len(levels), str(path)))
+        return self.get(path)
+
+    def prefetch(self, path, loader):
+        """ Build the pyramid of path if it is a large image that has none,
+        decoding it with loader. Returns whether path is large """
+        if not is_large_file(path):
+            return False
+        if self.get(path) is None:
+            self.build(path, loader(str(path)))
+        return True
@@ -0,0 +1,134 @@
+""" Superpixel segmentations shown as an overlay of the dual image view.
+
+Label maps are computed by a process pool, since the segmentations take
+seconds per image, and stored on disk as uint16 .npy files keyed by the
+image file and the method parameters. The gui memory-maps them and turns
+them into an rgba overlay with a few array operations.
+"""
+import os
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+from skimage.io import imread
+from skimage.color import gray2rgb
+from skimage.segmentation import slic, felzenszwalb, quickshift
+import pyimgann.cache as cache
+
+log = logging.getLogger("pyimgann.segmentation")
+log.setLevel(logging.DEBUG)
+
+SEGMENT_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, "segments")
+METHODS = OrderedDict([('slic', (slic, {'n_segments': 400, 'compactness': 10.0})),
+                       ('felzenszwalb', (felzenszwalb, {'scale': 100, 'sigma': 0.8,
+                                                        'min_size': 50})),
+                       ('quickshift', (quickshift, {'kernel_size': 5, 'max_dist': 10,
+                                                    'ratio': 0.5}))])
+BOUNDARIES = 'boundaries'
+REGIONS = 'regions'
+BOUNDARY_COLOR = (255,255,0,255)
+# pairs after the current one whose segmentations are computed ahead
+PREFETCH_PAIRS = 2
+
+def segment(img, method):
+    """ Return the label map of img as consecutive uint16 labels """
+    f, params = METHODS[method]
+    if img.ndim == 2 or img.shape[2] == 1:
+        img = gray2rgb(img.reshape(img.shape[:2]))
+    labels = f(img[...,:3], **params)
+    _, labels = np.unique(labels, return_inverse=True)
+    dtype = np.uint16 if labels.max() <= np.iinfo(np.uint16).max else np.uint32
+    return labels.reshape(img.shape[:2]).astype(dtype)
+
+def segment_job(job):
+    """ Segment an image file and store the labels, in a worker process """
+    path, method, filename = job
+    try:
+        labels = segment(imread(path), method)
+        tmpname = filename + ".{0}.tmp".format(os.getpid())
+        with open(tmpname, "wb") as f:
+            np.save(f, labels)
+        os.rename(tmpname, filename)
+        return path, True
+    except Exception:
+        log.exception("failed to segment {0}".format(path))
+        return path, False
+
+def label_overlay(labels, mode=BOUNDARIES):
+    """ Return an rgba overlay of a label map: the segment boundaries, or
+    every segment filled with a colour of its own """
+    h, w = labels.shape
+    if mode == REGIONS:
+        rng = np.random.RandomState(0)
+        palette = rng.randint(0, 256, size=(int(labels.max()) + 1, 4)).astype(np.uint8)
+        palette[:,3] = 255
+        return palette[labels]
+    edge = np.zeros((h, w), dtype=bool)
+    edge[:,1:] |= labels[:,1:] != labels[:,:-1]
+    edge[1:,:] |= labels[1:,:] != labels[:-1,:]
+    rgba = np.zeros((h, w, 4), dtype=np.uint8)
+    rgba[edge] = BOUNDARY_COLOR
+    return rgba
+
+class SegmentationEngine(object):
+    """ Computes and caches the label maps of image files """
+    def __init__(self, cache_dir=SEGMENT_DIR, processes=None):
+        self.cache_dir_ = cache_dir
+        self.processes_ = processes or max(1, multiprocessing.cpu_count() - 1)
+        self.pool_ = None
+        self.pending_ = set()
+        self.lock_ = threading.Lock()
+
+    def filename_(self, path, method):
+        ident = repr((cache.file_key(path), method, sorted(METHODS[method][1].items())))
+        return os.path.join(self.cache_dir_, hashlib.sha1(ident).hexdigest() + ".npy")
+
+    def get(self, path, method):
+        """ Return the cached labels of path, memory-mapped, or None """
+        try:
+            return np.load(self.filename_(path, method), mmap_mode="r")
+        except (IOError, OSError, ValueError):
+            return None
+
+    def request(self, path, method, done=None):
+        """ Segment path in the pool unless it is cached or queued, then call
+        done(path) from the pool's result thread """
+        key = (str(path), method)
+        with self.lock_:
+            if key in self.pending_:
+                return
+            self.pending_.add(key)
+        fn = self.filename_(path, method)
+        if os.path.exists(fn):
+            self.finished_(key, True, done)
+            return
+        if not os.path.isdir(self.cache_dir_):
+            try:
+                os.makedirs(self.cache_dir_)
+            except OSError:
+                if not os.path.isdir(self.cache_dir_):
+                    raise
+        if self.pool_ is None:
+            self.pool_ = multiprocessing.Pool(self.processes_)
+        self.pool_.apply_async(segment_job, ((str(path), method, fn),),
+                               callback=lambda r: self.finished_(key, r[1], done))
+
+    def finished_(self, key, ok, done):
+        with self.lock_:
+            self.pending_.discard(key)
+        if ok and done is not None:
+            done(key[0])
+
+    def prefetch(self, pairs, index, method, done=None):
+        """ Queue the images of the pairs following pairs[index] """
+        for i in xrange(index + 1, min(index + 1 + PREFETCH_PAIRS, len(pairs))):
+            for p in pairs[i]:
+                self.request(p, method, done)
+
+    def close(self):
+        if self.pool_ is not None:
+            self.pool_.terminate()
+            self.pool_.join()
+            self.pool_ = None
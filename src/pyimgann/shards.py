@@ -0,0 +1,192 @@
+""" Sharded project storage.
+
+A sharded project is a manifest project file holding the meta, the path
+table, the pairs and the correspondence counts of every pair, and a
+directory of shard files next to it, each a project file of its own with
+the rows of SHARD_SIZE consecutive pairs:
+
+  project.pya
+  project.pya.shards/000000.3.pya
+  project.pya.shards/000001.5.pya
+  ...
+
+A shard holds the correspondences of its pairs and the keypoints of the
+images whose first pair falls in it. Opening a project maps the manifest
+only; shards are mapped when one of their rows is first read, a bounded
+number at a time, so open time and resident memory follow the pairs being
+looked at rather than the length of the sequence.
+
+Saving writes the shards holding edited groups under the generation of the
+new manifest, then the manifest naming them, then deletes the shards no
+longer named. The manifest rename switches the whole project at once; a
+crash before it leaves the previous manifest and all of its shards.
+"""
+import os
+import logging
+from collections import OrderedDict
+import numpy as np
+import pyimgann.projfile as pf
+
+log = logging.getLogger("pyimgann.shards")
+log.setLevel(logging.DEBUG)
+
+# pairs per shard
+SHARD_SIZE = 256
+# shard files kept mapped
+MAX_OPEN_SHARDS = 8
+# shards either side of the current pair's whose groups stay loaded
+WINDOW_SHARDS = 1
+
+def shard_dir(filename):
+    return str(filename) + ".shards"
+
+def shard_name(k, generation):
+    return "{0:06d}.{1}.pya".format(k, generation)
+
+def next_generation(filename):
+    """ Return the generation of a manifest replacing the one at filename,
+    so its shards never overwrite those in use """
+    try:
+        return pf.ProjectFile(filename).meta.get('generation', -1) + 1
+    except (IOError, OSError):
+        return 0
+
+def shard_count(pair_count, size):
+    return (pair_count + size - 1) // size
+
+def is_sharded(store):
+    return 'shard_size' in store.meta
+
+def image_owners(pairs, image_count):
+    """ Return the index of the first pair showing each image, or -1. Images
+    in no pair are kept in the first shard """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    owner = np.full(image_count, len(pairs), dtype=np.int64)
+    order = np.arange(len(pairs), dtype=np.int64)
+    np.minimum.at(owner, pairs[:,0], order)
+    np.minimum.at(owner, pairs[:,1], order)
+    owner[owner == len(pairs)] = -1
+    return owner
+
+def images_by_shard(owner, size, count):
+    """ Return the image indices owned by each of count shards """
+    shard = np.where(owner < 0, 0, owner // size)
+    order = np.argsort(shard, kind='mergesort')
+    bounds = np.searchsorted(shard[order], np.arange(count + 1))
+    return [order[bounds[k]:bounds[k+1]] for k in xrange(count)]
+
+def write_shard(filename, k, size, generation, corr_groups, images, kp_groups):
+    """ Write shard k: the correspondence groups of its pairs and the
+    keypoint groups of the images it owns. Returns its file name """
+    d = shard_dir(filename)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    name = shard_name(k, generation)
+    pf.write_project_file(os.path.join(d, name),
+                          {'shard': k, 'first': k * size,
+                           'images': [int(i) for i in images]},
+                          [], np.empty((0, 2), dtype=np.int32),
+                          corr_groups, kp_groups)
+    return name
+
+def write_manifest(filename, meta, paths, pairs, counts, size, generation, names):
+    """ Write the manifest of a sharded project, with the correspondence
+    count of every pair and the file names of its shards """
+    index = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=index[1:])
+    meta = dict(meta, shard_size=size, generation=generation, shard_files=names)
+    pf.write_project_file(filename, meta, paths, pairs, [], [], corr_idx=index)
+
+def remove_unused_shards(filename, names):
+    """ Delete the shard files the manifest does not name, left by earlier
+    generations or by a save that did not finish. Mapped files stay
+    readable after they are removed """
+    d = shard_dir(filename)
+    if not os.path.isdir(d):
+        return
+    used = set(names)
+    for name in os.listdir(d):
+        if name not in used and (name.endswith(".pya") or name.endswith(".tmp")):
+            os.remove(os.path.join(d, name))
+
+class Shard(object):
+    """ A mapped shard file """
+    def __init__(self, filename):
+        self.file = pf.ProjectFile(filename)
+        self.first = self.file.meta['first']
+        self.images_ = dict((p, i) for i, p in enumerate(self.file.meta['images']))
+
+    def corrs(self, pair_index):
+        return self.file.corrs(pair_index - self.first)
+
+    def kps(self, path_index):
+        i = self.images_.get(path_index)
+        if i is None:
+            return np.empty((0, 2), dtype=np.int32)
+        return self.file.kps(i)
+
+class ShardedProject(object):
+    """ Read-only view of a sharded project with the interface of a
+    ProjectFile. Shards are mapped on demand and the least recently used
+    are unmapped past max_shards """
+    def __init__(self, filename, max_shards=MAX_OPEN_SHARDS, manifest=None):
+        self.filename = str(filename)
+        self.manifest = manifest or pf.ProjectFile(filename)
+        self.meta = self.manifest.meta
+        self.paths = self.manifest.paths
+        self.pairs = self.manifest.pairs
+        self.corr_idx = self.manifest.corr_idx
+        self.shard_size = self.meta['shard_size']
+        self.generation = self.meta['generation']
+        self.shard_files = self.meta['shard_files']
+        self.max_shards_ = max_shards
+        self.shards_ = OrderedDict()
+        self.owners_ = None
+
+    @property
+    def shard_count(self):
+        return shard_count(len(self.pairs), self.shard_size)
+
+    def shard(self, k):
+        """ Return shard k, mapping it if needed """
+        s = self.shards_.pop(k, None)
+        if s is None:
+            log.debug("mapping shard %d of %s", k, self.filename)
+            s = Shard(os.path.join(shard_dir(self.filename), self.shard_files[k]))
+        self.shards_[k] = s
+        while len(self.shards_) > self.max_shards_:
+            self.shards_.popitem(last=False)
+        return s
+
+    def owners(self):
+        """ Return the first pair of each image, computed on first use """
+        if self.owners_ is None:
+            self.owners_ = image_owners(self.pairs, len(self.paths))
+        return self.owners_
+
+    def shard_of_image(self, path_index):
+        if path_index >= len(self.paths):
+            return -1
+        if self.shard_count == 0:
+            return -1
+        return max(self.owners()[path_index], 0) // self.shard_size
+
+    def corrs(self, pair_index):
+        """ Return the (N,4) correspondence rows of a pair """
+        if pair_index >= len(self.pairs):
+            return np.empty((0, 4), dtype=np.int32)
+        return self.shard(pair_index // self.shard_size).corrs(pair_index)
+
+    def kps(self, path_index):
+        """ Return the (N,2) keypoint rows of an image """
+        k = self.shard_of_image(path_index)
+        if k < 0:
+            return np.empty((0, 2), dtype=np.int32)
+        return self.shard(k).kps(path_index)
+
+def open_store(filename):
+    """ Open a project file, sharded or not """
+    f = pf.ProjectFile(filename)
+    if is_sharded(f):
+        return ShardedProject(filename, manifest=f)
+    return f
@@ -0,0 +1,124 @@
+""" Timing spans of the interactive hot paths.
+
+    with trace.span("load_keypoints"):
+        ...
+
+Spans are recorded only while tracing is enabled; otherwise span() returns a
+shared no-op object, so the instrumented code pays one global lookup. The
+most recent spans are kept in a bounded buffer and can be summarised, broken
+down below an outer span, or exported in the Chrome trace event format
+(chrome://tracing, Perfetto).
+"""
+import time
+import json
+import threading
+from collections import deque, OrderedDict
+from functools import wraps
+
+# spans kept in memory
+MAX_SPANS = 20000
+
+enabled = False
+spans_ = deque(maxlen=MAX_SPANS)
+local_ = threading.local()
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+    __slots__ = ('name', 'start', 'depth')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.depth = getattr(local_, 'depth', 0)
+        local_.depth = self.depth + 1
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        local_.depth = self.depth
+        spans_.append((self.name, self.start, end - self.start, self.depth,
+                       threading.current_thread().ident))
+        return False
+
+def span(name):
+    """ Return a context manager timing the enclosed block as name """
+    if not enabled:
+        return NULL_SPAN
+    return Span(name)
+
+def traced(name):
+    """ Decorator timing every call of a function as name """
+    def decorate(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            with Span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def clear():
+    spans_.clear()
+
+def spans():
+    """ Return the recorded (name, start, duration, depth, thread) spans,
+    oldest first """
+    return list(spans_)
+
+def breakdown(name):
+    """ Return the duration of the last span called name and the (name,
+    total duration) of the spans directly nested within it """
+    recorded = spans()
+    for i in xrange(len(recorded) - 1, -1, -1):
+        n, start, dur, depth, thread = recorded[i]
+        if n != name:
+            continue
+        inner = OrderedDict()
+        for s in recorded[:i]:
+            if s[4] == thread and s[3] == depth + 1 and s[1] >= start:
+                inner[s[0]] = inner.get(s[0], 0.0) + s[2]
+        return dur, inner.items()
+    return None, []
+
+def summary():
+    """ Return name -> (count, mean, max) seconds of the recorded spans """
+    stats = OrderedDict()
+    for name, start, dur, depth, thread in spans():
+        count, total, worst = stats.get(name, (0, 0.0, 0.0))
+        stats[name] = (count + 1, total + dur, max(worst, dur))
+    return OrderedDict((n, (c, t / c, w)) for n, (c, t, w) in stats.items())
+
+def export_trace(filename):
+    """ Write the recorded spans as a Chrome trace event file """
+    events = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': thread,
+               'ts': start * 1e6, 'dur': dur * 1e6}
+              for name, start, dur, depth, thread in spans()]
+    with open(filename, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
+
+def format_breakdown(name):
+    """ Return a one line description of the last span called name """
+    total, inner = breakdown(name)
+    if total is None:
+        return ""
+    parts = ["{0} {1:.1f}ms".format(n, 1000 * d) for n, d in inner]
+    text = "{0} {1:.1f}ms".format(name, 1000 * total)
+    if parts:
+        text += ": " + ", ".join(parts)
+    return text
@@ -3,16 +3,18 @@ import sys
 import os
 import pathlib as pl
 import logging
+from collections import OrderedDict
 
 from PyQt4.QtCore import Qt, QRect, QLine, QMargins, \
-     QDir, pyqtSignal, QRectF, QPointF, QObject
+     QDir, pyqtSignal, QRectF, QPointF, QObject, QAbstractTableModel, \
+     QAbstractListModel, QModelIndex, QVariant, QSize
 from PyQt4.QtGui import QApplication, QLabel, QWidget, QImage, QPainter, \
-     QColor, QPixmap, QGridLayout, QLabel, QGraphicsView, QGraphicsScene, \
+     QColor, QPen, QPixmap, QGridLayout, QLabel, QGraphicsView, QGraphicsScene, \
      QMainWindow, QPalette, QMenu, QAction, QFileDialog, QScrollArea, \
      QGraphicsItemGroup, QGraphicsLineItem, QGraphicsRectItem, QGraphicsPolygonItem, \
      QGraphicsEllipseItem, QListView, QDockWidget, QPolygonF, QPushButton, QHBoxLayout, \
      QSpinBox, QDialogButtonBox, QLineEdit, QSplitter, QDialog, QFormLayout, QTableView, \
-     QGraphicsItem
+     QGraphicsItem, QStyleOptionGraphicsItem, QSlider
 
 import numpy as np
 from skimage.io import imread
@@ -22,10 +24,105 @@ from skimage import exposure
 import cv2
 
 import qimage2ndarray as qn
+import sip
+import pyimgann.pyramid as pyr
+import pyimgann.trace as trace
+import pyimgann.enhance as enh
+from pyimgann.cache import THUMB_SIZE
 
 log = logging.getLogger('pyimgann.ui')
 log.setLevel(logging.DEBUG)
 
+GRAY_TABLE = [QColor(i,i,i).rgb() for i in range(256)]
+# tiles of an image pyramid kept as pixmaps
+TILE_CACHE_SIZE = 256
+# thumbnail strips of the pair list kept as pixmaps
+PAIR_PIXMAP_CACHE_SIZE = 512
+# correspondences removed row by row from the table; more reset it
+TABLE_ROW_EDIT = 16
+# lasso vertices closer than this many pixels are merged
+LASSO_STEP = 3
+REGION_COLOR = (0,255,255)
+OVERLAY_OPACITY = 0.5
+
+def wrap_qimage(img, buf=None):
+    """ Return a QImage viewing the pixels of img, and the array backing it.
+    8-bit gray and rgb images are wrapped without copying; rgba images are
+    swizzled into buf (reused when its shape matches) since Qt4 has no rgba
+    byte order. The returned array must outlive the QImage. """
+    if img.dtype != np.uint8 or img.ndim not in (2,3):
+        qimg = qn.array2qimage(img, normalize=(img.dtype != np.uint8))
+        return qimg, None
+    h, w = img.shape[:2]
+    if img.ndim == 2 or img.shape[2] == 1:
+        arr = np.ascontiguousarray(img.reshape(h, w))
+        qimg = QImage(sip.voidptr(arr.ctypes.data), w, h, arr.strides[0],
+                      QImage.Format_Indexed8)
+        qimg.setColorTable(GRAY_TABLE)
+    elif img.shape[2] == 3:
+        arr = np.ascontiguousarray(img)
+        qimg = QImage(sip.voidptr(arr.ctypes.data), w, h, arr.strides[0],
+                      QImage.Format_RGB888)
+    else:
+        if buf is None or buf.shape != (h, w, 4):
+            buf = np.empty((h, w, 4), dtype=np.uint8)
+        arr = buf
+        # Format_ARGB32 is stored as BGRA on little-endian machines
+        arr[...,0] = img[...,2]
+        arr[...,1] = img[...,1]
+        arr[...,2] = img[...,0]
+        arr[...,3] = img[...,3]
+        qimg = QImage(sip.voidptr(arr.ctypes.data), w, h, arr.strides[0],
+                      QImage.Format_ARGB32)
+    return qimg, arr
+
+class TiledImageItem(QGraphicsItem):
+    """ Draws the visible tiles of an ImagePyramid at the level matching the
+    view scale. The item spans the full resolution image, so scene
+    coordinates stay in full resolution pixels """
+    def __init__(self, pyramid, parent=None):
+        super(TiledImageItem,self).__init__(parent)
+        self.pyramid_ = pyramid
+        self.tiles_ = OrderedDict()
+        self.lut_ = None
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def set_lut(self, lut):
+        """ Draw the tiles through a display lookup table, or none """
+        if lut is self.lut_:
+            return
+        self.lut_ = lut
+        self.tiles_.clear()
+        self.update()
+
+    def boundingRect(self):
+        h, w = self.pyramid_.shape[:2]
+        return QRectF(0, 0, w, h)
+
+    def tile_(self, level, tx, ty):
+        key = (level, tx, ty)
+        hit = self.tiles_.pop(key, None)
+        if hit is None:
+            px, rect = self.pyramid_.tile(level, tx, ty)
+            qimg, _ = wrap_qimage(enh.apply_lut(px, self.lut_))
+            hit = (QPixmap.fromImage(qimg), rect)
+            if len(self.tiles_) >= TILE_CACHE_SIZE:
+                self.tiles_.popitem(last=False)
+        self.tiles_[key] = hit
+        return hit
+
+    def paint(self, painter, option, widget=None):
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.pyramid_.level_for_scale(scale)
+        r = option.exposedRect
+        cols, rows = self.pyramid_.tile_range(level, r.left(), r.top(),
+                                              r.right(), r.bottom())
+        for ty in rows:
+            for tx in cols:
+                pixmap, (x, y, w, h) = self.tile_(level, tx, ty)
+                painter.drawPixmap(QRectF(x, y, w, h), pixmap,
+                                   QRectF(pixmap.rect()))
+
 class Annotation(QObject):
     BASE_COLOR = (255,0,0)
     SELECTED_COLOR = (0,255,0)
@@ -37,6 +134,7 @@ class Annotation(QObject):
         super(Annotation,self).__init__()
         self.desc_ = desc
         self.color_ = color
+        self.base_color_ = color
         self.pts_ = np.array(pts)
         self.radius_ = 4
         self.index = -1
@@ -55,10 +153,15 @@ class Annotation(QObject):
         self.changed.emit()
         
     def deselect(self):
-        self.color_ = Annotation.BASE_COLOR
+        self.color_ = self.base_color_
         self.item_.setPen(self.qcolor)
         self.changed.emit()
 
+    def highlight_(self, color):
+        # recolour without a change notification, for bulk selection
+        self.color_ = color
+        self.item.setPen(self.qcolor)
+
     @property
     def is_point(self):
         return len(self.pts_) == 1
@@ -113,6 +216,149 @@ class Annotation(QObject):
             self.item_ = item
         return self.item_
         
+class CorrespondenceTableModel(QAbstractTableModel):
+    """ Table of the correspondences of one pair, read directly from the
+    pair's CorrespondenceSet """
+    HEADERS = ["Image A", "Image B"]
+
+    def __init__(self, parent=None):
+        super(CorrespondenceTableModel,self).__init__(parent)
+        self.corrs_ = None
+
+    def set_correspondences(self, corrs):
+        self.beginResetModel()
+        self.corrs_ = corrs
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid() or self.corrs_ is None:
+            return 0
+        return len(self.corrs_)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(CorrespondenceTableModel.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return QVariant()
+        row = self.corrs_.rows()[index.row()]
+        c = 2 * index.column()
+        return "[{0} {1}]".format(row[c], row[c+1])
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return CorrespondenceTableModel.HEADERS[section]
+        return QVariant()
+
+    def add_rows(self, rows):
+        """ Append the (N,4) rows, which must not be in the pair yet,
+        returning their ids """
+        if len(rows) == 0:
+            return []
+        n = len(self.corrs_)
+        self.beginInsertRows(QModelIndex(), n, n + len(rows) - 1)
+        ids = self.corrs_.append(rows)
+        self.endInsertRows()
+        return ids.tolist()
+
+    def remove_rows(self, rows, ids):
+        """ Remove the (N,4) rows with the given ids. A few rows are
+        removed one at a time, keeping the selection and scroll position of
+        the views; more with a single reset """
+        if len(ids) > TABLE_ROW_EDIT:
+            self.beginResetModel()
+            self.corrs_.remove_rows(rows)
+            self.endResetModel()
+            return
+        for cid in ids:
+            # the last row moves into the place of the removed one
+            i = self.corrs_.position(cid)
+            last = len(self.corrs_) - 1
+            self.beginRemoveRows(QModelIndex(), last, last)
+            self.corrs_.remove_id(cid)
+            self.endRemoveRows()
+            if i != last:
+                self.dataChanged.emit(self.index(i, 0),
+                                      self.index(i, self.columnCount() - 1))
+
+class PairListModel(QAbstractListModel):
+    """ List of image pairs whose rows are formatted on demand, so the
+    pair sequence is never materialised. With a ThumbnailCache, rows are
+    decorated with the thumbnails of both images once they are ready """
+    # emitted from the thumbnail workers, delivered in the gui thread
+    thumbnail_ready = pyqtSignal(str)
+
+    def __init__(self, parent=None, thumbnails=None):
+        super(PairListModel,self).__init__(parent)
+        self.pairs_ = None
+        self.rows_ = 0
+        self.thumbnails_ = thumbnails
+        # composed row pixmaps, and the rows waiting for each image
+        self.pixmaps_ = OrderedDict()
+        self.waiting_ = {}
+        self.thumbnail_ready.connect(self.on_thumbnail_ready)
+
+    def set_pairs(self, pairs):
+        self.beginResetModel()
+        self.pairs_ = pairs
+        self.rows_ = 0 if pairs is None else len(pairs)
+        self.pixmaps_.clear()
+        self.waiting_.clear()
+        self.endResetModel()
+
+    def sync(self):
+        """ Show the pairs appended to the sequence since the last sync """
+        count = 0 if self.pairs_ is None else len(self.pairs_)
+        if count > self.rows_:
+            self.beginInsertRows(QModelIndex(), self.rows_, count - 1)
+            self.rows_ = count
+            self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.rows_
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return QVariant()
+        if role == Qt.DisplayRole:
+            left, right = self.pairs_[index.row()]
+            return "{0}, {1}".format(left.stem, right.stem)
+        if role == Qt.DecorationRole and self.thumbnails_ is not None:
+            return self.decoration_(index.row())
+        return QVariant()
+
+    def decoration_(self, row):
+        pixmap = self.pixmaps_.pop(row, None)
+        if pixmap is None:
+            thumbs = []
+            for path in self.pairs_[row]:
+                thumb = self.thumbnails_.get(path)
+                if thumb is None:
+                    # only rows the view asks for, i.e. visible rows, wait
+                    self.waiting_.setdefault(str(path), set()).add(row)
+                    self.thumbnails_.request(path, lambda p: self.thumbnail_ready.emit(str(p)))
+                thumbs.append(thumb)
+            if any(t is None for t in thumbs):
+                return QVariant()
+            h = max(t.shape[0] for t in thumbs)
+            strip = np.zeros((h, sum(t.shape[1] for t in thumbs) + 2, 3), dtype=np.uint8)
+            strip[:thumbs[0].shape[0], :thumbs[0].shape[1]] = thumbs[0]
+            strip[:thumbs[1].shape[0], thumbs[0].shape[1] + 2:] = thumbs[1]
+            qimg, _ = wrap_qimage(strip)
+            pixmap = QPixmap.fromImage(qimg)
+            if len(self.pixmaps_) >= PAIR_PIXMAP_CACHE_SIZE:
+                self.pixmaps_.popitem(last=False)
+        self.pixmaps_[row] = pixmap
+        return pixmap
+
+    def on_thumbnail_ready(self, path):
+        for row in self.waiting_.pop(str(path), ()):
+            if row < self.rows_:
+                idx = self.index(row, 0)
+                self.dataChanged.emit(idx, idx)
+
 class DualImageView(QGraphicsView):
     VERTICAL = 0
     HORIZONTAL = 1
@@ -129,6 +375,11 @@ class DualImageView(QGraphicsView):
     image_a_click = pyqtSignal(int,int)
     image_b_click = pyqtSignal(int,int)    
 
+    # region signals: the (N,2) polygon dragged out in scene coordinates,
+    # and the offset the selected region was dragged by
+    region_selected = pyqtSignal(object)
+    region_moved = pyqtSignal(int,int)
+
     # keyboard
     key_event = pyqtSignal(int)
 
@@ -141,8 +392,18 @@ class DualImageView(QGraphicsView):
         self.setStyleSheet("QGraphicsView { border: none; }")
         
         self.scene_ = QGraphicsScene(0,0,0,0,self.parent_)
-        self.image_item_ = self.scene_.addPixmap(QPixmap())
-        self.image_item_.setPos(0,0)
+        # one pixmap item per image, so no composite is ever built
+        self.image_items_ = [self.scene_.addPixmap(QPixmap()),
+                             self.scene_.addPixmap(QPixmap())]
+        for it in self.image_items_:
+            it.setPos(0,0)
+        # pyramid images are drawn by tiled items in place of the pixmaps
+        self.tiled_items_ = [None, None]
+        # overlays above the images and below the annotations
+        self.overlay_items_ = [self.scene_.addPixmap(QPixmap()),
+                               self.scene_.addPixmap(QPixmap())]
+        for it in self.overlay_items_:
+            it.setOpacity(OVERLAY_OPACITY)
         #self.ann_group_ = QGraphicsItemGroup()
         #self.ann_group_.setPos(0,0)
         #self.scene_.addItem(self.ann_group_)
@@ -152,11 +413,26 @@ class DualImageView(QGraphicsView):
         # TODO: handle orientation
         self.orientation_ = DualImageView.VERTICAL
         self.images_ = [None, None]
-        self.composite_ = None
-        self.annotations_ = []
+        # reusable swizzle buffers for images Qt cannot wrap directly
+        self.buffers_ = [None, None]
+        # display lookup tables of the images; None shows the pixels as is
+        self.luts_ = [None, None]
+        # annotations by stable id, and the id of each annotation's item
+        self.annotations_ = OrderedDict()
+        self.item_ids_ = {}
+        self.next_id_ = 0
         self.dim_ = 0
         self.offset_ = np.array([0,0])
         self.cancel_click_ = False
+        self.img_local_pt = None
+        # the region being dragged out, and the selected region
+        self.drag_ = []
+        self.lasso_ = False
+        self.moving_ = False
+        self.band_ = None
+        self.region_ = None
+        self.region_item_ = None
+        self.region_ids_ = []
         
         self.images_changed.connect(self.on_images_changed)
         self.annotations_changed.connect(self.on_annotations_changed)
@@ -167,12 +443,10 @@ class DualImageView(QGraphicsView):
         if len(selected) > 0:
             self.cancel_click_ = True
             selected = self.scene_.selectedItems()[0]
-            idx = -1
-            for a in self.annotations_:
-                idx += 1
-                if a.item == selected:
-                    log.debug(" emitting selection {0}".format(idx))
-                    self.annotation_selected.emit(idx)
+            idx = self.item_ids_.get(selected)
+            if idx is not None:
+                log.debug(" emitting selection {0}".format(idx))
+                self.annotation_selected.emit(idx)
         else:
             self.no_selection.emit()
 
@@ -196,23 +470,42 @@ class DualImageView(QGraphicsView):
             return p + self.image_b_offset
         return p
 
+    @trace.traced("on_images_changed")
     def on_images_changed(self):
         imga = self.images_[0]
         imgb = self.images_[1]
+        for i, it in enumerate(self.tiled_items_):
+            if it is not None:
+                self.scene_.removeItem(it)
+                self.tiled_items_[i] = None
+        for it in self.overlay_items_:
+            it.setPixmap(QPixmap())
+        if imga is None or imgb is None:
+            for it in self.image_items_:
+                it.setPixmap(QPixmap())
+            self.repaint()
+            return
         width = max(imga.shape[1],imgb.shape[1])
         heighta = imga.shape[0]
         heightb = imgb.shape[0]
         height = heighta + heightb
         self.dim_ = heighta
         self.offset_ = np.array([0,heighta])
-        # this assumes rgb images :-(
-        comp = np.empty((height,width,imga.shape[2]),dtype=imga.dtype)
-        comp[0:heighta,:imga.shape[1],:] = imga
-        comp[heighta:(heighta+heightb),:imgb.shape[1],:] = imgb
-        self.composite_ = comp
-        qimg = qn.array2qimage(self.composite_)
-        pix = QPixmap.fromImage(qimg)
-        self.image_item_.setPixmap(pix)
+        for i, img in enumerate(self.images_):
+            if isinstance(img, pyr.ImagePyramid):
+                self.image_items_[i].setPixmap(QPixmap())
+                item = TiledImageItem(img)
+                # below the annotations, like the pixmap items
+                item.setZValue(self.image_items_[i].zValue())
+                item.set_lut(self.luts_[i])
+                self.scene_.addItem(item)
+                self.tiled_items_[i] = item
+                continue
+            self.update_pixmap_(i)
+        self.image_items_[1].setPos(0, heighta)
+        self.overlay_items_[1].setPos(0, heighta)
+        if self.tiled_items_[1] is not None:
+            self.tiled_items_[1].setPos(0, heighta)
         self.scene_.setSceneRect(0,0, width, height)
         self.repaint()
         
@@ -226,7 +519,8 @@ class DualImageView(QGraphicsView):
         #     log.debug(" adding item")
         #     self.ann_group_.addToGroup(a.get_item())
         # self.scene_.addItem(self.ann_group_)
-        self.repaint()
+        # coalesce the repaints of many changes into one
+        self.viewport().update()
 
     def transform_raw_pt(self, ev):
         pt = self.mapToScene(ev.x(), ev.y())
@@ -234,12 +528,11 @@ class DualImageView(QGraphicsView):
 
     def clear(self):
         self.images_ = [None,None]
-        self.composite_ = None
-        self.annotations_ = None
         self.images_changed.emit()
-        self.annotations_changed.emit()
+        self.clear_annotations()
         
     def set_images(self, img_pair):
+        """ Show a pair of images, each an array or an ImagePyramid """
         self.images_ = img_pair
         self.images_changed.emit()
 
@@ -266,52 +559,215 @@ class DualImageView(QGraphicsView):
         return self.annotations_[idx]
 
     def clear_annotations(self):
-        for a in self.annotations_:
+        self.clear_region_selection()
+        for a in self.annotations_.itervalues():
             self.scene_.removeItem(a.item)
-        self.annotations_ = []
+        self.annotations_.clear()
+        self.item_ids_.clear()
         self.annotations_changed.emit()
 
     def add_annotation(self, ann):
+        """ Add ann to the scene and return its id, which stays valid until
+        the annotation is removed """
+        idx = self.next_id_
+        self.next_id_ += 1
         ann.changed.connect(self.on_annotations_changed)
-        self.annotations_.append(ann)
+        self.annotations_[idx] = ann
+        self.item_ids_[ann.item] = idx
         self.scene_.addItem(ann.item)
         self.annotations_changed.emit()
-        return len(self.annotations_) - 1
+        return idx
+
+    def add_annotations(self, anns):
+        """ Add all of anns with a single change notification, returning
+        their ids """
+        ids = range(self.next_id_, self.next_id_ + len(anns))
+        self.next_id_ += len(anns)
+        for idx, ann in zip(ids, anns):
+            ann.changed.connect(self.on_annotations_changed)
+            self.annotations_[idx] = ann
+            self.item_ids_[ann.item] = idx
+            self.scene_.addItem(ann.item)
+        self.annotations_changed.emit()
+        return ids
         
     def remove_last_annotation(self):
-        self.scene_.removeItem(self.annotations_[-1].item)
-        del self.annotations_[-1]
-        self.annotations_changed.emit()
+        idx, ann = self.annotations_.popitem(last=True)
+        self.remove_item_(ann)
 
     def remove_annotation(self, idx):
-        self.scene_.removeItem(self.annotations_[idx].item)
-        del self.annotations_[idx]
+        self.remove_item_(self.annotations_.pop(idx))
+
+    def remove_annotations(self, ids):
+        """ Remove the annotations ids with a single change notification """
+        for idx in ids:
+            ann = self.annotations_.pop(idx)
+            del self.item_ids_[ann.item]
+            self.scene_.removeItem(ann.item)
+        self.annotations_changed.emit()
+
+    def remove_item_(self, ann):
+        del self.item_ids_[ann.item]
+        self.scene_.removeItem(ann.item)
+        self.annotations_changed.emit()
+
+    def update_pixmap_(self, i):
+        img = enh.apply_lut(self.images_[i], self.luts_[i])
+        # the QImage borrows the array, so fromImage is the only copy
+        qimg, self.buffers_[i] = wrap_qimage(img, self.buffers_[i])
+        self.image_items_[i].setPixmap(QPixmap.fromImage(qimg))
+
+    @property
+    def images(self):
+        return tuple(self.images_)
+
+    def set_luts(self, luts, redraw=True):
+        """ Show the images through a pair of display lookup tables. Only
+        the displayed pixels change """
+        self.luts_ = list(luts)
+        if not redraw:
+            return
+        for i, img in enumerate(self.images_):
+            if self.tiled_items_[i] is not None:
+                self.tiled_items_[i].set_lut(self.luts_[i])
+            elif img is not None:
+                self.update_pixmap_(i)
+
+    def is_tiled(self, which):
+        return self.tiled_items_[which] is not None
+
+    def set_overlay(self, which, rgba):
+        """ Show an (H,W,4) rgba overlay over image which, or none """
+        if rgba is None:
+            self.overlay_items_[which].setPixmap(QPixmap())
+            return
+        qimg, _ = wrap_qimage(rgba)
+        self.overlay_items_[which].setPixmap(QPixmap.fromImage(qimg))
+
+    def set_overlay_visible(self, visible):
+        for it in self.overlay_items_:
+            it.setVisible(visible)
+
+    def set_overlay_opacity(self, opacity):
+        for it in self.overlay_items_:
+            it.setOpacity(opacity)
+
+    def region_pen_(self):
+        pen = QPen(QColor(*REGION_COLOR))
+        pen.setStyle(Qt.DashLine)
+        pen.setCosmetic(True)
+        return pen
+
+    def set_region_selection(self, poly, ids):
+        """ Outline the (N,2) polygon poly and highlight the annotations ids
+        selected by it """
+        self.clear_region_selection()
+        self.region_ = QPolygonF([QPointF(x, y) for x, y in poly])
+        self.region_item_ = self.scene_.addPolygon(self.region_, self.region_pen_())
+        self.region_item_.setZValue(1e6)
+        self.region_ids_ = list(ids)
+        for idx in self.region_ids_:
+            self.annotations_[idx].highlight_(Annotation.SELECTED_COLOR)
         self.annotations_changed.emit()
 
+    def clear_region_selection(self):
+        if self.region_item_ is not None:
+            self.scene_.removeItem(self.region_item_)
+        for idx in self.region_ids_:
+            ann = self.annotations_.get(idx)
+            if ann is not None:
+                ann.highlight_(ann.base_color_)
+        self.region_ = None
+        self.region_item_ = None
+        self.region_ids_ = []
+        self.annotations_changed.emit()
+
+    def move_region_items_(self, dx, dy):
+        """ Preview a move of the selected region """
+        self.region_item_.setPos(dx, dy)
+        for idx in self.region_ids_:
+            ann = self.annotations_.get(idx)
+            if ann is not None:
+                ann.item.setPos(dx, dy)
+        self.viewport().update()
+
     def mousePressEvent(self, ev):
         super(DualImageView,self).mousePressEvent(ev)
         if self.cancel_click_:
             return
         log.debug("mouse pressed: " + str(ev))
         self.img_local_pt = self.transform_raw_pt(ev)
+        pt = QPointF(self.img_local_pt[0], self.img_local_pt[1])
+        self.moving_ = self.region_ is not None and \
+                       self.region_.containsPoint(pt, Qt.OddEvenFill)
+        self.lasso_ = bool(ev.modifiers() & Qt.ShiftModifier)
+        self.drag_ = [self.img_local_pt]
+
+    def mouseMoveEvent(self, ev):
+        super(DualImageView,self).mouseMoveEvent(ev)
+        if self.cancel_click_ or self.img_local_pt is None or \
+           not (ev.buttons() & Qt.LeftButton):
+            return
+        pt = self.transform_raw_pt(ev)
+        delta = pt - self.img_local_pt
+        if self.moving_:
+            self.move_region_items_(delta[0], delta[1])
+            return
+        if self.lasso_:
+            if np.abs(pt - self.drag_[-1]).max() >= LASSO_STEP:
+                self.drag_.append(pt)
+        else:
+            self.drag_ = [self.img_local_pt, pt]
+        poly = self.drag_polygon_()
+        if self.band_ is None:
+            self.band_ = self.scene_.addPolygon(QPolygonF(), self.region_pen_())
+            self.band_.setZValue(1e6)
+        self.band_.setPolygon(QPolygonF([QPointF(x, y) for x, y in poly]))
+
+    def drag_polygon_(self):
+        """ Return the dragged out region as an (N,2) polygon """
+        if self.lasso_:
+            return np.array(self.drag_)
+        (x0, y0), (x1, y1) = self.drag_[0], self.drag_[-1]
+        return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
+
+    def end_drag_(self):
+        if self.band_ is not None:
+            self.scene_.removeItem(self.band_)
+            self.band_ = None
+        self.img_local_pt = None
+        self.drag_ = []
 
     def mouseReleaseEvent(self, ev):
         super(DualImageView,self).mouseReleaseEvent(ev)
         if self.cancel_click_:
             self.cancel_click_ = False
             return
+        if self.img_local_pt is None:
+            return
         log.debug("mouse released: " + str(ev))
         rel_pt = self.transform_raw_pt(ev)
         delta = rel_pt - self.img_local_pt
-        if abs(delta[0]) < 3 and abs(delta[1] < 3):
+        if abs(delta[0]) < 3 and abs(delta[1]) < 3:
             # it was a successful click
+            if self.moving_:
+                self.move_region_items_(0, 0)
             self.mouseClicked(self.img_local_pt)
         else: 
-            # recognize this as a rectangle drag
+            # recognize this as a region drag
             self.mouseDragged(self.img_local_pt, delta)
+        self.end_drag_()
 
     def mouseDragged(self, pt, delta):
         log.debug("mouse dragged: {0}, {1}".format(pt,delta))
+        if self.moving_:
+            # the controller rebuilds the moved annotations
+            self.move_region_items_(0, 0)
+            self.region_moved.emit(int(delta[0]), int(delta[1]))
+        else:
+            if not self.lasso_:
+                self.drag_ = [pt, pt + delta]
+            self.region_selected.emit(self.drag_polygon_())
 
     def mouseClicked(self, pt):
         log.debug("mouse clicked: {0}".format(pt))
@@ -328,6 +784,46 @@ class DualImageView(QGraphicsView):
         k = ev.key()
         self.key_event.emit(k)
 
+class EnhanceWidget(QWidget):
+    """ Sliders of the display enhancement """
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(EnhanceWidget,self).__init__(parent)
+        # name, range and scale of each slider's integer value
+        self.sliders_ = OrderedDict()
+        layout = QFormLayout(self)
+        for name, label, lo, hi, scale in [('low', "Black %", 0, 200, 10.0),
+                                           ('high', "White %", 800, 1000, 10.0),
+                                           ('gamma', "Gamma", 20, 300, 100.0),
+                                           ('equalize', "Equalise", 0, 100, 100.0)]:
+            slider = QSlider(Qt.Horizontal, self)
+            slider.setRange(lo, hi)
+            slider.valueChanged.connect(lambda v: self.changed.emit())
+            self.sliders_[name] = (slider, scale)
+            layout.addRow(label, slider)
+        reset = QPushButton("Reset", self)
+        reset.clicked.connect(self.reset)
+        layout.addRow(reset)
+        self.setLayout(layout)
+        self.reset()
+
+    def reset(self):
+        self.set_adjustment(enh.Adjustment())
+
+    def set_adjustment(self, adj):
+        for name, (slider, scale) in self.sliders_.items():
+            slider.blockSignals(True)
+            slider.setValue(int(round(getattr(adj, name) * scale)))
+            slider.blockSignals(False)
+        self.changed.emit()
+
+    @property
+    def adjustment(self):
+        values = dict((name, slider.value() / scale)
+                      for name, (slider, scale) in self.sliders_.items())
+        return enh.Adjustment(**values)
+
 class QFileField(QWidget):
     # itemSelected is emitted when a valid file/dir is chosen
     itemSelected = pyqtSignal()
@@ -424,7 +920,20 @@ class MainWindow(QMainWindow):
         self.next_button_ = QPushButton("&Next",self)
         self.prev_button_ = QPushButton("&Previous",self)
         self.status_msg_ = QLabel("Status...",self)
+        # latency overlay, shown while timing is enabled
+        self.timing_msg_ = QLabel("",self)
+        self.timing_msg_.setVisible(False)
+        # opacity of the segment overlay, shown while it is on
+        self.overlay_opacity_ = QSlider(Qt.Horizontal, self)
+        self.overlay_opacity_.setRange(0, 100)
+        self.overlay_opacity_.setValue(int(100 * OVERLAY_OPACITY))
+        self.overlay_opacity_.setMaximumWidth(120)
+        self.overlay_opacity_.setVisible(False)
+        self.enhance_ = EnhanceWidget(self)
         
+        # all rows share one height, so the view never measures them all
+        self.pair_list_.setUniformItemSizes(True)
+        self.pair_list_.setIconSize(QSize(2 * THUMB_SIZE + 2, THUMB_SIZE))
         self.corr_list_.verticalHeader().setVisible(False)
         self.corr_list_.setSelectionBehavior(QTableView.SelectRows)
 
@@ -462,10 +971,16 @@ class MainWindow(QMainWindow):
         hpanel.addWidget(self.next_button_)
         hpanel.addWidget(self.status_msg_)
         hpanel.addStretch()
+        hpanel.addWidget(self.overlay_opacity_)
+        hpanel.addWidget(self.timing_msg_)
         wpanel.setLayout(hpanel)
         bot = self.dock(wpanel, Qt.BottomDockWidgetArea)
         bot.setFeatures(bot.features() & QDockWidget.NoDockWidgetFeatures)
 
+        self.enhance_dock_ = self.dock(self.enhance_, Qt.RightDockWidgetArea,
+                                       title="Contrast")
+        self.enhance_dock_.setVisible(False)
+
     def create_menu(self):
         self.file_ = QMenu("&File", self)
         self.edit_ = QMenu("&Edit", self)